@@ -4,9 +4,10 @@ from __future__ import absolute_import
 import datetime
 import json
 import logging
+import uuid
 
-from ckan.lib.jobs import get_queue
 import ckan.lib.navl.dictization_functions
+from ckan.lib.jobs import get_queue
 from ckan.logic import side_effect_free
 import ckan.plugins as p
 from ckan.plugins.toolkit import config, enqueue_job, get_or_bust
@@ -15,7 +16,7 @@ from dateutil.parser import isoparse as parse_iso_date
 
 import ckanext.xloader.schema
 
-from . import interfaces as xloader_interfaces, jobs, db, utils
+from . import interfaces as xloader_interfaces, jobs, db, fair_share, utils
 
 log = logging.getLogger(__name__)
 
@@ -36,9 +37,22 @@ def xloader_submit(context, data_dict):
     :param ignore_hash: If set to True, the xloader will reload the file
         even if it haven't changed. (optional, default: False)
     :type ignore_hash: bool
-
-    Returns ``True`` if the job has been submitted and ``False`` if the job
-    has not been submitted, i.e. when ckanext-xloader is not configured.
+    :param profile: If set to True, the job is run under cProfile and the
+        report is stored with the job as its 'profile_report' metadata.
+        Sysadmins only. (optional, default: False)
+    :type profile: bool
+    :param profile_memory: If set to True, the job is also run under
+        tracemalloc, and the top allocation sites are stored as its
+        'memory_profile_report' metadata. Sysadmins only. (optional,
+        default: False)
+    :type profile_memory: bool
+
+    A submit while the resource's job is queued is folded into that job,
+    and one while it is running makes it load again once after it finishes.
+
+    Returns ``True`` if the job has been submitted (or the follow-up load
+    requested) and ``False`` if the job has not been submitted, i.e. when
+    ckanext-xloader is not configured or the resource's job is queued.
 
     :rtype: bool
     '''
@@ -64,7 +78,12 @@ def xloader_submit(context, data_dict):
     except p.toolkit.ObjectNotFound:
         return False
     package_id = resource_dict.get('package_id')
-    custom_queue = data_dict.pop('queue', jobs.get_default_queue_name(package_id))
+    large_file = False
+    if 'queue' in data_dict:
+        custom_queue = data_dict.pop('queue')
+    else:
+        large_file = jobs.is_large_file(resource_dict)
+        custom_queue = jobs.get_default_queue_name(package_id, large_file=large_file)
 
     for plugin in p.PluginImplementations(xloader_interfaces.IXloader):
         upload = plugin.can_upload(res_id)
@@ -91,41 +110,12 @@ def xloader_submit(context, data_dict):
             'task_type': 'xloader',
             'key': 'xloader'
         })
-        assume_task_stale_after = datetime.timedelta(seconds=int(
-            config.get('ckanext.xloader.assume_task_stale_after', 3600)))
-        assume_task_stillborn_after = \
-            datetime.timedelta(seconds=int(
-                config.get('ckanext.xloader.assume_task_stillborn_after', 5)))
-        if existing_task.get('state') == 'pending':
-            import re  # here because it takes a moment to load
-            queued_res_ids = [
-                re.search(r"'resource_id': u?'([^']+)'",
-                          job.description).groups()[0]
-                for job in get_queue().get_jobs()
-                if 'xloader_to_datastore' in str(job)  # filter out test_job etc
-            ]
-            updated = parse_iso_date(existing_task['last_updated'])
-            time_since_last_updated = datetime.datetime.utcnow() - updated
-            if (res_id not in queued_res_ids
-                    and time_since_last_updated > assume_task_stillborn_after):
-                # it's not on the queue (and if it had just been started then
-                # its taken too long to update the task_status from pending -
-                # the first thing it should do in the xloader job).
-                # Let it be restarted.
-                log.info('A pending task was found %r, but its not found in '
-                         'the queue %r and is %s hours old',
-                         existing_task['id'], queued_res_ids,
-                         time_since_last_updated)
-            elif time_since_last_updated > assume_task_stale_after:
-                # it's been a while since the job was last updated - it's more
-                # likely something went wrong with it and the state wasn't
-                # updated than its still in progress. Let it be restarted.
-                log.info('A pending task was found %r, but it is only %s hours'
-                         ' old', existing_task['id'], time_since_last_updated)
-            else:
-                log.info('A pending task was found %s for this resource, so '
-                         'skipping this duplicate task', existing_task['id'])
-                return False
+        outcome = _existing_task_outcome(
+            existing_task, res_id, data_dict.get('ignore_hash', False))
+        if outcome == 'follow_up':
+            return True
+        elif outcome == 'queued':
+            return False
 
         task['id'] = existing_task['id']
     except p.toolkit.ObjectNotFound:
@@ -137,43 +127,27 @@ def xloader_submit(context, data_dict):
         {'session': model.meta.create_local_session(), 'ignore_auth': True},
         task
     )
+    utils.invalidate_cached_status(res_id)
 
-    callback_url = p.toolkit.url_for(
-        "api.action",
-        ver=3,
-        logic_function="xloader_hook",
-        qualified=True
-    )
-    data = {
-        'api_key': api_key,
-        'job_type': 'xloader_to_datastore',
-        'result_url': callback_url,
-        'metadata': {
-            'ignore_hash': data_dict.get('ignore_hash', False),
-            'ckan_url': config['ckan.site_url'],
-            'resource_id': res_id,
-            'set_url_type': data_dict.get('set_url_type', False),
-            'task_created': task['last_updated'],
-            'original_url': resource_dict.get('url'),
-            'queue_name': custom_queue,
-        }
-    }
-    if custom_queue not in jobs.default_queue_names:
-        # Don't automatically retry if it's a custom run
-        data['metadata']['tries'] = jobs.max_retries
-
-    # Expand timeout for resources that have to be type-guessed
-    timeout = config.get(
-        'ckanext.xloader.job_timeout',
-        '3600' if utils.datastore_resource_exists(res_id) else '10800')
+    data = _job_data(api_key, resource_dict, data_dict, custom_queue, large_file,
+                     task['last_updated'])
+    timeout = _job_timeout(res_id, large_file, utils.datastore_resource_exists)
     log.debug("Timeout for XLoading resource %s is %s", res_id, timeout)
 
+    title = "xloader_submit: package: {} resource: {}".format(package_id, res_id)
     try:
-        job = enqueue_job(
-            jobs.xloader_data_into_datastore, [data], queue=custom_queue,
-            title="xloader_submit: package: {} resource: {}".format(package_id, res_id),
-            rq_kwargs=dict(timeout=timeout, at_front=sync)
-        )
+        if jobs.fair_share_enabled and not sync:
+            org = _organization_name(model, package_id)
+            data['metadata']['fair_share_org'] = org
+            job = fair_share.submit(
+                jobs.xloader_data_into_datastore, [data], custom_queue, title, org,
+                timeout=timeout)
+        else:
+            job = enqueue_job(
+                jobs.xloader_data_into_datastore, [data], queue=custom_queue,
+                title=title,
+                rq_kwargs=dict(timeout=timeout, at_front=sync)
+            )
     except Exception:
         if sync:
             log.exception('Unable to xloader res_id=%s', res_id)
@@ -181,6 +155,7 @@ def xloader_submit(context, data_dict):
             log.exception('Unable to enqueue xloader res_id=%s', res_id)
         return False
     log.debug('Enqueued xloader job=%s res_id=%s', job.id, res_id)
+    utils.set_active_job(res_id, job.id)
     value = json.dumps({'job_id': job.id})
 
     if sync:
@@ -194,10 +169,304 @@ def xloader_submit(context, data_dict):
         {'session': model.meta.create_local_session(), 'ignore_auth': True},
         task
     )
+    utils.invalidate_cached_status(res_id)
 
     return True
 
 
+def xloader_submit_many(context, data_dict):
+    ''' Submit the jobs of many resources at once, e.g. to reload a whole
+    catalogue. Like calling xloader_submit for each resource, but the
+    resources and their tasks are read with one query each, the tasks are
+    written in one transaction and the jobs are put on the queues with one
+    Redis pipeline per queue.
+
+    :param resource_ids: The ids of the resources to be loaded.
+    :type resource_ids: list of strings
+    :param set_url_type: see xloader_submit (optional, default: False)
+    :type set_url_type: bool
+    :param ignore_hash: see xloader_submit (optional, default: False)
+    :type ignore_hash: bool
+    :param queue: The queue to put all the jobs on, rather than each one's
+        default queue. Sysadmins only. (optional)
+    :type queue: string
+    :param profile: see xloader_submit (optional, default: False)
+    :type profile: bool
+    :param profile_memory: see xloader_submit (optional, default: False)
+    :type profile_memory: bool
+
+    :returns: the outcome for each resource, by resource id: 'submitted',
+        'queued' (folded into its queued job), 'follow_up' (loaded again
+        after its running job), 'not_found', 'rejected' (by an IXloader
+        plugin) or 'error' (the job could not be queued)
+    :rtype: dict
+    '''
+    data_dict, errors = _validate(
+        data_dict, ckanext.xloader.schema.xloader_submit_many_schema(), context)
+    if errors:
+        raise p.toolkit.ValidationError(errors)
+
+    p.toolkit.check_access('xloader_submit_many', context, data_dict)
+    api_key = utils.get_xloader_user_apitoken()
+    ignore_hash = data_dict.get('ignore_hash', False)
+    custom_queue = data_dict.get('queue')
+
+    resource_ids = list(dict.fromkeys(data_dict['resource_ids']))
+    outcomes = dict.fromkeys(resource_ids, 'not_found')
+    if not resource_ids:
+        return outcomes
+
+    model = context['model']
+    session = model.meta.create_local_session()
+    rows = session.query(model.Resource, model.Group.name) \
+        .join(model.Package, model.Package.id == model.Resource.package_id) \
+        .outerjoin(model.Group, model.Group.id == model.Package.owner_org) \
+        .filter(model.Resource.id.in_(resource_ids),
+                model.Resource.state == 'active',
+                model.Package.state == 'active') \
+        .all()
+    tasks = {
+        task.entity_id: task for task in session.query(model.TaskStatus).filter(
+            model.TaskStatus.entity_id.in_(resource_ids),
+            model.TaskStatus.task_type == 'xloader',
+            model.TaskStatus.key == 'xloader',
+        )
+    }
+    plugins = list(p.PluginImplementations(xloader_interfaces.IXloader))
+
+    now = datetime.datetime.utcnow()
+    submissions = []
+    for resource, org in rows:
+        res_id = resource.id
+        rejected_by = next(
+            (plugin for plugin in plugins if not plugin.can_upload(res_id)), None)
+        if rejected_by is not None:
+            log.info("Plugin %s rejected resource %s",
+                     rejected_by.__class__.__name__, res_id)
+            outcomes[res_id] = 'rejected'
+            continue
+
+        task = tasks.get(res_id)
+        # rather than a datastore query per resource
+        loaded_before = task is not None and task.state == 'complete'
+        if task is not None:
+            outcome = _existing_task_outcome(
+                {'id': task.id, 'state': task.state, 'last_updated': task.last_updated},
+                res_id, ignore_hash)
+            if outcome:
+                outcomes[res_id] = outcome
+                continue
+        else:
+            task = model.TaskStatus(
+                entity_id=res_id, entity_type='resource', task_type='xloader',
+                key='xloader')
+            session.add(task)
+
+        # uploads only get their full URL from resource_show; the job
+        # records it when it starts
+        resource_dict = {'id': res_id, 'size': resource.size, 'format': resource.format,
+                         'url': None if resource.url_type else resource.url,
+                         'url_type': resource.url_type}
+        large_file = False
+        if custom_queue:
+            queue = custom_queue
+        else:
+            # a HEAD request per resource would hold up the request for long
+            large_file = jobs.is_large_file(resource_dict, head_request=False)
+            queue = jobs.get_default_queue_name(resource.package_id, large_file=large_file)
+        job_id = str(uuid.uuid4())
+        data = _job_data(api_key, resource_dict, data_dict, queue, large_file, str(now))
+        if jobs.fair_share_enabled:
+            data['metadata']['fair_share_org'] = org or fair_share.NO_ORGANIZATION
+        task.state = 'pending'
+        task.value = json.dumps({'job_id': job_id})
+        task.error = '{}'
+        task.last_updated = now
+        submissions.append({
+            'resource_id': res_id,
+            'job_id': job_id,
+            'args': [data],
+            'queue': queue,
+            'title': "xloader_submit: package: {} resource: {}".format(
+                resource.package_id, res_id),
+            'org': data['metadata'].get('fair_share_org'),
+            'timeout': _job_timeout(res_id, large_file, lambda _res_id: loaded_before),
+        })
+
+    # the tasks are pending before their jobs can start, and update them
+    session.commit()
+    utils.invalidate_cached_statuses([s['resource_id'] for s in submissions])
+
+    failed = _enqueue_many(submissions)
+    for submission in submissions:
+        outcomes[submission['resource_id']] = \
+            'error' if submission['job_id'] in failed else 'submitted'
+    utils.set_active_jobs({
+        s['resource_id']: s['job_id'] for s in submissions if s['job_id'] not in failed})
+    if failed:
+        for task in session.query(model.TaskStatus).filter(
+                model.TaskStatus.entity_id.in_(
+                    [s['resource_id'] for s in submissions if s['job_id'] in failed]),
+                model.TaskStatus.task_type == 'xloader',
+                model.TaskStatus.key == 'xloader'):
+            task.state = 'error'
+            task.error = json.dumps({'message': 'The job could not be queued'})
+            task.last_updated = datetime.datetime.utcnow()
+        session.commit()
+        utils.invalidate_cached_statuses(
+            [s['resource_id'] for s in submissions if s['job_id'] in failed])
+    session.close()
+    log.info('Submitted %s of %s resources to xloader',
+             len(submissions) - len(failed), len(resource_ids))
+    return outcomes
+
+
+def _enqueue_many(submissions):
+    ''' Puts the jobs on their queues, with one Redis pipeline per queue (or
+    via fair_share). Returns the ids of the jobs that could not be queued.
+    '''
+    from rq import Queue
+
+    if jobs.fair_share_enabled:
+        try:
+            fair_share.submit_many(jobs.xloader_data_into_datastore, submissions)
+        except Exception:
+            log.exception('Unable to submit %s xloader jobs', len(submissions))
+            return {s['job_id'] for s in submissions}
+        return set()
+
+    by_queue = {}
+    for submission in submissions:
+        by_queue.setdefault(submission['queue'], []).append(submission)
+    failed = set()
+    for queue_name, queued in by_queue.items():
+        try:
+            get_queue(queue_name).enqueue_many([
+                Queue.prepare_data(
+                    jobs.xloader_data_into_datastore, args=s['args'],
+                    timeout=s['timeout'], job_id=s['job_id'],
+                    meta={'title': s['title']})
+                for s in queued])
+        except Exception:
+            log.exception('Unable to enqueue %s xloader jobs on queue "%s"',
+                          len(queued), queue_name)
+            failed.update(s['job_id'] for s in queued)
+        else:
+            log.debug('Enqueued %s xloader jobs on queue "%s"', len(queued), queue_name)
+    return failed
+
+
+def _existing_task_outcome(existing_task, res_id, ignore_hash=False):
+    ''' Returns what to do about a submit of a resource that has a task
+    already: 'queued' if its job is queued, so the submit is folded into it,
+    'follow_up' if its job is running, so a follow-up load is requested, or
+    None to queue a job (e.g. because the task is finished or stale).
+    '''
+    assume_task_stale_after = datetime.timedelta(seconds=int(
+        config.get('ckanext.xloader.assume_task_stale_after', 3600)))
+    assume_task_stillborn_after = \
+        datetime.timedelta(seconds=int(
+            config.get('ckanext.xloader.assume_task_stillborn_after', 5)))
+    updated = existing_task['last_updated']
+    if not isinstance(updated, datetime.datetime):
+        updated = parse_iso_date(updated)
+    time_since_last_updated = datetime.datetime.utcnow() - updated
+    if existing_task.get('state') in ('running', 'running_but_viewable'):
+        if time_since_last_updated > assume_task_stale_after:
+            log.info('A running task was found %r, but it is %s hours '
+                     'old', existing_task['id'], time_since_last_updated)
+        else:
+            # the running load may have read the resource before this
+            # change, so load it once more when it finishes (xloader_hook)
+            utils.request_follow_up(
+                res_id, ignore_hash=ignore_hash,
+                ttl=int(assume_task_stale_after.total_seconds()))
+            log.info('A running task was found %s for this resource, so '
+                     'it will be loaded again after that',
+                     existing_task['id'])
+            return 'follow_up'
+    if existing_task.get('state') == 'pending':
+        active_job = utils.get_active_job(res_id)
+        if (active_job is None
+                and time_since_last_updated > assume_task_stillborn_after):
+            # it's not on a queue (and if it had just been started then
+            # its taken too long to update the task_status from pending -
+            # the first thing it should do in the xloader job).
+            # Let it be restarted.
+            log.info('A pending task was found %r, but its job is not '
+                     'queued and it is %s hours old',
+                     existing_task['id'], time_since_last_updated)
+        elif time_since_last_updated > assume_task_stale_after:
+            # it's been a while since the job was last updated - it's more
+            # likely something went wrong with it and the state wasn't
+            # updated than its still in progress. Let it be restarted.
+            log.info('A pending task was found %r, but it is only %s hours'
+                     ' old', existing_task['id'], time_since_last_updated)
+        else:
+            log.info('A pending task was found %s for this resource, so '
+                     'skipping this duplicate task', existing_task['id'])
+            if active_job is not None:
+                utils.coalesce_into_job(active_job, ignore_hash=ignore_hash)
+            return 'queued'
+    return None
+
+
+def _job_data(api_key, resource_dict, data_dict, queue, large_file, task_created):
+    ''' Returns the input of the xloader job of a resource. '''
+    res_id = resource_dict['id']
+    callback_url = p.toolkit.url_for(
+        "api.action",
+        ver=3,
+        logic_function="xloader_hook",
+        qualified=True
+    )
+    data = {
+        'api_key': api_key,
+        'job_type': 'xloader_to_datastore',
+        'result_url': callback_url,
+        'metadata': {
+            'ignore_hash': data_dict.get('ignore_hash', False),
+            'ckan_url': config['ckan.site_url'],
+            'resource_id': res_id,
+            'set_url_type': data_dict.get('set_url_type', False),
+            'task_created': task_created,
+            'original_url': resource_dict.get('url'),
+            'queue_name': queue,
+            # for the xloader worker to estimate the job's memory and disk use
+            'resource_size': resource_dict.get('size'),
+            'resource_format': resource_dict.get('format'),
+        }
+    }
+    if large_file:
+        data['metadata']['large_file'] = True
+    elif queue not in jobs.default_queue_names:
+        # Don't automatically retry if it's a custom run
+        data['metadata']['tries'] = jobs.max_retries
+    for option in ('profile', 'profile_memory'):
+        if data_dict.get(option):
+            data['metadata'][option] = True
+    return data
+
+
+def _job_timeout(res_id, large_file, datastore_resource_exists):
+    if large_file:
+        return jobs.large_file_job_timeout
+    timeout = config.get('ckanext.xloader.job_timeout')
+    if timeout:
+        return timeout
+    if jobs.large_file_size:
+        # the files that could take hours are in the large file lane
+        return '3600'
+    # Expand timeout for resources that have to be type-guessed
+    return '3600' if datastore_resource_exists(res_id) else '10800'
+
+
+def _organization_name(model, package_id):
+    package = model.Package.get(package_id)
+    organization = model.Group.get(package.owner_org) if package and package.owner_org else None
+    return organization.name if organization else fair_share.NO_ORGANIZATION
+
+
 def xloader_hook(context, data_dict):
     ''' Update xloader task. This action is typically called by ckanext-xloader
     whenever the status of a job changes.
@@ -292,12 +561,81 @@ def xloader_hook(context, data_dict):
 
     context['ignore_auth'] = True
     p.toolkit.get_action('task_status_update')(context, task)
+    utils.invalidate_cached_status(res_id)
+
+    follow_up = None
+    if status in ('complete', 'error'):
+        # the resource was submitted again while this job was running. (Any
+        # later submit sees the finished task and queues a job itself.)
+        follow_up = utils.pop_follow_up(res_id)
+        resubmit = resubmit or follow_up is not None
 
     if resubmit:
         log.debug('Resource %s has been modified, '
                   'resubmitting to DataPusher', res_id)
         p.toolkit.get_action('xloader_submit')(
-            context, {'resource_id': res_id})
+            context, {'resource_id': res_id,
+                      'ignore_hash': bool(follow_up and follow_up.get('ignore_hash'))})
+
+
+@side_effect_free
+def xloader_status_bulk(context, data_dict):
+    ''' Get the status of the ckanext-xloader jobs of several resources at
+    once. Unlike xloader_status, the job logs are not included.
+
+    :param resource_ids: The ids of the resources that you want the status
+        for.
+    :type resource_ids: list of strings
+
+    :returns: the status of each resource that has been submitted, by
+        resource id, with the same keys as xloader_status. Resources that
+        don't exist or have been deleted are left out.
+    :rtype: dict
+    '''
+    data_dict, errors = _validate(data_dict, ckanext.xloader.schema.xloader_status_bulk_schema(), context)
+    if errors:
+        raise p.toolkit.ValidationError(errors)
+    resource_ids = data_dict['resource_ids']
+
+    p.toolkit.check_access('xloader_status_bulk', context, data_dict)
+
+    model = context['model']
+    tasks = model.Session.query(model.TaskStatus).join(
+        model.Resource, model.Resource.id == model.TaskStatus.entity_id,
+    ).filter(
+        model.TaskStatus.entity_id.in_(resource_ids),
+        model.TaskStatus.task_type == 'xloader',
+        model.TaskStatus.key == 'xloader',
+        model.Resource.state == 'active',
+    ).all()
+
+    job_ids = {}
+    for task in tasks:
+        try:
+            job_ids[task.entity_id] = json.loads(task.value).get('job_id')
+        except ValueError:
+            job_ids[task.entity_id] = None
+    jobs_by_id = {}
+    if any(job_ids.values()):
+        db.init(config)
+        jobs_by_id = db.get_jobs(job_ids.values())
+
+    statuses = {}
+    for task in tasks:
+        try:
+            error = json.loads(task.error)
+        except (TypeError, ValueError):
+            error = task.error
+        job_id = job_ids[task.entity_id]
+        statuses[task.entity_id] = {
+            'status': task.state,
+            'job_id': job_id,
+            'job_url': None,
+            'last_updated': task.last_updated.isoformat() if task.last_updated else None,
+            'task_info': jobs_by_id.get(job_id),
+            'error': error,
+        }
+    return statuses
 
 
 @side_effect_free
@@ -307,13 +645,31 @@ def xloader_status(context, data_dict):
     :param resource_id: The resource id of the resource that you want the
         status for.
     :type resource_id: string
+    :param logs_limit: The maximum number of log lines to return (optional,
+        all by default).
+    :type logs_limit: int
+    :param logs_offset: The number of log lines to skip (optional). If
+        negative, counts back from the newest line, so -50 returns the newest
+        50 lines.
+    :type logs_offset: int
+    :param logs_since: Only return log lines after this ISO format timestamp
+        (optional).
+    :type logs_since: string
+
+    The result includes the timings of the stages of the job, once it has
+    finished, as "stages": a list of dicts, each with a "name" (e.g.
+    "download", "copy", "fulltext"), "seconds", and where relevant "bytes",
+    "rows", and "failed" if the stage raised an error.
     '''
 
     p.toolkit.check_access('xloader_status', context, data_dict)
 
     if 'id' in data_dict:
         data_dict['resource_id'] = data_dict['id']
-    res_id = get_or_bust(data_dict, 'resource_id')
+    data_dict, errors = _validate(data_dict, ckanext.xloader.schema.xloader_status_schema(), context)
+    if errors:
+        raise p.toolkit.ValidationError(errors)
+    res_id = data_dict['resource_id']
 
     task = p.toolkit.get_action('task_status_show')(context, {
         'entity_id': res_id,
@@ -329,12 +685,11 @@ def xloader_status(context, data_dict):
     if job_id:
         # get logs from the xloader db
         db.init(config)
-        job_detail = db.get_job(job_id)
-
-        if job_detail and job_detail.get('logs'):
-            for log in job_detail['logs']:
-                if 'timestamp' in log and isinstance(log['timestamp'], datetime.datetime):
-                    log['timestamp'] = log['timestamp'].isoformat()
+        job_detail = db.get_job(
+            job_id,
+            logs_limit=data_dict.get('logs_limit'),
+            logs_offset=data_dict.get('logs_offset', 0),
+            logs_since=data_dict.get('logs_since'))
     try:
         error = json.loads(task['error'])
     except ValueError:
@@ -347,4 +702,5 @@ def xloader_status(context, data_dict):
         'last_updated': task['last_updated'],
         'task_info': job_detail,
         'error': error,
+        'stages': job_detail['metadata'].get('stages') if job_detail else None,
     }
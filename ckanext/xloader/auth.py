@@ -1,4 +1,5 @@
 from ckan import authz
+from ckan.plugins import toolkit
 
 from .jobs import default_queue_names
 
@@ -13,5 +14,37 @@ def xloader_submit(context, data_dict):
     return auth.datastore_auth(context, data_dict)
 
 
+def xloader_submit_many(context, data_dict):
+    custom_queue = data_dict.get('queue')
+    if custom_queue and custom_queue not in default_queue_names:
+        return authz.is_authorized('config_option_update', context, data_dict)
+    for resource_id in data_dict.get('resource_ids', []):
+        try:
+            result = auth.datastore_auth(context, {'resource_id': resource_id})
+        except toolkit.ObjectNotFound:
+            # reported as 'not_found' by the action
+            continue
+        if not result.get('success'):
+            return result
+    return {'success': True}
+
+
 def xloader_status(context, data_dict):
     return auth.datastore_auth(context, data_dict)
+
+
+def xloader_metrics(context, data_dict):
+    # sysadmins only, unless ckanext.xloader.metrics_token is given
+    return {'success': False}
+
+
+def xloader_status_bulk(context, data_dict):
+    for resource_id in data_dict.get('resource_ids', []):
+        try:
+            result = auth.datastore_auth(context, {'resource_id': resource_id})
+        except toolkit.ObjectNotFound:
+            # left out of the statuses by the action
+            continue
+        if not result.get('success'):
+            return result
+    return {'success': True}
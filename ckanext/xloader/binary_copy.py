@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''Encodes typed rows in PostgreSQL's binary COPY format, so that numbers and
+timestamps that have already been parsed don't have to be written out as text
+and parsed again by PostgreSQL.
+
+See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+'''
+import datetime
+from decimal import Decimal
+import struct
+
+import six
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+HEADER = SIGNATURE + struct.pack('!ii', 0, 0)  # flags, header extension length
+TRAILER = struct.pack('!h', -1)
+NULL = struct.pack('!i', -1)
+
+# Same as load_table: these types can't store an empty string, so it is
+# loaded as NULL
+NON_EMPTY_TYPES = ('timestamp', 'numeric')
+
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+NUMERIC_NAN = 0xC000
+NUMERIC_PINF = 0xD000
+NUMERIC_NINF = 0xF000
+
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
+
+_int16 = struct.Struct('!h')
+_int32 = struct.Struct('!i')
+_int64 = struct.Struct('!q')
+_numeric_header = struct.Struct('!hhHh')  # ndigits, weight, sign, dscale
+
+
+def encode_numeric(value):
+    '''Returns the binary representation of a number as a PostgreSQL numeric:
+    base 10000 digits, most significant first, and the weight (power of
+    10000) of the first one.
+    '''
+    if not isinstance(value, Decimal):
+        if isinstance(value, float):
+            # the shortest repr, as JSON (and so datastore_create) would send
+            value = repr(value)
+        value = Decimal(value)
+    if value.is_nan():
+        return _numeric_header.pack(0, 0, NUMERIC_NAN, 0)
+    if value.is_infinite():
+        return _numeric_header.pack(0, 0, NUMERIC_NINF if value.is_signed() else NUMERIC_PINF, 0)
+
+    sign, digits, exponent = value.as_tuple()
+    dscale = max(0, -exponent)
+    digits = list(digits)
+    # Align the digits to groups of four either side of the decimal point
+    padding = exponent % 4
+    digits.extend([0] * padding)
+    exponent -= padding
+    digits[:0] = [0] * (-len(digits) % 4)
+    groups = [digits[i] * 1000 + digits[i + 1] * 100 + digits[i + 2] * 10 + digits[i + 3]
+              for i in range(0, len(digits), 4)]
+    weight = exponent // 4 + len(groups) - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        return _numeric_header.pack(0, 0, NUMERIC_POS, dscale)
+    return _numeric_header.pack(len(groups), weight, NUMERIC_NEG if sign else NUMERIC_POS, dscale) \
+        + struct.pack('!{}h'.format(len(groups)), *groups)
+
+
+def encode_timestamp(value):
+    '''Returns the binary representation of a datetime as a PostgreSQL
+    timestamp (without time zone): microseconds since 2000-01-01.
+
+    A datetime with a time zone is converted to UTC, as datastore_create
+    stores it.
+    '''
+    if not isinstance(value, datetime.datetime):
+        if not isinstance(value, datetime.date):
+            raise ValueError('Not a timestamp: {!r}'.format(value))
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.utcoffset() is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    delta = value - POSTGRES_EPOCH
+    return _int64.pack((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def encode_text(value):
+    '''Returns a value as UTF-8 text, written as datastore_create would
+    store it, e.g. ``true`` for True.
+    '''
+    if isinstance(value, six.binary_type):
+        return value
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    return six.text_type(value).encode('utf-8')
+
+
+ENCODERS = {
+    'numeric': encode_numeric,
+    'timestamp': encode_timestamp,
+    'text': encode_text,
+}
+
+
+def encode_row(row, types):
+    '''Returns a row as a binary COPY tuple. ``types`` are the datastore
+    column types, in the same order as the cells.
+    '''
+    parts = [_int16.pack(len(types))]
+    for cell, type_ in zip(row, types):
+        if cell is None or (cell == '' and type_ in NON_EMPTY_TYPES):
+            parts.append(NULL)
+            continue
+        data = ENCODERS[type_](cell)
+        parts.append(_int32.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+class BinaryCopyStream(object):
+    '''A file-like object to pass to psycopg2's ``copy_expert`` for a
+    ``COPY ... FROM STDIN (FORMAT binary)``. It encodes the rows only as they
+    are read, so the whole table is never held in memory.
+
+    psycopg2 reports an exception raised by read() as a cancelled COPY, so
+    an error encoding a row is also kept in ``error``.
+    '''
+
+    def __init__(self, rows, types):
+        self.rows = iter(rows)
+        self.types = list(types)
+        self.error = None
+        self._buffer = bytearray(HEADER)
+        self._finished = False
+
+    def read(self, size=-1):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            row = next(self.rows, None)
+            if row is None:
+                self._buffer += TRAILER
+                self._finished = True
+                break
+            try:
+                self._buffer += encode_row(row, self.types)
+            except (ArithmeticError, TypeError, ValueError) as e:
+                self.error = e
+                raise
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
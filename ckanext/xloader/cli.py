@@ -29,11 +29,19 @@ def status():
 @click.option('--queue', help='Queue name for asynchronous processing, unused if executing immediately')
 @click.option('--sync', is_flag=True, default=False,
               help='Execute immediately instead of enqueueing for asynchronous processing')
-def submit(dataset_spec, y, dry_run, queue, sync):
+@click.option('--profile', is_flag=True, default=False,
+              help='Run the jobs under cProfile (see the profile command)')
+@click.option('--profile-memory', is_flag=True, default=False,
+              help='Also trace the memory allocations of the jobs')
+@click.option('--concurrency', type=int, default=4, show_default=True,
+              help='Number of batches of resources looked up and submitted at once, '
+                   'for "all" and "all-existing" (unused with --sync)')
+def submit(dataset_spec, y, dry_run, queue, sync, profile, profile_memory, concurrency):
     """
         xloader submit [options] <dataset-spec>
     """
-    cmd = XloaderCmd(dry_run)
+    cmd = XloaderCmd(dry_run, profile=profile, profile_memory=profile_memory,
+                     concurrency=concurrency)
 
     if dataset_spec == 'all':
         cmd._setup_xloader_logger()
@@ -52,6 +60,114 @@ def submit(dataset_spec, y, dry_run, queue, sync):
         sys.exit(1)
 
 
+@xloader.command()
+@click.argument('job-or-resource-id')
+def profile(job_or_resource_id):
+    """Shows the profile of a job submitted with --profile
+
+    Given a resource id, shows that of its latest job.
+    """
+    from ckan.plugins.toolkit import config, get_action, ObjectNotFound
+    from ckanext.xloader import db
+
+    db.init(config)
+    job = db.get_job(job_or_resource_id, logs_limit=0)
+    if not job:
+        try:
+            status = get_action('xloader_status')(
+                {'ignore_auth': True}, {'resource_id': job_or_resource_id, 'logs_limit': 0})
+        except ObjectNotFound:
+            status = {}
+        job = status.get('task_info')
+    if not job:
+        print('No job found for {}'.format(job_or_resource_id))
+        sys.exit(1)
+
+    reports = [job['metadata'].get(key) for key in ('profile_report', 'memory_profile_report')]
+    if not any(reports):
+        print('Job {} was not profiled'.format(job['job_id']))
+        sys.exit(1)
+    for report in reports:
+        if report:
+            print(report)
+
+
+@xloader.command('fair-share')
+@click.option('--dispatch', is_flag=True, default=False,
+              help='Top up the queues from the waiting jobs first')
+def fair_share_(dispatch):
+    """Shows the jobs waiting under fair-share scheduling, by organization
+    """
+    from ckanext.xloader import fair_share
+
+    dispatcher = fair_share.get_dispatcher()
+    if dispatch:
+        for queue_name, org, job_id in fair_share.dispatch(dispatcher):
+            print('Dispatched job {} of {} to queue "{}"'.format(job_id, org, queue_name))
+    active = dispatcher.active()
+    for queue_name, waiting in dispatcher.waiting().items():
+        print('Queue "{}":'.format(queue_name))
+        for org, count in waiting.items():
+            print('  {}: {} waiting, {} queued or running'.format(org, count, active.get(org, 0)))
+    if not dispatcher.waiting():
+        print('No jobs waiting')
+
+
+@xloader.command()
+@click.argument('queues', nargs=-1)
+@click.option('--slots', type=int, help='The number of jobs to run at once '
+              '(default: ckanext.xloader.worker.slots)')
+@click.option('--burst', is_flag=True, default=False, help='Stop once the queues are empty')
+def worker(queues, slots, burst):
+    """Runs several xloader jobs at once, within a memory and disk budget
+
+    Takes jobs from the given queues, or by default from the xloader queues.
+    """
+    from ckanext.xloader.worker import get_pool
+
+    get_pool(list(queues), slots=slots).run(burst=burst)
+
+
+@xloader.command('init-db')
+def init_db():
+    """Creates the jobs database tables and indexes, if they don't exist yet
+    """
+    from ckan.plugins.toolkit import config
+    from ckanext.xloader import db
+
+    db.init(config, create_tables=True)
+    db.create_indexes()
+    print('XLoader jobs database tables are ready')
+
+
+@xloader.command()
+@click.option('--keep-jobs', type=int, default=None,
+              help='Number of most recent jobs to keep per resource (0 keeps all)')
+@click.option('--keep-logs-days', type=int, default=None,
+              help='Delete logs older than this many days (0 keeps all)')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of jobs to delete, or whose logs to delete, per transaction')
+def purge(keep_jobs, keep_logs_days, batch_size):
+    """Deletes old jobs and logs from the jobs database
+
+    The defaults are the ckanext.xloader.jobs_db.keep_* config options.
+    """
+    from ckan.plugins.toolkit import config
+    from ckanext.xloader import db
+
+    db.init(config)
+    options = db.get_retention_options(config)
+    if keep_jobs is not None:
+        options['keep_jobs_per_resource'] = keep_jobs
+    if keep_logs_days is not None:
+        options['keep_logs_days'] = keep_logs_days
+    if batch_size is not None:
+        options['batch_size'] = batch_size
+    counts = db.purge(**options)
+    print('Deleted {jobs} jobs and {logs} log records, and dropped {partitions} '
+          'logs partitions'.format(**counts))
+
+
 def get_commands():
     return [xloader]
 
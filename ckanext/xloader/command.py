@@ -2,15 +2,26 @@
 
 import sys
 import logging
+import datetime
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import ckan.plugins.toolkit as tk
 
+from ckanext.xloader import profiling
 from ckanext.xloader.jobs import xloader_data_into_datastore_
 from ckanext.xloader.utils import XLoaderFormats, get_xloader_user_apitoken
 
+# Datasets fetched per package_search, and resources per xloader_submit_many
+BATCH_SIZE = 1000
+
 
 class XloaderCmd:
-    def __init__(self, dry_run=False):
+    def __init__(self, dry_run=False, profile=False, profile_memory=False, concurrency=1):
         self.dry_run = dry_run
+        self.profile = profile
+        self.profile_memory = profile_memory
+        self.concurrency = max(1, concurrency)
         self.error_occured = False
 
     def _setup_xloader_logger(self):
@@ -32,28 +43,177 @@ class XloaderCmd:
         print('Processing %d resources' % len(resource_ids))
         user = tk.get_action('get_site_user')(
             {'ignore_auth': True}, {})
-        for resource_id in resource_ids:
-            try:
-                resource_dict = tk.get_action('resource_show')(
-                    {'ignore_auth': True}, {'id': resource_id})
-            except tk.ObjectNotFound:
-                print('  Skipping resource {} found in datastore but not in '
-                      'metadata'.format(resource_id))
-                continue
-            self._submit_resource(resource_dict, user, indent=2, sync=sync, queue=queue)
+        batches = (resource_ids[start:start + BATCH_SIZE]
+                   for start in range(0, len(resource_ids), BATCH_SIZE))
+        if sync:
+            for batch in batches:
+                for resource_dict in self._get_resources(batch, indent=2):
+                    self._submit_resource(resource_dict, user, indent=2, sync=sync, queue=queue)
+            return
+
+        def submit_batch(batch):
+            return len(batch), self._submit_many(
+                self._get_resources(batch, indent=2), user, queue)
+
+        self._run_batches(batches, submit_batch, _Progress(len(resource_ids), 'resources'))
 
     def _submit_all(self, sync=False, queue=None):
-        # submit every package
-        # for each package in the package list,
-        #   submit each resource w/ _submit_package
-        package_list = tk.get_action('package_search')(
-            {'ignore_auth': True}, {'include_private': True, 'rows': 1000})
-        package_list = [pkg['id'] for pkg in package_list['results']]
-        print('Processing %d datasets' % len(package_list))
+        # submit every package, a page of package_search at a time
+        pages = self._iter_package_pages()
+        count, first_page = next(pages, (0, []))
+        print('Processing %d datasets' % count)
         user = tk.get_action('get_site_user')(
             {'ignore_auth': True}, {})
-        for p_id in package_list:
-            self._submit_package(p_id, user, indent=2, sync=sync, queue=queue)
+        pages = itertools.chain([first_page], (page for _count, page in pages))
+        if sync:
+            for page in pages:
+                for pkg in page:
+                    self._submit_package_dict(pkg, user, indent=2, sync=sync, queue=queue)
+            return
+
+        def submit_page(page):
+            resources = []
+            for pkg in page:
+                for resource in pkg['resources']:
+                    resource['package_name'] = pkg['name']  # for debug output
+                    resources.append(resource)
+            return len(page), self._submit_many(resources, user, queue)
+
+        self._run_batches(pages, submit_page, _Progress(count, 'datasets'))
+
+    def _iter_package_pages(self):
+        ''' Yields the number of datasets left and the next page of them,
+        until all the datasets (including private ones) have been seen. The
+        pages follow on by dataset id rather than by offset, so datasets
+        created or deleted meanwhile don't make others be skipped or seen
+        twice, and deep pages are as quick to get as the first.
+        '''
+        last_id = None
+        while True:
+            data_dict = {'include_private': True, 'rows': BATCH_SIZE, 'sort': 'id asc'}
+            if last_id:
+                data_dict['fq'] = 'id:{{"{}" TO *]'.format(last_id)
+            result = tk.get_action('package_search')({'ignore_auth': True}, data_dict)
+            if not result['results']:
+                return
+            yield result['count'], result['results']
+            last_id = result['results'][-1]['id']
+
+    def _get_resources(self, resource_ids, indent=0):
+        ''' Returns the dicts of the resources, with the fields that
+        _submit_resource needs, from one query. '''
+        from ckan import model
+
+        rows = model.Session.query(model.Resource, model.Package.name) \
+            .join(model.Package, model.Package.id == model.Resource.package_id) \
+            .filter(model.Resource.id.in_(resource_ids),
+                    model.Resource.state == 'active') \
+            .all()
+        resources = [{
+            'id': resource.id,
+            'package_id': resource.package_id,
+            'package_name': package_name,
+            'url': resource.url,
+            'url_type': resource.url_type,
+            'format': resource.format,
+        } for resource, package_name in rows]
+        for resource_id in set(resource_ids) - {resource['id'] for resource in resources}:
+            print(' ' * indent + 'Skipping resource {} found in datastore but not in '
+                  'metadata'.format(resource_id))
+        return resources
+
+    def _run_batches(self, batches, submit_batch, progress):
+        ''' Calls submit_batch on each batch, in up to self.concurrency
+        threads at once, and reports the progress. submit_batch returns the
+        number of items of the batch and the outcomes of its resources.
+        Batches are only taken as threads become free, so they can be
+        generated as they go.
+        '''
+        from flask import current_app
+
+        app = current_app._get_current_object()
+        outcomes = {}
+
+        def run(batch):
+            from ckan import model
+
+            # the actions need an app context and their own database session
+            with app.test_request_context():
+                try:
+                    return submit_batch(batch)
+                finally:
+                    model.Session.remove()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            running = set()
+            for batch in batches:
+                running.add(executor.submit(run, batch))
+                if len(running) >= self.concurrency * 2:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    self._batches_done(done, progress, outcomes)
+            self._batches_done(running, progress, outcomes)
+        progress.finish()
+        print('Outcomes: ' + (', '.join(
+            '{} {}'.format(count, outcome) for outcome, count in sorted(outcomes.items()))
+            or 'no resources submitted'))
+
+    def _batches_done(self, futures, progress, outcomes):
+        for future in futures:
+            try:
+                count, batch_outcomes = future.result()
+            except Exception as e:
+                self.error_occured = True
+                progress.clear()
+                print('ERROR submitting a batch of resources: {}'.format(e))
+                continue
+            for resource_id, outcome in batch_outcomes.items():
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                if outcome in ('error', 'not_found', 'rejected'):
+                    progress.clear()
+                    print('  ERROR submitting resource {}: {}'.format(resource_id, outcome))
+                    self.error_occured = self.error_occured or outcome == 'error'
+            progress.update(count)
+
+    def _submit_many(self, resources, user, queue=None):
+        ''' Submits the resources that can be xloadered with one call of
+        xloader_submit_many, and returns their outcomes. '''
+        resource_ids = [resource['id'] for resource in resources
+                        if self._can_submit(resource, indent=2, verbose=self.dry_run)]
+        if self.dry_run:
+            for resource_id in resource_ids:
+                print('  Would submit resource {}'.format(resource_id))
+            return {}
+        if not resource_ids:
+            return {}
+        data_dict = {
+            'resource_ids': resource_ids,
+            'ignore_hash': True,
+        }
+        if queue:
+            data_dict['queue'] = queue
+        if self.profile:
+            data_dict['profile'] = True
+        if self.profile_memory:
+            data_dict['profile_memory'] = True
+        return tk.get_action('xloader_submit_many')({'user': user['name']}, data_dict)
+
+    def _can_submit(self, resource, indent=0, verbose=True):
+        indentation = ' ' * indent
+        if not XLoaderFormats.is_it_an_xloader_format(resource['format']):
+            if verbose:
+                print(indentation
+                      + 'Skipping resource {r[id]} because format "{r[format]}" is '
+                      'not configured to be xloadered'.format(r=resource))
+            return False
+        if resource['url_type'] in ('datapusher', 'xloader'):
+            if verbose:
+                print(indentation
+                      + 'Skipping resource {r[id]} because url_type "{r[url_type]}" '
+                      'means resource.url points to the datastore '
+                      'already, so loading would be circular.'.format(
+                          r=resource))
+            return False
+        return True
 
     def _submit_package(self, pkg_id, user=None, indent=0, sync=False, queue=None):
         indentation = ' ' * indent
@@ -69,7 +229,10 @@ class XloaderCmd:
             print(e)
             print(indentation + 'Dataset "{}" was not found'.format(pkg_id))
             sys.exit(1)
+        self._submit_package_dict(pkg, user, indent=indent, sync=sync, queue=queue)
 
+    def _submit_package_dict(self, pkg, user, indent=0, sync=False, queue=None):
+        indentation = ' ' * indent
         print(indentation + 'Processing dataset {} with {} resources'.format(
               pkg['name'], len(pkg['resources'])))
         for resource in pkg['resources']:
@@ -88,17 +251,7 @@ class XloaderCmd:
         '''
         indentation = ' ' * indent
 
-        if not XLoaderFormats.is_it_an_xloader_format(resource['format']):
-            print(indentation
-                  + 'Skipping resource {r[id]} because format "{r[format]}" is '
-                  'not configured to be xloadered'.format(r=resource))
-            return
-        if resource['url_type'] in ('datapusher', 'xloader'):
-            print(indentation
-                  + 'Skipping resource {r[id]} because url_type "{r[url_type]}" '
-                  'means resource.url points to the datastore '
-                  'already, so loading would be circular.'.format(
-                      r=resource))
+        if not self._can_submit(resource, indent=indent):
             return
         dataset_ref = resource.get('package_name', resource['package_id'])
         print('{indent}{sync_style} /dataset/{dataset}/resource/{r[id]}\n'
@@ -120,10 +273,21 @@ class XloaderCmd:
                 'api_key': get_xloader_user_apitoken()
             }
             logger = logging.getLogger('ckanext.xloader.cli')
-            xloader_data_into_datastore_(input_dict, None, logger)
+            if self.profile or self.profile_memory:
+                with profiling.profiled(memory=self.profile_memory) as reports:
+                    xloader_data_into_datastore_(input_dict, None, logger)
+                print(reports['profile_report'])
+                if self.profile_memory:
+                    print(reports['memory_profile_report'])
+            else:
+                xloader_data_into_datastore_(input_dict, None, logger)
         else:
             if queue:
                 data_dict['queue'] = queue
+            if self.profile:
+                data_dict['profile'] = True
+            if self.profile_memory:
+                data_dict['profile_memory'] = True
             success = tk.get_action('xloader_submit')({'user': user['name']}, data_dict)
             if success:
                 print(indentation + '...ok')
@@ -147,3 +311,45 @@ class XloaderCmd:
                       res_id=job_metadata['resource_id'],
                       url=job_metadata['original_url'],
                   ))
+
+
+class _Progress(object):
+    ''' Shows how many of the items of a bulk submission are done, the rate
+    and the time left, on one line that is rewritten on a terminal. '''
+
+    def __init__(self, total, unit, out=None):
+        self.total = total
+        self.unit = unit
+        self.out = out or sys.stdout
+        self.done = 0
+        self.started = time.time()
+        self.interactive = self.out.isatty()
+        self._shown = False
+
+    def update(self, count):
+        self.done += count
+        elapsed = time.time() - self.started
+        rate = self.done / elapsed if elapsed else 0
+        if rate and self.total > self.done:
+            eta = str(datetime.timedelta(seconds=int((self.total - self.done) / rate)))
+        else:
+            eta = '-'
+        line = '{}/{} {} ({:.0%}), {:.1f}/s, ETA {}'.format(
+            self.done, self.total, self.unit,
+            float(self.done) / self.total if self.total else 1, rate, eta)
+        if self.interactive:
+            self.out.write('\r' + line + '\033[K')
+            self._shown = True
+        else:
+            self.out.write(line + '\n')
+        self.out.flush()
+
+    def clear(self):
+        ''' Ends the progress line, so other output can be printed. '''
+        if self._shown:
+            self.out.write('\n')
+            self.out.flush()
+            self._shown = False
+
+    def finish(self):
+        self.clear()
@@ -7,25 +7,40 @@ Loosely based on ckan-service-provider's db.py
 
 import datetime
 import json
+import os
 
 import six
 import sqlalchemy
+from ckan.plugins.toolkit import asbool
 
 ENGINE = None
 _METADATA = None
 JOBS_TABLE = None
 METADATA_TABLE = None
 LOGS_TABLE = None
+CHECKPOINTS_TABLE = None
 
+# Engines (and so connection pools) by (uri, process id), as a forked worker
+# must not share its parent's connections
+_ENGINES = {}
+# URIs of the databases whose tables have been created, which forked
+# processes inherit
+_TABLES_CREATED = set()
 
-def init(config, echo=False):
+# How many months of logs partitions to create ahead of time
+LOGS_PARTITIONS_AHEAD = 12
+
+
+def init(config, echo=False, create_tables=None):
     """Initialise the database.
 
     Initialise the sqlalchemy engine, metadata and table objects that we use to
-    connect to the database.
+    connect to the database. These are created once per process and database
+    URI, and reused by later calls, so this is cheap to call per request.
 
-    Create the database and the database tables themselves if they don't
-    already exist.
+    Create the database tables themselves if they don't already exist, once
+    per database (in a process and the processes forked from it), unless ckanext.xloader.jobs_db.create_tables is false (in
+    which case they are created by `ckan xloader init-db`).
 
     :param uri: the sqlalchemy database URI
     :type uri: string
@@ -34,16 +49,70 @@ def init(config, echo=False):
         statements to stdout
     :type echo: bool
 
+    :param create_tables: create the tables, overriding the config option
+    :type create_tables: bool
+
     """
-    global ENGINE, _METADATA, JOBS_TABLE, METADATA_TABLE, LOGS_TABLE
+    global ENGINE, _METADATA, JOBS_TABLE, METADATA_TABLE, LOGS_TABLE, CHECKPOINTS_TABLE
     db_uri = config.get('ckanext.xloader.jobs_db.uri',
                         'sqlite:////tmp/xloader_jobs.db')
-    ENGINE = sqlalchemy.create_engine(db_uri, echo=echo)
-    _METADATA = sqlalchemy.MetaData()
-    JOBS_TABLE = _init_jobs_table()
-    METADATA_TABLE = _init_metadata_table()
-    LOGS_TABLE = _init_logs_table()
-    _METADATA.create_all(ENGINE)
+    key = (db_uri, os.getpid())
+    if key not in _ENGINES:
+        _ENGINES[key] = sqlalchemy.create_engine(
+            db_uri, echo=echo, **_engine_options(db_uri, config))
+    ENGINE = _ENGINES[key]
+    if _METADATA is None:
+        _METADATA = sqlalchemy.MetaData()
+        JOBS_TABLE = _init_jobs_table()
+        METADATA_TABLE = _init_metadata_table()
+        LOGS_TABLE = _init_logs_table(
+            partitioned=asbool(config.get('ckanext.xloader.jobs_db.partition_logs', False)))
+        CHECKPOINTS_TABLE = _init_checkpoints_table()
+    if create_tables is None:
+        create_tables = asbool(config.get('ckanext.xloader.jobs_db.create_tables', True))
+    if create_tables and db_uri not in _TABLES_CREATED:
+        _METADATA.create_all(ENGINE)
+        with ENGINE.begin() as conn:
+            _upgrade_logs_table(conn)
+        # indexes that are newer than existing tables are left to
+        # create_indexes, as building them can take a while
+        if _logs_partitioned():
+            with ENGINE.begin() as conn:
+                _create_logs_partitions(conn)
+        _TABLES_CREATED.add(db_uri)
+
+
+def create_indexes():
+    """Create the indexes that are newer than existing tables (which
+    create_all skips), without blocking writes to the tables on PostgreSQL.
+    Run by `ckan xloader init-db`, as on a large table this takes a while.
+    """
+    if ENGINE is None or LOGS_TABLE is None:
+        raise RuntimeError("DB is not initialized")
+
+    for index in LOGS_TABLE.indexes:
+        if ENGINE.dialect.name != 'postgresql':
+            index.create(ENGINE, checkfirst=True)
+        elif not _logs_partitioned():
+            # a partitioned logs table was created with its indexes.
+            # CONCURRENTLY can't run in a transaction.
+            with ENGINE.connect().execution_options(
+                    isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(sqlalchemy.text(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{}" ON "{}" ({})'.format(
+                        index.name, index.table.name,
+                        ', '.join('"{}"'.format(column.name) for column in index.columns))))
+
+
+def _engine_options(db_uri, config):
+    options = {
+        'pool_pre_ping': asbool(config.get('ckanext.xloader.jobs_db.pool_pre_ping', True)),
+    }
+    pool_size = config.get('ckanext.xloader.jobs_db.pool_size')
+    # sqlite's default pools don't take a size
+    if pool_size and not db_uri.startswith('sqlite'):
+        options['pool_size'] = int(pool_size)
+    return options
 
 
 def drop_all():
@@ -56,9 +125,12 @@ def drop_all():
     """
     if _METADATA:
         _METADATA.drop_all(ENGINE)
+        for (db_uri, _pid), engine in list(_ENGINES.items()):
+            if engine is ENGINE:
+                _TABLES_CREATED.discard(db_uri)
 
 
-def get_job(job_id):
+def get_job(job_id, logs_limit=None, logs_offset=0, logs_since=None):
     """Return the job with the given job_id as a dict.
 
     The dict also includes any metadata or logs associated with the job.
@@ -102,7 +174,21 @@ def get_job(job_id):
 
     "metadata": Any custom metadata associated with the job (dict)
 
-    "logs": Any logs associated with the job (list)
+    "logs": Any logs associated with the job, oldest first, with ISO format
+        timestamps (list)
+
+    "logs_count": The total number of logs associated with the job, or with
+        it since logs_since (int)
+
+    :param logs_limit: the maximum number of logs to return (all by default)
+    :type logs_limit: int
+
+    :param logs_offset: the number of logs to skip. If negative, counts back
+        from the newest log, so -50 returns the newest 50 logs.
+    :type logs_offset: int
+
+    :param logs_since: only return logs after this time
+    :type logs_since: datetime or ISO format string
 
     """
     # Avoid SQLAlchemy "Unicode type received non-unicode bind param value"
@@ -110,20 +196,66 @@ def get_job(job_id):
     if job_id:
         job_id = six.text_type(job_id)
 
+    if JOBS_TABLE is None or METADATA_TABLE is None or LOGS_TABLE is None \
+            or ENGINE is None:
+        raise RuntimeError("DB is not initialized")
+
+    # the job, a row per metadata item and the number of logs in one query,
+    # then the page of logs, if there is one
+    logs_condition = _logs_condition(job_id, logs_since)
+    stmt = sqlalchemy.select(
+        JOBS_TABLE,
+        METADATA_TABLE.c.key.label('metadata_key'),
+        METADATA_TABLE.c.value.label('metadata_value'),
+        METADATA_TABLE.c.type.label('metadata_type'),
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(LOGS_TABLE)
+        .where(logs_condition).scalar_subquery().label('logs_count'),
+    ).select_from(JOBS_TABLE.outerjoin(
+        METADATA_TABLE, METADATA_TABLE.c.job_id == JOBS_TABLE.c.job_id)) \
+        .where(JOBS_TABLE.c.job_id == job_id)
+    with ENGINE.connect() as conn:
+        rows = conn.execute(stmt).fetchall()
+        if not rows:
+            return None
+        logs_count = rows[0].logs_count
+        logs = _get_logs(conn, logs_condition, logs_count, logs_limit, logs_offset)
+
+    result_dict = _job_as_dict(rows[0], columns=JOBS_TABLE.c.keys())
+    result_dict['metadata'] = _metadata_from_rows(rows)
+    result_dict['logs'] = logs
+    result_dict['logs_count'] = logs_count
+
+    return result_dict
+
+
+def get_jobs(job_ids):
+    """Return the jobs with the given job_ids, without their metadata, logs
+    or API keys, in one query.
+
+    :returns: the jobs that exist, by job_id, with the keys described in
+        get_job
+    :rtype: dict
+
+    """
     if JOBS_TABLE is None or ENGINE is None:
         raise RuntimeError("DB is not initialized")
 
-    stmt = sqlalchemy.select(JOBS_TABLE).where(JOBS_TABLE.c.job_id == job_id)
+    job_ids = [six.text_type(job_id) for job_id in job_ids if job_id]
+    if not job_ids:
+        return {}
+    columns = [column for column in JOBS_TABLE.c if column.name != 'api_key']
+    stmt = sqlalchemy.select(*columns).where(JOBS_TABLE.c.job_id.in_(job_ids))
     with ENGINE.connect() as conn:
-        result = conn.execute(stmt).first()
+        return {row.job_id: _job_as_dict(row) for row in conn.execute(stmt)}
 
-    if not result:
-        return None
 
-    # Turn the result into a dictionary representation of the job.
+def _job_as_dict(row, columns=None):
+    """Turn a row of the jobs table into a dictionary representation of the
+    job. Given columns, other columns of the row are left out."""
     result_dict = {}
-    for field in stmt.columns.keys():
-        value = getattr(result, field)
+    for field, value in row._mapping.items():  # pyright: ignore[reportPrivateUsage]
+        if columns is not None and field not in columns:
+            continue
         if value is None:
             result_dict[field] = value
         elif field in ('sent_data', 'data', 'error'):
@@ -132,10 +264,6 @@ def get_job(job_id):
             result_dict[field] = value.isoformat()
         else:
             result_dict[field] = six.text_type(value)
-
-    result_dict['metadata'] = _get_metadata(job_id)
-    result_dict['logs'] = _get_logs(job_id)
-
     return result_dict
 
 
@@ -206,28 +334,58 @@ def add_pending_job(job_id, job_type, api_key,
 
         # Insert any (key, value) metadata pairs that the job has into the
         # metadata table.
-        inserts = []
-        for key, value in list(metadata.items()):
-            type_ = 'string'
-            if not isinstance(value, six.string_types):
-                value = json.dumps(value)
-                type_ = 'json'
-
-            # Turn strings into unicode to stop SQLAlchemy
-            # "Unicode type received non-unicode bind param value" warnings.
-            key = six.text_type(key)
-            value = six.text_type(value)
-
-            inserts.append(
-                {"job_id": job_id,
-                 "key": key,
-                 "value": value,
-                 "type": type_}
-            )
+        inserts = _metadata_rows(job_id, metadata)
         if inserts:
             conn.execute(METADATA_TABLE.insert(), inserts)
 
 
+def save_metadata(job_id, metadata):
+    """Add (key, value) metadata pairs to a job, replacing any existing
+    values of the same keys.
+
+    :param job_id: the job_id of the job
+    :type job_id: unicode
+
+    :param metadata: the keys should be strings, the values can be strings or
+        any JSON-encodable type
+    :type metadata: dict
+
+    """
+    if ENGINE is None or METADATA_TABLE is None:
+        raise RuntimeError("DB is not initialized")
+
+    inserts = _metadata_rows(six.text_type(job_id), metadata)
+    if not inserts:
+        return
+    with ENGINE.begin() as conn:
+        conn.execute(METADATA_TABLE.delete().where(sqlalchemy.and_(
+            METADATA_TABLE.c.job_id == six.text_type(job_id),
+            METADATA_TABLE.c.key.in_([row['key'] for row in inserts]))))
+        conn.execute(METADATA_TABLE.insert(), inserts)
+
+
+def _metadata_rows(job_id, metadata):
+    rows = []
+    for key, value in list(metadata.items()):
+        type_ = 'string'
+        if not isinstance(value, six.string_types):
+            value = json.dumps(value)
+            type_ = 'json'
+
+        # Turn strings into unicode to stop SQLAlchemy
+        # "Unicode type received non-unicode bind param value" warnings.
+        key = six.text_type(key)
+        value = six.text_type(value)
+
+        rows.append(
+            {"job_id": job_id,
+             "key": key,
+             "value": value,
+             "type": type_}
+        )
+    return rows
+
+
 class InvalidErrorObjectError(Exception):
     pass
 
@@ -390,6 +548,265 @@ def delete_api_key(job_id):
     _update_job(job_id, {"api_key": None})
 
 
+def get_checkpoint(resource_id):
+    """Return the checkpoint of the last interrupted load of the given
+    resource as a dict, or None if there isn't one.
+
+    The keys are "resource_id", "file_hash", "stage" ("copy", "fulltext" or
+    "indexes"), "byte_offset", "rows_loaded", "max_id", "fulltext_id" and
+    "timestamp".
+
+    """
+    if ENGINE is None or CHECKPOINTS_TABLE is None:
+        raise RuntimeError("DB is not initialized")
+
+    with ENGINE.connect() as conn:
+        result = conn.execute(
+            CHECKPOINTS_TABLE.select().where(
+                CHECKPOINTS_TABLE.c.resource_id == six.text_type(resource_id))
+        ).first()
+    if not result:
+        return None
+    return dict(result._mapping)  # pyright: ignore[reportPrivateUsage]
+
+
+def save_checkpoint(resource_id, file_hash, stage, byte_offset=0,
+                    rows_loaded=0, max_id=0, fulltext_id=0):
+    """Record how far the load of a resource has got, replacing any previous
+    checkpoint of that resource.
+
+    :param resource_id: the resource being loaded
+    :type resource_id: unicode
+
+    :param file_hash: the hash of the file being loaded, so that a checkpoint
+        is only used to resume loading the same file
+    :type file_hash: unicode
+
+    :param stage: the stage to resume at: "copy", "fulltext" or "indexes"
+    :type stage: unicode
+
+    :param byte_offset: the offset in the (UTF-8 encoded) file of the first
+        row that has not been copied yet
+    :type byte_offset: int
+
+    :param rows_loaded: the number of rows copied so far
+    :type rows_loaded: int
+
+    :param max_id: the highest _id copied so far
+    :type max_id: int
+
+    :param fulltext_id: the _id up to which the search index is populated
+    :type fulltext_id: int
+
+    """
+    if ENGINE is None or CHECKPOINTS_TABLE is None:
+        raise RuntimeError("DB is not initialized")
+
+    resource_id = six.text_type(resource_id)
+    with ENGINE.begin() as conn:
+        conn.execute(CHECKPOINTS_TABLE.delete().where(
+            CHECKPOINTS_TABLE.c.resource_id == resource_id))
+        conn.execute(CHECKPOINTS_TABLE.insert().values(
+            resource_id=resource_id,
+            file_hash=six.text_type(file_hash),
+            stage=six.text_type(stage),
+            byte_offset=byte_offset,
+            rows_loaded=rows_loaded,
+            max_id=max_id,
+            fulltext_id=fulltext_id,
+            timestamp=datetime.datetime.utcnow()))
+
+
+def delete_checkpoint(resource_id):
+    """Delete the checkpoint of the given resource, if there is one."""
+    if ENGINE is None or CHECKPOINTS_TABLE is None:
+        raise RuntimeError("DB is not initialized")
+
+    with ENGINE.begin() as conn:
+        conn.execute(CHECKPOINTS_TABLE.delete().where(
+            CHECKPOINTS_TABLE.c.resource_id == six.text_type(resource_id)))
+
+
+def get_retention_options(config):
+    """Return the purge() arguments set in the config."""
+    return {
+        'keep_jobs_per_resource': int(config.get('ckanext.xloader.jobs_db.keep_jobs_per_resource') or 0),
+        'keep_logs_days': int(config.get('ckanext.xloader.jobs_db.keep_logs_days') or 0),
+        'batch_size': int(config.get('ckanext.xloader.jobs_db.purge_batch_size') or 1000),
+    }
+
+
+def purge(keep_jobs_per_resource=0, keep_logs_days=0, batch_size=1000):
+    """Delete old jobs and logs, a batch at a time so that no transaction
+    runs for long.
+
+    :param keep_jobs_per_resource: keep only this many of the most recent
+        jobs of each resource, with their metadata and logs (0 keeps them all)
+    :type keep_jobs_per_resource: int
+
+    :param keep_logs_days: delete logs older than this many days (0 keeps
+        them all). Partitions of a partitioned logs table (see
+        ckanext.xloader.jobs_db.partition_logs) that only hold older logs are
+        dropped whole.
+    :type keep_logs_days: int
+
+    :param batch_size: the number of jobs to delete, or whose logs to
+        delete, per transaction
+    :type batch_size: int
+
+    :returns: the numbers of "jobs" and "logs" deleted, and of logs
+        "partitions" dropped
+    :rtype: dict
+
+    """
+    if ENGINE is None or JOBS_TABLE is None:
+        raise RuntimeError("DB is not initialized")
+
+    counts = {'jobs': 0, 'logs': 0, 'partitions': 0}
+    if keep_jobs_per_resource:
+        ranked = sqlalchemy.select(
+            JOBS_TABLE.c.job_id,
+            sqlalchemy.func.row_number().over(
+                partition_by=METADATA_TABLE.c.value,
+                order_by=JOBS_TABLE.c.requested_timestamp.desc(),
+            ).label('rank'),
+        ).select_from(JOBS_TABLE.join(METADATA_TABLE, sqlalchemy.and_(
+            METADATA_TABLE.c.job_id == JOBS_TABLE.c.job_id,
+            METADATA_TABLE.c.key == u'resource_id',
+        ))).subquery()
+        doomed = sqlalchemy.select(ranked.c.job_id) \
+            .where(ranked.c.rank > keep_jobs_per_resource)
+        for conn, job_ids in _batches_of_job_ids(doomed, batch_size):
+            # not relying on ON DELETE CASCADE, which sqlite doesn't do
+            # by default
+            counts['logs'] += conn.execute(LOGS_TABLE.delete().where(
+                LOGS_TABLE.c.job_id.in_(job_ids))).rowcount
+            conn.execute(METADATA_TABLE.delete().where(
+                METADATA_TABLE.c.job_id.in_(job_ids)))
+            counts['jobs'] += conn.execute(JOBS_TABLE.delete().where(
+                JOBS_TABLE.c.job_id.in_(job_ids))).rowcount
+
+    if keep_logs_days:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=keep_logs_days)
+        if _logs_partitioned():
+            with ENGINE.begin() as conn:
+                counts['partitions'] = _drop_logs_partitions(conn, cutoff)
+                _create_logs_partitions(conn)
+        doomed = sqlalchemy.select(LOGS_TABLE.c.job_id).distinct() \
+            .where(LOGS_TABLE.c.timestamp < cutoff)
+        for conn, job_ids in _batches_of_job_ids(doomed, batch_size):
+            counts['logs'] += conn.execute(LOGS_TABLE.delete().where(
+                sqlalchemy.and_(LOGS_TABLE.c.job_id.in_(job_ids),
+                                LOGS_TABLE.c.timestamp < cutoff))).rowcount
+    return counts
+
+
+def _batches_of_job_ids(stmt, batch_size):
+    """Run the query of job ids once, into a temporary table, and yield a
+    connection in a transaction and the next batch_size of the ids, in turn,
+    so that each batch is quick to get however big the tables are."""
+    table = sqlalchemy.Table(
+        'xloader_purge_job_ids', sqlalchemy.MetaData(),
+        sqlalchemy.Column('job_id', sqlalchemy.UnicodeText, primary_key=True),
+        prefixes=['TEMPORARY'])
+    with ENGINE.connect() as conn:
+        with conn.begin():
+            table.create(conn)
+            conn.execute(table.insert().from_select(['job_id'], stmt))
+        try:
+            last_id = None
+            while True:
+                with conn.begin():
+                    page = sqlalchemy.select(table.c.job_id) \
+                        .order_by(table.c.job_id).limit(batch_size)
+                    if last_id is not None:
+                        page = page.where(table.c.job_id > last_id)
+                    job_ids = conn.execute(page).scalars().all()
+                    if not job_ids:
+                        return
+                    yield conn, job_ids
+                last_id = job_ids[-1]
+        finally:
+            if conn.in_transaction():
+                conn.rollback()
+            with conn.begin():
+                table.drop(conn)
+
+
+def _logs_partitioned():
+    """Return whether the logs table is partitioned by time (which only
+    PostgreSQL can do)."""
+    if ENGINE.dialect.name != 'postgresql' \
+            or 'postgresql_partition_by' not in LOGS_TABLE.dialect_kwargs:
+        return False
+    with ENGINE.connect() as conn:
+        return bool(conn.execute(sqlalchemy.text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('logs')"
+        )).scalar())
+
+
+def _month_start(date, months=0):
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+
+def _create_logs_partitions(conn):
+    """Create the monthly partitions of the logs table for this month and
+    the next LOGS_PARTITIONS_AHEAD, if they don't exist yet, and a default
+    partition for any logs outside them.
+
+    If neither init nor purge ran for so long that logs of a month went to
+    the default partition, they are moved to the month's new partition
+    (PostgreSQL won't create it otherwise)."""
+    conn.execute(sqlalchemy.text(
+        "CREATE TABLE IF NOT EXISTS logs_default PARTITION OF logs DEFAULT"))
+    existing = set(conn.execute(sqlalchemy.text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('logs')")).scalars())
+    this_month = _month_start(datetime.datetime.utcnow())
+    for i in range(LOGS_PARTITIONS_AHEAD + 1):
+        start = _month_start(this_month, i)
+        name = 'logs_{:%Y%m}'.format(start)
+        if name in existing:
+            continue
+        bounds = {'start': start, 'end': _month_start(start, 1)}
+        strays = conn.execute(sqlalchemy.text(
+            "SELECT 1 FROM logs_default WHERE timestamp >= :start AND timestamp < :end "
+            "LIMIT 1"), bounds).scalar()
+        if strays:
+            conn.execute(sqlalchemy.text("ALTER TABLE logs DETACH PARTITION logs_default"))
+        conn.execute(sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS {} PARTITION OF logs "
+            "FOR VALUES FROM ('{:%Y-%m-%d}') TO ('{:%Y-%m-%d}')".format(
+                name, bounds['start'], bounds['end'])))
+        if strays:
+            conn.execute(sqlalchemy.text(
+                "WITH moved AS (DELETE FROM logs_default "
+                "WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+                "INSERT INTO {} SELECT * FROM moved".format(name)), bounds)
+            conn.execute(sqlalchemy.text(
+                "ALTER TABLE logs ATTACH PARTITION logs_default DEFAULT"))
+
+
+def _drop_logs_partitions(conn, cutoff):
+    """Drop the monthly partitions of the logs table that end before the
+    cutoff. Returns how many were dropped."""
+    partitions = conn.execute(sqlalchemy.text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('logs')")).scalars().all()
+    dropped = 0
+    for name in partitions:
+        try:
+            start = datetime.datetime.strptime(name, 'logs_%Y%m')
+        except ValueError:
+            # the default partition, or one not created by us
+            continue
+        if _month_start(start, 1) <= cutoff:
+            conn.execute(sqlalchemy.text('DROP TABLE "{}"'.format(name)))
+            dropped += 1
+    return dropped
+
+
 def _init_jobs_table():
     """Initialise the "jobs" table in the db."""
     _jobs_table = sqlalchemy.Table(
@@ -424,8 +841,13 @@ def _init_metadata_table():
     return _metadata_table
 
 
-def _init_logs_table():
-    """Initialise the "logs" table in the db."""
+def _init_logs_table(partitioned=False):
+    """Initialise the "logs" table in the db.
+
+    If partitioned, a new logs table is created partitioned by month of the
+    timestamp, on PostgreSQL. An existing table is left as it is.
+    """
+    options = {'postgresql_partition_by': 'RANGE (timestamp)'} if partitioned else {}
     _logs_table = sqlalchemy.Table(
         'logs', _METADATA,
         sqlalchemy.Column(
@@ -436,47 +858,92 @@ def _init_logs_table():
         sqlalchemy.Column('level', sqlalchemy.UnicodeText),
         sqlalchemy.Column('module', sqlalchemy.UnicodeText),
         sqlalchemy.Column('funcName', sqlalchemy.UnicodeText),
-        sqlalchemy.Column('lineno', sqlalchemy.Integer)
+        sqlalchemy.Column('lineno', sqlalchemy.Integer),
+        # the order logs with the same timestamp were written in (NULL on
+        # sqlite, and for logs written before the column was added)
+        sqlalchemy.Column('id', sqlalchemy.BigInteger, sqlalchemy.Sequence('logs_id_seq')),
+        # metadata needs no index of its own: job_id leads its primary key
+        sqlalchemy.Index('logs_job_id_timestamp_idx', 'job_id', 'timestamp'),
+        **options
     )
     return _logs_table
 
 
-def _get_metadata(job_id):
-    """Return any metadata for the given job_id from the metadata table."""
-    # Avoid SQLAlchemy "Unicode type received non-unicode bind param value"
-    # warnings.
-    job_id = six.text_type(job_id)
-    if ENGINE is None or METADATA_TABLE is None:
-        raise RuntimeError("DB is not initialized")
+def _upgrade_logs_table(conn):
+    """Add the columns that are newer than an existing logs table."""
+    columns = {column['name'] for column in sqlalchemy.inspect(conn).get_columns('logs')}
+    if 'id' in columns:
+        return
+    if conn.dialect.name == 'postgresql':
+        # no default, so that the table isn't rewritten
+        conn.execute(sqlalchemy.text('CREATE SEQUENCE IF NOT EXISTS logs_id_seq'))
+        conn.execute(sqlalchemy.text('ALTER TABLE logs ADD COLUMN IF NOT EXISTS id BIGINT'))
+    else:
+        conn.execute(sqlalchemy.text('ALTER TABLE logs ADD COLUMN id BIGINT'))
+
+
+def _init_checkpoints_table():
+    """Initialise the "checkpoints" table in the db."""
+    _checkpoints_table = sqlalchemy.Table(
+        'checkpoints', _METADATA,
+        sqlalchemy.Column('resource_id', sqlalchemy.UnicodeText, primary_key=True),
+        sqlalchemy.Column('file_hash', sqlalchemy.UnicodeText),
+        sqlalchemy.Column('stage', sqlalchemy.UnicodeText),
+        sqlalchemy.Column('byte_offset', sqlalchemy.BigInteger),
+        sqlalchemy.Column('rows_loaded', sqlalchemy.BigInteger),
+        sqlalchemy.Column('max_id', sqlalchemy.BigInteger),
+        sqlalchemy.Column('fulltext_id', sqlalchemy.BigInteger),
+        sqlalchemy.Column('timestamp', sqlalchemy.DateTime),
+    )
+    return _checkpoints_table
 
-    with ENGINE.connect() as conn:
-        results = conn.execute(
-            METADATA_TABLE.select().where(
-                METADATA_TABLE.c.job_id == job_id)).fetchall()
+
+def _metadata_from_rows(rows):
+    """Return the metadata of a job from the rows of get_job's query, which
+    has the job's metadata items outer joined."""
     metadata = {}
-    for row in results:
-        value = row.value
-        if row.type == 'json':
+    for row in rows:
+        if row.metadata_key is None:
+            continue
+        value = row.metadata_value
+        if row.metadata_type == 'json':
             value = json.loads(value)
-        metadata[row.key] = value
+        metadata[row.metadata_key] = value
     return metadata
 
 
-def _get_logs(job_id):
-    """Return any logs for the given job_id from the logs table."""
-    # Avoid SQLAlchemy "Unicode type received non-unicode bind param value"
-    # warnings.
-    job_id = six.text_type(job_id)
-    if ENGINE is None or LOGS_TABLE is None:
-        raise RuntimeError("DB is not initialized")
-
-    with ENGINE.connect() as conn:
-        results = conn.execute(
-            LOGS_TABLE.select().where(LOGS_TABLE.c.job_id == job_id)).fetchall()
-
-    results = [dict(result._mapping) for result in results]  # pyright: ignore[reportPrivateUsage]
-
-    for result in results:
-        result.pop("job_id")
-
-    return results
+def _logs_condition(job_id, since=None):
+    """Return the condition for the logs of the given job_id, or those of
+    them after since."""
+    condition = LOGS_TABLE.c.job_id == job_id
+    if since:
+        if not isinstance(since, datetime.datetime):
+            since = datetime.datetime.fromisoformat(since)
+        condition = sqlalchemy.and_(condition, LOGS_TABLE.c.timestamp > since)
+    return condition
+
+
+def _get_logs(conn, condition, count, limit=None, offset=0):
+    """Return a page of the logs that meet the condition, of which there
+    are count."""
+    offset = offset or 0
+    if offset < 0:
+        offset = max(count + offset, 0)
+    if count <= offset or limit == 0:
+        return []
+
+    stmt = sqlalchemy.select(*[column for column in LOGS_TABLE.c
+                               if column.name not in ('job_id', 'id')]) \
+        .where(condition) \
+        .order_by(LOGS_TABLE.c.timestamp, LOGS_TABLE.c.id) \
+        .offset(offset)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    logs = []
+    for row in conn.execute(stmt):
+        log = dict(row._mapping)  # pyright: ignore[reportPrivateUsage]
+        if isinstance(log['timestamp'], datetime.datetime):
+            log['timestamp'] = log['timestamp'].isoformat()
+        logs.append(log)
+    return logs
@@ -0,0 +1,341 @@
+# encoding: utf-8
+'''Fair-share dispatching of xloader jobs between organizations.
+
+With ``ckanext.xloader.fair_share`` on, xloader_submit doesn't put jobs
+straight on the RQ queues. Each job waits in a sub-queue of its
+organization (per RQ queue), and the Dispatcher tops each RQ queue up to
+``ckanext.xloader.fair_share.queue_length`` jobs, taking the next job from
+the organization that has had the least work dispatched relative to its
+weight (``ckanext.xloader.fair_share.weights``), skipping organizations
+that already have ``ckanext.xloader.fair_share.max_jobs_per_org`` jobs
+queued or running. So an organization submitting thousands of resources
+only gets its share of the workers, and the others' jobs start within a
+few jobs' time.
+
+Dispatching happens when a job is submitted and when one finishes, and
+every second in ``ckan xloader worker`` for jobs that were killed. The state is kept in Redis under REDIS_PREFIX:
+
+* ``<prefix>:queues`` - set of the RQ queue names with jobs waiting
+* ``<prefix>:queue:<queue>`` - set of the organizations with jobs waiting
+  on that queue
+* ``<prefix>:queue:<queue>:org:<org>`` - list of the ids of the jobs of
+  the organization waiting for that queue, oldest first
+* ``<prefix>:pass`` - hash of the work dispatched per organization,
+  divided by its weight (stride scheduling)
+* ``<prefix>:clock`` - the pass of the organization whose job was
+  dispatched last
+* ``<prefix>:active`` - hash of the organization of each dispatched job
+  that hasn't finished
+* ``<prefix>:lock`` - held by the process dispatching
+* ``<prefix>:again`` - set by a process that found the lock held, for the
+  holder to dispatch again
+'''
+import logging
+import uuid
+
+from redis.exceptions import WatchError
+
+log = logging.getLogger(__name__)
+
+REDIS_PREFIX = 'ckanext-xloader:fair-share'
+# Stands for the organization of datasets that have none
+NO_ORGANIZATION = '-'
+# Seconds after which a dispatch lock left by a crashed process expires
+LOCK_TIMEOUT = 30
+
+
+class Dispatcher(object):
+    '''Hands the jobs waiting in organizations' sub-queues to the RQ queues.
+
+    It only needs a Redis connection (redis-py compatible, e.g. fakeredis)
+    and is told how to check and fill the RQ queues, so it can be tried with
+    synthetic job streams.
+
+    :param redis: the Redis connection
+    :param queue_length: the number of jobs to keep on each RQ queue
+    :param max_jobs_per_org: the most jobs of one organization that can be
+        queued or running at once, 0 for no limit
+    :param weights: the weight of organizations, by name; others get 1
+    :type weights: dict
+    '''
+
+    def __init__(self, redis, queue_length=1, max_jobs_per_org=0, weights=None,
+                 prefix=REDIS_PREFIX):
+        self.redis = redis
+        self.queue_length = queue_length
+        self.max_jobs_per_org = max_jobs_per_org
+        self.weights = weights or {}
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def push(self, queue_name, org, *job_ids):
+        '''Adds the jobs to the end of the organization's sub-queue.'''
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(self._key('queue', queue_name, 'org', org), *job_ids)
+        pipeline.sadd(self._key('queue', queue_name), org)
+        pipeline.sadd(self._key('queues'), queue_name)
+        _length, added, _added = pipeline.execute()
+        if added:
+            # an organization that starts submitting again begins level with
+            # the others, rather than being owed the work they had meanwhile
+            clock = float(self.redis.get(self._key('clock')) or 0)
+            if float(self.redis.hget(self._key('pass'), org) or 0) < clock:
+                self.redis.hset(self._key('pass'), org, clock)
+
+    def track(self, org, job_id):
+        '''Counts a job put on an RQ queue other than by dispatch (e.g. a
+        retry) as one of the organization's.'''
+        self.redis.hset(self._key('active'), job_id, org)
+
+    def finished(self, job_id):
+        '''Stops counting the job as one of its organization's.'''
+        self.redis.hdel(self._key('active'), job_id)
+
+    def waiting(self):
+        '''Returns the number of jobs waiting, by queue and organization.'''
+        waiting = {}
+        for queue_name in sorted(_decode_all(self.redis.smembers(self._key('queues')))):
+            for org in sorted(_decode_all(self.redis.smembers(self._key('queue', queue_name)))):
+                waiting.setdefault(queue_name, {})[org] = \
+                    self.redis.llen(self._key('queue', queue_name, 'org', org))
+        return waiting
+
+    def active(self, is_active=None):
+        '''Returns the number of dispatched jobs that haven't finished, by
+        organization.
+
+        :param is_active: called with a job id, returns whether the job is
+            still queued or running. Jobs for which it returns False (e.g.
+            because their worker was killed) are forgotten.
+        '''
+        counts = {}
+        for job_id, org in self.redis.hgetall(self._key('active')).items():
+            job_id, org = _decode(job_id), _decode(org)
+            if is_active is not None and not is_active(job_id):
+                self.finished(job_id)
+                continue
+            counts[org] = counts.get(org, 0) + 1
+        return counts
+
+    def dispatch(self, queue_depth, enqueue, is_active=None):
+        '''Moves waiting jobs to the RQ queues that are short of
+        queue_length jobs, fairly between the organizations.
+
+        :param queue_depth: called with a queue name, returns the number of
+            jobs on that RQ queue
+        :param enqueue: called with a queue name and a job id, puts the job
+            on that RQ queue. Returns False if the job no longer exists.
+        :param is_active: see active
+
+        :returns: the (queue name, organization, job id) of the jobs
+            dispatched
+        :rtype: list
+        '''
+        lock = self._key('lock')
+        again = self._key('again')
+        dispatched = []
+        while True:
+            token = uuid.uuid4().hex
+            if not self.redis.set(lock, token, nx=True, ex=LOCK_TIMEOUT):
+                # another process is dispatching, but may have read the
+                # state before what this call is for (e.g. a job finishing),
+                # so ask it to go again. Unless it has just finished, and
+                # the lock can be had after all.
+                self.redis.set(again, 1, ex=LOCK_TIMEOUT)
+                if not self.redis.set(lock, token, nx=True, ex=LOCK_TIMEOUT):
+                    return dispatched
+            try:
+                self.redis.delete(again)
+                dispatched += self._dispatch(queue_depth, enqueue, is_active)
+            finally:
+                if _decode(self.redis.get(lock)) == token:
+                    self.redis.delete(lock)
+            # checked after releasing the lock, so that a request made
+            # after this check finds the lock free
+            if not self.redis.exists(again):
+                return dispatched
+
+    def _dispatch(self, queue_depth, enqueue, is_active):
+        dispatched = []
+        active = self.active(is_active)
+        for queue_name in sorted(_decode_all(self.redis.smembers(self._key('queues')))):
+            free = self.queue_length - queue_depth(queue_name)
+            while free > 0:
+                org = self._next_org(queue_name, active)
+                if org is None:
+                    break
+                self.redis.set(self._key('clock'), self.redis.hget(self._key('pass'), org) or 0)
+                job_id = self._pop(queue_name, org)
+                if job_id is None or not enqueue(queue_name, job_id):
+                    continue
+                self.track(org, job_id)
+                self.redis.hincrbyfloat(self._key('pass'), org, 1.0 / self._weight(org))
+                active[org] = active.get(org, 0) + 1
+                dispatched.append((queue_name, org, job_id))
+                free -= 1
+            if not self.redis.scard(self._key('queue', queue_name)):
+                self.redis.srem(self._key('queues'), queue_name)
+        return dispatched
+
+    def _weight(self, org):
+        return float(self.weights.get(org, 1)) or 1.0
+
+    def _next_org(self, queue_name, active):
+        '''The organization with jobs waiting for the queue, below the cap,
+        that has had the least work dispatched for its weight.'''
+        orgs = sorted(_decode_all(self.redis.smembers(self._key('queue', queue_name))))
+        if self.max_jobs_per_org:
+            orgs = [org for org in orgs if active.get(org, 0) < self.max_jobs_per_org]
+        if not orgs:
+            return None
+        passes = dict(zip(orgs, self.redis.hmget(self._key('pass'), orgs)))
+        return min(orgs, key=lambda org: (float(passes[org] or 0), org))
+
+    def _pop(self, queue_name, org):
+        '''Takes the organization's next job, and takes the organization
+        off the queue's set if it was the last one. A push in between
+        restarts it, so that the pushed job isn't left out of sight.'''
+        key = self._key('queue', queue_name, 'org', org)
+        with self.redis.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    job_id = pipeline.lindex(key, 0)
+                    length = pipeline.llen(key)
+                    pipeline.multi()
+                    pipeline.lpop(key)
+                    if length <= 1:
+                        pipeline.srem(self._key('queue', queue_name), org)
+                    pipeline.execute()
+                    return _decode(job_id)
+                except WatchError:
+                    continue
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _decode_all(values):
+    return [_decode(value) for value in values]
+
+
+def parse_weights(value):
+    '''Parses the ckanext.xloader.fair_share.weights option, e.g.
+    ``"org-a:3 org-b:0.5"``, into a dict.'''
+    weights = {}
+    for item in (value or '').split():
+        org, _sep, weight = item.rpartition(':')
+        if not org:
+            raise ValueError('Expected <organization>:<weight>, not {!r}'.format(item))
+        weights[org] = float(weight)
+    return weights
+
+
+def get_dispatcher():
+    '''Returns a Dispatcher on the CKAN Redis, configured by the
+    ckanext.xloader.fair_share.* options.'''
+    from ckan.lib.redis import connect_to_redis
+    from ckan.plugins.toolkit import config
+
+    return Dispatcher(
+        connect_to_redis(),
+        queue_length=int(config.get('ckanext.xloader.fair_share.queue_length') or 1),
+        max_jobs_per_org=int(config.get('ckanext.xloader.fair_share.max_jobs_per_org') or 0),
+        weights=parse_weights(config.get('ckanext.xloader.fair_share.weights')),
+    )
+
+
+def submit(fn, args, queue, title, org, timeout=None):
+    '''Creates the RQ job, as toolkit.enqueue_job would, but leaves it in
+    the organization's sub-queue until dispatch puts it on the RQ queue.
+
+    :returns: the job
+    :rtype: rq.job.Job
+    '''
+    from ckan.lib.jobs import get_queue
+    from rq.job import JobStatus
+
+    # 'scheduled' rather than 'deferred', which RQ keeps for jobs waiting
+    # on dependencies and won't enqueue
+    job = get_queue(queue).create_job(
+        fn, args=args, timeout=timeout, meta={'title': title},
+        status=JobStatus.SCHEDULED)
+    job.save()
+    dispatcher = get_dispatcher()
+    dispatcher.push(queue, org, job.id)
+    log.info('Added background job %s ("%s") for organization %s to wait for queue "%s"',
+             job.id, title, org, queue)
+    dispatch(dispatcher)
+    return job
+
+
+def submit_many(fn, job_args):
+    '''Creates several jobs as submit does, saving them with one Redis
+    pipeline, and dispatches once.
+
+    :param job_args: for each job, a dict of the arguments of submit, i.e.
+        'args', 'queue', 'title', 'org' and 'timeout', and its 'job_id'
+    :type job_args: list
+
+    :returns: the jobs
+    :rtype: list
+    '''
+    from ckan.lib.jobs import get_queue
+    from rq.job import JobStatus
+
+    dispatcher = get_dispatcher()
+    created = []
+    pipeline = dispatcher.redis.pipeline()
+    for kwargs in job_args:
+        job = get_queue(kwargs['queue']).create_job(
+            fn, args=kwargs['args'], timeout=kwargs.get('timeout'),
+            job_id=kwargs.get('job_id'), meta={'title': kwargs['title']},
+            status=JobStatus.SCHEDULED)
+        job.save(pipeline=pipeline)
+        created.append(job)
+    pipeline.execute()
+
+    by_org = {}
+    for kwargs, job in zip(job_args, created):
+        by_org.setdefault((kwargs['queue'], kwargs['org']), []).append(job.id)
+    for (queue, org), job_ids in by_org.items():
+        dispatcher.push(queue, org, *job_ids)
+        log.info('Added %s background jobs for organization %s to wait for queue "%s"',
+                 len(job_ids), org, queue)
+    dispatch(dispatcher)
+    return created
+
+
+def dispatch(dispatcher=None):
+    '''Tops up the RQ queues from the organizations' sub-queues.'''
+    from ckan.lib.jobs import get_queue
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+
+    dispatcher = dispatcher or get_dispatcher()
+
+    def enqueue(queue_name, job_id):
+        queue = get_queue(queue_name)
+        try:
+            job = Job.fetch(job_id, connection=queue.connection)
+        except NoSuchJobError:
+            return False
+        queue.enqueue_job(job)
+        return True
+
+    def is_active(job_id):
+        try:
+            job = Job.fetch(job_id, connection=dispatcher.redis)
+        except NoSuchJobError:
+            return False
+        return job.get_status() in ('queued', 'started', 'deferred', 'scheduled')
+
+    try:
+        return dispatcher.dispatch(lambda queue_name: get_queue(queue_name).count,
+                                   enqueue, is_active)
+    except Exception:
+        log.exception('Could not dispatch the waiting xloader jobs')
+        return []
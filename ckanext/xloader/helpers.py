@@ -1,5 +1,5 @@
 import ckan.plugins.toolkit as toolkit
-from ckanext.xloader.utils import XLoaderFormats
+from ckanext.xloader.utils import XLoaderFormats, cache_statuses, get_cached_statuses
 from markupsafe import Markup
 from html import escape as html_escape
 
@@ -46,6 +46,44 @@ def is_resource_supported_by_xloader(res_dict, check_access=True):
     return (is_supported_format or is_datastore_active) and user_has_access and is_supported_url_type
 
 
+def _get_badge_status(resource):
+    """
+    Returns the xloader status of a resource for its badge, without logs.
+
+    On a dataset page, the statuses of all the dataset's resources are fetched
+    in one go for the first badge and kept for the rest of the request. They
+    are also cached (see ckanext.xloader.status_cache_ttl) until xloader_hook
+    or xloader_submit changes them.
+    """
+    try:
+        statuses = toolkit.g.setdefault('xloader_badge_statuses', {})
+        pkg_dict = getattr(toolkit.g, 'pkg_dict', None) or {}
+    except (AttributeError, RuntimeError, TypeError):
+        # outside of a request
+        statuses, pkg_dict = {}, {}
+
+    resource_id = resource.get('id')
+    if resource_id not in statuses:
+        resource_ids = [resource_id]
+        if pkg_dict.get('id') == resource.get('package_id'):
+            resource_ids += [res['id'] for res in pkg_dict.get('resources', [])
+                             if res.get('id') not in statuses]
+        resource_ids = list(set(resource_ids))
+        cached = get_cached_statuses(resource_ids)
+        statuses.update(cached)
+        missing = [id_ for id_ in resource_ids if id_ not in cached]
+        if missing:
+            fetched = toolkit.get_action('xloader_status_bulk')(
+                {'ignore_auth': True}, {'resource_ids': missing})
+            # only what the badge shows
+            fetched = {id_: {key: fetched[id_][key] for key in ('status', 'last_updated')}
+                       if id_ in fetched else {}
+                       for id_ in missing}
+            cache_statuses(fetched)
+            statuses.update(fetched)
+    return statuses[resource_id]
+
+
 def xloader_badge(resource):
     # type: (dict) -> str
     """
@@ -60,11 +98,7 @@ def xloader_badge(resource):
 
     is_datastore_active = resource.get('datastore_active', False)
 
-    try:
-        xloader_job = toolkit.get_action("xloader_status")({'ignore_auth': True},
-                                                           {"resource_id": resource.get('id')})
-    except toolkit.ObjectNotFound:
-        xloader_job = {}
+    xloader_job = _get_badge_status(resource)
 
     if xloader_job.get('status') == 'complete':
         # the xloader task is complete, show datastore active or inactive.
@@ -18,7 +18,7 @@ class FileCouldNotBeLoadedError(Exception):
 class HTTPError(JobError):
     """Exception that's raised if a job fails due to an HTTP problem."""
 
-    def __init__(self, message, status_code, request_url, response):
+    def __init__(self, message, status_code, request_url, response, retry_after=None):
         """Initialise a new HTTPError.
 
         :param message: A human-readable error message
@@ -36,12 +36,17 @@ class HTTPError(JobError):
             give you this)
         :type response: unicode
 
+        :param retry_after: The number of seconds the server asked to wait
+            before trying again, with a Retry-After header
+        :type retry_after: int
+
         """
         super(HTTPError, self).__init__(message)
         self.message = message
         self.status_code = status_code
         self.request_url = request_url
         self.response = response
+        self.retry_after = retry_after
 
     def __str__(self):
         return str('{} status={} url={} response={}'.format(
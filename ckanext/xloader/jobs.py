@@ -1,14 +1,19 @@
 from __future__ import division
 from __future__ import absolute_import
+import contextlib
 import math
 import logging
+import logging.handlers
 import hashlib
 import time
 import tempfile
 import json
 import datetime
+import email.utils
 import os
+import random
 import traceback
+import threading
 import sys
 
 from psycopg2 import errors
@@ -18,12 +23,14 @@ from rq import get_current_job
 from rq.timeouts import JobTimeoutException
 import sqlalchemy as sa
 
-from ckan.lib.jobs import DEFAULT_QUEUE_NAME
+from ckan.lib.jobs import DEFAULT_QUEUE_NAME, get_queue, remove_queue_name_prefix
+from ckan.lib.redis import connect_to_redis
 from ckan.plugins.toolkit import get_action, asbool, enqueue_job, ObjectNotFound, config, h
 
-from . import db, loader
+from . import db, fair_share, loader, metrics, profiling
 from .job_exceptions import JobError, HTTPError, DataTooBigError, FileCouldNotBeLoadedError, LoaderError, XLoaderTimeoutError
-from .utils import cleanup_temp_file, datastore_resource_exists, set_resource_metadata, modify_input_url
+from .utils import cleanup_temp_file, datastore_resource_exists, set_resource_metadata, modify_input_url, record_stage, \
+    set_active_job, clear_active_job
 
 
 from ckan.lib.api_token import get_user_from_token
@@ -32,6 +39,7 @@ log = logging.getLogger(__name__)
 
 CHUNK_SIZE = 16 * 1024  # 16kb
 DOWNLOAD_TIMEOUT = 30
+PURGE_QUEUED_KEY = 'ckanext-xloader:purge-queued'
 
 RETRYABLE_ERRORS = (
     errors.DeadlockDetected,
@@ -48,6 +56,19 @@ max_type_guessing_length = None
 max_excerpt_lines = None
 max_retries = None
 retried_job_timeout = None
+retry_backoff = None
+retry_backoff_max = None
+append_only_loads = None
+resumable_loads = None
+background_analyze = None
+purge_interval = None
+metrics_enabled = None
+queue_depth_aware = None
+large_file_size = None
+large_file_queue_names = None
+large_file_job_timeout = None
+large_file_head_request = None
+fair_share_enabled = None
 apitoken_header_name = None
 default_queue_names = DEFAULT_QUEUE_NAME.split()
 
@@ -98,22 +119,79 @@ def is_retryable_error(error):
 # }
 
 
-def get_default_queue_name(package_id=None):
+def get_default_queue_name(package_id=None, large_file=False):
     """ Retrieve the queue to be used in submitting jobs for the specified dataset.
 
     By sending all jobs for a dataset to the same queue, lock conflicts are reduced.
+
+    With large_file, one of the ckanext.xloader.large_file_queue_names is
+    picked instead (see is_large_file).
     """
-    if not default_queue_names:
+    queue_names = large_file_queue_names if large_file else default_queue_names
+    if not queue_names:
         return DEFAULT_QUEUE_NAME
     if not package_id:
-        return default_queue_names[0]
+        return queue_names[0]
+
+    queue_names = rank_queue_names(package_id, queue_names)
+    if queue_depth_aware and len(queue_names) > 1:
+        # the shorter of the dataset's two preferred queues, so that its
+        # jobs still only ever go to those two
+        try:
+            return min(queue_names[:2], key=lambda name: get_queue(name).count)
+        except Exception:
+            log.exception('Could not get the depth of the xloader queues')
+    return queue_names[0]
+
+
+def rank_queue_names(package_id, queue_names=None):
+    """ Returns the queue names (by default, the default queue names) in the
+    order of preference for the dataset's jobs.
+
+    This is rendezvous hashing: each queue gets a score from a hash of its
+    name and the whole package id, so datasets are spread evenly over the
+    queues, and adding or removing a queue only moves the datasets whose
+    first choice it is or becomes. md5 is used because, unlike hash(), it is
+    the same in every process.
+    """
+    def score(queue_name):
+        key = u'{}/{}'.format(queue_name, package_id).encode('utf-8')
+        return hashlib.md5(key, usedforsecurity=False).digest()
+
+    return sorted(queue_names or default_queue_names, key=score, reverse=True)
 
-    # Pick a queue by taking the first character of the package name
-    # and converting it into a numeric index to the list of queue names.
-    # We don't want a proper hash function, because those tend to add
-    # complications for the sake of (unnecessary) cryptographic strength.
-    queue_index = ord(package_id[0]) % len(default_queue_names)
-    return default_queue_names[queue_index]
+
+def is_large_file(resource_dict, head_request=True):
+    """ Returns whether the resource's file is at least
+    ckanext.xloader.large_file_size bytes, so its job should go to the large
+    file queues and not hold up the jobs of the many smaller files.
+
+    The size is the resource's 'size', or else, with
+    ckanext.xloader.large_file_head_request and head_request, the
+    Content-Length of its URL. A file of unknown size is not treated as large.
+    """
+    if not large_file_size:
+        return False
+    size = _resource_size(resource_dict, head_request)
+    return size is not None and size >= large_file_size
+
+
+def _resource_size(resource_dict, head_request=True):
+    try:
+        return int(resource_dict['size'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    url = resource_dict.get('url') or ''
+    if not (head_request and large_file_head_request) or resource_dict.get('url_type') \
+            or urlsplit(url).scheme not in ('http', 'https'):
+        return None
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT,
+                                 verify=ssl_verify)
+        return int(response.headers['Content-Length']) if response.ok else None
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        log.debug('Could not get the size of %s: %s', url, e)
+        return None
 
 
 def xloader_data_into_datastore(input):
@@ -134,8 +212,16 @@ def xloader_data_into_datastore(input):
                           api_key=input['api_key'],
                           job_dict=job_dict)
 
-    job_id = get_current_job().id
+    job = get_current_job()
+    job_id = job.id
+    # set by submits coalesced into this job while it was queued
+    if (getattr(job, 'meta', None) or {}).get('ignore_hash'):
+        input['metadata']['ignore_hash'] = True
     errored = False
+    # timings of the stages of the job, stored with it
+    stats = {}
+    # reports requested with xloader_submit's profile options
+    profile = {}
     # Set-up logging to the db
     handler = StoringHandler(job_id, input)
     level = logging.DEBUG
@@ -152,8 +238,11 @@ def xloader_data_into_datastore(input):
     try:
         # Store details of the job in the db
         db.add_pending_job(job_id, **input)
-        xloader_data_into_datastore_(input, job_dict, logger)
+        handler.start_flushing()
+        with _profiled(input['metadata']) as profile:
+            xloader_data_into_datastore_(input, job_dict, logger, stats)
         job_dict['status'] = 'complete'
+        handler.flush()
         db.mark_job_as_completed(job_id, job_dict)
     except sa.exc.IntegrityError as e:
         db.mark_job_as_errored(job_id, str(e))
@@ -169,14 +258,85 @@ def xloader_data_into_datastore(input):
         logger.error('xloader error: %s', e)
         errored = error_state['errored']
     finally:
+        # store any buffered log records before reporting the result
+        logger.removeHandler(handler)
+        try:
+            handler.close()
+        except Exception:
+            log.exception('Could not store the logs of job %s', job_id)
+        if stats.get('stages'):
+            try:
+                db.save_metadata(job_id, {'stages': stats['stages']})
+            except Exception:
+                log.exception('Could not store the stage timings of job %s', job_id)
+        if profile:
+            try:
+                db.save_metadata(job_id, profile)
+            except Exception:
+                log.exception('Could not store the profile of job %s', job_id)
+        if metrics_enabled:
+            # a job queued again after a temporary error is left 'pending'
+            metrics.job_finished(
+                'retried' if job_dict['status'] == 'pending' else job_dict['status'], stats)
         # job_dict is defined in xloader_hook's docstring
         is_saved_ok = callback_xloader_hook(result_url=input['result_url'],
                                             api_key=input['api_key'],
                                             job_dict=job_dict)
         errored = errored or not is_saved_ok
+        clear_active_job(input['metadata']['resource_id'], job_id)
+        if input['metadata'].get('fair_share_org') is not None:
+            _dispatch_next(job_id)
+        enqueue_due_retries()
+        enqueue_purge()
     return 'error' if errored else None
 
 
+def _job_timeout():
+    '''Returns the timeout, in seconds, of the RQ job running, which for a
+    retry of a large file is large_file_job_timeout.'''
+    return getattr(get_current_job(), 'timeout', None) or retried_job_timeout
+
+
+def _profiled(metadata):
+    '''Returns a context manager that profiles the job, if xloader_submit
+    was asked to, and otherwise does nothing.'''
+    if not metadata.get('profile') and not metadata.get('profile_memory'):
+        return contextlib.nullcontext({})
+    return profiling.profiled(memory=bool(metadata.get('profile_memory')))
+
+
+def _dispatch_next(job_id):
+    '''Hands this job's place on the queue to the next job, under fair-share
+    scheduling.'''
+    try:
+        dispatcher = fair_share.get_dispatcher()
+        dispatcher.finished(job_id)
+        fair_share.dispatch(dispatcher)
+    except Exception:
+        log.exception('Could not dispatch the next xloader job')
+
+
+def enqueue_purge():
+    '''Queue purge_jobs_db, if ckanext.xloader.jobs_db.purge_interval is set
+    and no worker has queued it within that interval.'''
+    if not purge_interval:
+        return
+    try:
+        if connect_to_redis().set(PURGE_QUEUED_KEY, 1, nx=True, ex=int(purge_interval * 3600)):
+            enqueue_job(purge_jobs_db, title='xloader purge jobs database')
+    except Exception:
+        log.exception('Could not queue the purge of the jobs database')
+
+
+def purge_jobs_db():
+    '''Delete old jobs and logs from the jobs database, as configured by
+    the ckanext.xloader.jobs_db.keep_* options.'''
+    db.init(config)
+    counts = db.purge(**db.get_retention_options(config))
+    log.info('Purged %(jobs)s jobs, %(logs)s log records and %(partitions)s '
+             'logs partitions from the jobs database', counts)
+
+
 def handle_retryable_error(e, input, job_id, job_dict, logger, error_state):
     """
     Handle retryable errors by attempting to retry the job or marking it as failed.
@@ -205,17 +365,43 @@ def handle_retryable_error(e, input, job_id, job_dict, logger, error_state):
         tries = job_dict['metadata'].get('tries', 0)
         if tries < max_retries:
             tries = tries + 1
-            log.info("Job %s failed due to temporary error [%s], retrying", job_id, e)
-            logger.info("Job failed due to temporary error [%s], retrying", e)
+            delay = retry_delay(tries, getattr(e, 'retry_after', None))
+            retry_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+            log.info("Job %s failed due to temporary error [%s], retrying in %.0fs",
+                     job_id, e, delay)
+            logger.info("Job failed due to temporary error [%s], retrying in %.0f seconds",
+                        e, delay)
             job_dict['status'] = 'pending'
-            job_dict['metadata']['tries'] = tries
-            enqueue_job(
-                xloader_data_into_datastore,
-                [input],
-                title="retry xloader_data_into_datastore: resource: {} attempt {}".format(
-                    job_dict['metadata']['resource_id'], tries),
-                rq_kwargs=dict(timeout=retried_job_timeout)
-            )
+            metadata = job_dict['metadata']
+            metadata['tries'] = tries
+            metadata['retry_at'] = retry_at.isoformat()
+            metadata['retry_reason'] = str(e)
+            try:
+                db.save_metadata(job_id, {key: metadata[key]
+                                          for key in ('tries', 'retry_at', 'retry_reason')})
+            except Exception:
+                log.exception('Could not store the retry of job %s', job_id)
+            title = "retry xloader_data_into_datastore: resource: {} attempt {}".format(
+                metadata['resource_id'], tries)
+            timeout = large_file_job_timeout if metadata.get('large_file') else retried_job_timeout
+            if delay:
+                # held in the queue's scheduled job registry until it's due
+                # (see enqueue_due_retries)
+                retry_job = get_queue(metadata.get('queue_name') or DEFAULT_QUEUE_NAME).enqueue_in(
+                    datetime.timedelta(seconds=delay), xloader_data_into_datastore, input,
+                    job_timeout=timeout, meta={'title': title})
+            else:
+                retry_job = enqueue_job(
+                    xloader_data_into_datastore,
+                    [input],
+                    queue=metadata.get('queue_name'),
+                    title=title,
+                    rq_kwargs=dict(timeout=timeout)
+                )
+            set_active_job(job_dict['metadata']['resource_id'], retry_job.id)
+            if metadata.get('fair_share_org') is not None:
+                # the retry takes over the job's place in its organization's share
+                fair_share.get_dispatcher().track(metadata['fair_share_org'], retry_job.id)
             return True
     db.mark_job_as_errored(
         job_id, traceback.format_tb(sys.exc_info()[2])[-1] + repr(e))
@@ -225,7 +411,67 @@ def handle_retryable_error(e, input, job_id, job_dict, logger, error_state):
     error_state['errored'] = True
 
 
-def xloader_data_into_datastore_(input, job_dict, logger):
+def retry_delay(tries, retry_after=None):
+    """ Returns the number of seconds to wait before the given try of a job:
+    ckanext.xloader.retry_backoff seconds, doubled for each earlier retry, up
+    to ckanext.xloader.retry_backoff_max, with a random part so that jobs
+    that failed together don't all retry together. A longer Retry-After
+    from the server is kept to, up to ckanext.xloader.retry_backoff_max.
+    """
+    if not retry_backoff:
+        return 0
+    longest = retry_backoff_max or float('inf')
+    delay = min(retry_backoff * 2 ** (tries - 1), longest)
+    # "equal jitter": between half and all of the delay
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    # a server can't hold the job back for longer than we would
+    return max(delay, min(retry_after or 0, longest))
+
+
+def parse_retry_after(value):
+    """ Returns the number of seconds to wait given by a Retry-After header
+    (a number of seconds or an HTTP date), or None. """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(retry_at.tzinfo)
+    return max(0, int((retry_at - now).total_seconds()))
+
+
+def enqueue_due_retries():
+    """ Moves the retries that are due from the scheduled job registries of
+    the xloader queues onto the queues, as an RQ worker started with
+    --with-scheduler would. `ckan jobs worker` doesn't, so this is done
+    when each xloader job finishes and by `ckan xloader worker`.
+    """
+    from rq.scheduler import RQScheduler
+
+    if not retry_backoff:
+        return
+    queue_names = list(default_queue_names)
+    if large_file_size:
+        queue_names += large_file_queue_names
+    try:
+        queues = [get_queue(name) for name in queue_names]
+        scheduler = RQScheduler(queues, connection=queues[0].connection)
+        # only one process moves the jobs of a queue at a time
+        if scheduler.acquire_locks():
+            try:
+                scheduler.enqueue_scheduled_jobs()
+            finally:
+                scheduler.release_locks()
+    except Exception:
+        log.exception('Could not enqueue the xloader retries that are due')
+
+
+def xloader_data_into_datastore_(input, job_dict, logger, stats=None):
     '''This function:
     * downloads the resource (metadata) from CKAN
     * downloads the data
@@ -233,19 +479,31 @@ def xloader_data_into_datastore_(input, job_dict, logger):
     * calls back to CKAN with the new status
 
     (datapusher called this function 'push_to_datastore')
+
+    stats: An optional dict, which gets the timings of the stages of the job
+    ('stages', see record_stage).
     '''
+    if stats is None:
+        stats = {}
     validate_input(input)
 
     data = input['metadata']
 
     resource_id = data['resource_id']
     api_key = input.get('api_key')
+    started = datetime.datetime.utcnow().isoformat()
     try:
         resource, dataset = get_resource_and_dataset(resource_id, api_key)
     except (JobError, ObjectNotFound):
         # try again in 5 seconds just in case CKAN is slow at adding resource
         time.sleep(5)
+        started = datetime.datetime.utcnow().isoformat()
         resource, dataset = get_resource_and_dataset(resource_id, api_key)
+    # This loads the resource as it is now, which includes any changes made
+    # while the job was queued, so xloader_hook only needs to load it again
+    # if it is changed after this
+    data['task_created'] = started
+    data['original_url'] = resource.get('url')
     resource_ckan_url = '/dataset/{}/resource/{}' \
         .format(dataset['name'], resource['id'])
     logger.info('Express Load starting: %s', resource_ckan_url)
@@ -263,8 +521,10 @@ def xloader_data_into_datastore_(input, job_dict, logger):
         return
 
     # download resource
-    tmp_file, file_hash = _download_resource_data(resource, data, api_key,
-                                                  logger)
+    with record_stage(stats, 'download') as stage:
+        tmp_file, file_hash = _download_resource_data(resource, data, api_key,
+                                                      logger)
+        stage['bytes'] = os.path.getsize(tmp_file.name)
 
     try:
         if (resource.get('hash') == file_hash
@@ -273,6 +533,7 @@ def xloader_data_into_datastore_(input, job_dict, logger):
                         '{hash}.'.format(hash=file_hash))
             return
         logger.info('File hash: %s', file_hash)
+        prefix_length = _get_appendable_prefix_length(resource, tmp_file, data, logger)
         resource['hash'] = file_hash
 
         def direct_load(allow_type_guessing=False):
@@ -281,39 +542,78 @@ def xloader_data_into_datastore_(input, job_dict, logger):
                 resource_id=resource['id'],
                 mimetype=resource.get('format'),
                 allow_type_guessing=allow_type_guessing,
-                logger=logger)
-            loader.calculate_record_count(
-                resource_id=resource['id'], logger=logger)
-            set_datastore_active(data, resource, logger)
+                logger=logger,
+                file_hash=file_hash if resumable_loads else None,
+                stats=stats)
+            calculate_record_count(resource_id=resource['id'], logger=logger, stats=stats)
+            data['datastore_row_count'] = stats['rows']
+            with record_stage(stats, 'set_datastore_active'):
+                set_datastore_active(data, resource, logger)
             if 'result_url' in input:
                 job_dict['status'] = 'running_but_viewable'
-                callback_xloader_hook(result_url=input['result_url'],
-                                      api_key=api_key,
-                                      job_dict=job_dict)
+                with record_stage(stats, 'callback'):
+                    callback_xloader_hook(result_url=input['result_url'],
+                                          api_key=api_key,
+                                          job_dict=job_dict)
             logger.info('Data now available to users: %s', resource_ckan_url)
-            loader.create_column_indexes(
-                fields=fields,
-                resource_id=resource['id'],
-                logger=logger)
-            update_resource(resource={'id': resource['id'], 'hash': resource['hash']},
-                            patch_only=True)
+            with loader.stage_slot('indexes', logger), \
+                    record_stage(stats, 'indexes', rows=stats['rows']):
+                loader.create_column_indexes(
+                    fields=fields,
+                    resource_id=resource['id'],
+                    logger=logger)
+            with record_stage(stats, 'update_resource'):
+                update_resource(resource=_get_hash_patch(resource, data, tmp_file),
+                                patch_only=True)
             logger.info('File Hash updated for resource: %s', resource['hash'])
+            if resumable_loads:
+                db.delete_checkpoint(resource['id'])
+
+        def append_load():
+            try:
+                loader.append_csv(
+                    tmp_file.name,
+                    resource_id=resource['id'],
+                    offset=prefix_length,
+                    mimetype=resource.get('format'),
+                    logger=logger,
+                    stats=stats)
+            except (JobError, LoaderError) as e:
+                logger.warning('Appending the new rows failed: %s', e)
+                logger.info('Trying again with a full load')
+                return False
+            calculate_record_count(resource_id=resource['id'], logger=logger, stats=stats)
+            try:
+                data['datastore_row_count'] = int(resource['datastore_row_count']) + stats['rows']
+            except (KeyError, TypeError, ValueError):
+                # not recorded by the previous load, so unknown without counting
+                data['datastore_row_count'] = ''
+            with record_stage(stats, 'set_datastore_active'):
+                set_datastore_active(data, resource, logger)
+            with record_stage(stats, 'update_resource'):
+                update_resource(resource=_get_hash_patch(resource, data, tmp_file),
+                                patch_only=True)
+            logger.info('File Hash updated for resource: %s', resource['hash'])
+            return True
 
         def tabulator_load():
             try:
                 loader.load_table(tmp_file.name,
                                   resource_id=resource['id'],
                                   mimetype=resource.get('format'),
-                                  logger=logger)
+                                  logger=logger,
+                                  stats=stats)
             except JobError as e:
                 logger.error('Error during tabulator load: %s', e)
                 raise
-            loader.calculate_record_count(
-                resource_id=resource['id'], logger=logger)
-            set_datastore_active(data, resource, logger)
+            calculate_record_count(resource_id=resource['id'], logger=logger, stats=stats)
+            data['datastore_row_count'] = stats['rows']
+            with record_stage(stats, 'set_datastore_active'):
+                set_datastore_active(data, resource, logger)
             logger.info('Finished loading with tabulator')
-            update_resource(resource={'id': resource['id'], 'hash': resource['hash']},
-                            patch_only=True)
+            with record_stage(stats, 'update_resource'):
+                update_resource(resource={'id': resource['id'], 'hash': resource['hash']},
+                                patch_only=True)
             logger.info('File Hash updated for resource: %s', resource['hash'])
 
         # Load it
@@ -327,7 +627,9 @@ def xloader_data_into_datastore_(input, job_dict, logger):
             and os.path.getsize(tmp_file.name) <= max_type_guessing_length
         logger.info("'use_type_guessing' mode is: %s", use_type_guessing)
         try:
-            if use_type_guessing:
+            if prefix_length and append_load():
+                logger.info('Finished appending the new rows')
+            elif use_type_guessing:
                 try:
                     tabulator_load()
                 except JobError as e:
@@ -340,10 +642,17 @@ def xloader_data_into_datastore_(input, job_dict, logger):
                 except (JobError, LoaderError) as e:
                     logger.warning('Load using COPY failed: %s', e)
                     logger.info('Trying again with tabulator')
+                    if resumable_loads:
+                        db.delete_checkpoint(resource['id'])
                     tabulator_load()
         except JobTimeoutException:
-            logger.warning('Job timed out after %ss', retried_job_timeout)
-            raise JobError('Job timed out after {}s'.format(retried_job_timeout))
+            timeout = _job_timeout()
+            logger.warning('Job timed out after %ss', timeout)
+            if resumable_loads:
+                # the retry continues from the last checkpoint, so it is
+                # worth making
+                raise XLoaderTimeoutError('Job timed out after {}s'.format(timeout))
+            raise JobError('Job timed out after {}s'.format(timeout))
         except FileCouldNotBeLoadedError as e:
             logger.warning('Loading excerpt for this format not supported.')
             logger.error('Loading file raised an error: %s', e)
@@ -354,6 +663,88 @@ def xloader_data_into_datastore_(input, job_dict, logger):
     logger.info('Express Load completed')
 
 
+def calculate_record_count(resource_id, logger, stats=None):
+    '''Runs ANALYZE on the table, so that the datastore has a row count
+    estimate for large tables. With ckanext.xloader.background_analyze it is
+    queued as a separate job, on the queue of the current job, rather than
+    holding up this one; the exact count is already on the resource.
+    '''
+    if not background_analyze:
+        with record_stage(stats, 'analyze'):
+            loader.calculate_record_count(resource_id=resource_id, logger=logger)
+        return
+    job = get_current_job()
+    enqueue_job(
+        analyze_datastore_table, [resource_id],
+        title="xloader ANALYZE: resource {}".format(resource_id),
+        queue=remove_queue_name_prefix(job.origin) if job else None)
+    logger.info('Queued ANALYZE of the table')
+
+
+def analyze_datastore_table(resource_id):
+    '''Job queued by calculate_record_count.'''
+    loader.calculate_record_count(resource_id=resource_id, logger=log)
+
+
+def _get_appendable_prefix_length(resource, tmp_file, data, logger):
+    '''Returns the length of the previously loaded file, if the new download
+    starts with exactly that file and so only its tail needs loading.
+    Otherwise returns None and the file gets a full load.
+
+    The previous file is identified by the 'xloader_loaded_bytes' and 'hash'
+    that a full COPY load stores on the resource.
+    '''
+    if not append_only_loads:
+        return None
+    if not data.get('datastore_contains_all_records_of_source_file', True):
+        return None
+    try:
+        prefix_length = int(resource.get('xloader_loaded_bytes') or 0)
+    except ValueError:
+        return None
+    if not prefix_length or not resource.get('hash'):
+        return None
+    if os.path.getsize(tmp_file.name) <= prefix_length:
+        return None
+    if not datastore_resource_exists(resource['id']):
+        return None
+
+    m = hashlib.md5(usedforsecurity=False)
+    last_chunk = b''
+    remaining = prefix_length
+    with open(tmp_file.name, 'rb') as f:
+        while remaining:
+            last_chunk = f.read(min(CHUNK_SIZE, remaining))
+            m.update(last_chunk)
+            remaining -= len(last_chunk)
+    if m.hexdigest() != resource['hash']:
+        logger.info('File does not start with the previously loaded data, '
+                    'so it will be fully reloaded')
+        return None
+    if not last_chunk.endswith(b'\n'):
+        logger.info('Previously loaded data did not end with a line break, '
+                    'so the file will be fully reloaded')
+        return None
+    logger.info('File starts with the %s previously loaded, '
+                'so only the new rows will be loaded',
+                printable_file_size(prefix_length))
+    return prefix_length
+
+
+def _get_hash_patch(resource, data, tmp_file):
+    '''Returns the resource patch recording the file that has been loaded.
+    In append-only mode this includes its length, so that the next load can
+    check whether the new file just adds rows to it.
+    '''
+    patch = {'id': resource['id'], 'hash': resource['hash']}
+    if append_only_loads:
+        if data.get('datastore_contains_all_records_of_source_file', True):
+            patch['xloader_loaded_bytes'] = os.path.getsize(tmp_file.name)
+        else:
+            patch['xloader_loaded_bytes'] = ''
+    return patch
+
+
 def _download_resource_data(resource, data, api_key, logger):
     '''Downloads the resource['url'] as a tempfile.
 
@@ -449,7 +840,8 @@ def _download_resource_data(resource, data, api_key, logger):
         raise HTTPError(
             "Xloader received a bad HTTP response when trying to download "
             "the data file", status_code=error.response.status_code,
-            request_url=url, response=error)
+            request_url=url, response=error,
+            retry_after=parse_retry_after(error.response.headers.get('Retry-After')))
     except requests.exceptions.Timeout:
         logger.warning('URL time out after %ss', DOWNLOAD_TIMEOUT)
         raise XLoaderTimeoutError('Connection timed out after {}s'.format(
@@ -466,8 +858,9 @@ def _download_resource_data(resource, data, api_key, logger):
             request_url=url, response=None)
     except JobTimeoutException:
         cleanup_temp_file(tmp_file)
-        logger.warning('Job timed out after %ss', retried_job_timeout)
-        raise JobError('Job timed out after {}s'.format(retried_job_timeout))
+        timeout = _job_timeout()
+        logger.warning('Job timed out after %ss', timeout)
+        raise JobError('Job timed out after {}s'.format(timeout))
 
     logger.info('Downloaded ok - %s', printable_file_size(length))
     file_hash = m.hexdigest()
@@ -639,40 +1032,83 @@ def check_response(response, request_url, who, good_status=(201, 200),
                         reason=response.reason, url=request_url)
                 raise HTTPError(
                     message, status_code=response.status_code,
-                    request_url=request_url, response=response.text)
+                    request_url=request_url, response=response.text,
+                    retry_after=parse_retry_after(response.headers.get('Retry-After')))
     except ValueError:
         message = message.format(
             who=who, code=response.status_code, reason=response.reason,
             url=request_url, resp=response.text[:200])
         raise HTTPError(
             message, status_code=response.status_code, request_url=request_url,
-            response=response.text)
+            response=response.text,
+            retry_after=parse_retry_after(response.headers.get('Retry-After')))
+
 
+class StoringHandler(logging.handlers.BufferingHandler):
+    '''A handler that stores the logging records in a database.
 
-class StoringHandler(logging.Handler):
-    '''A handler that stores the logging records in a database.'''
-    def __init__(self, task_id, input):
-        logging.Handler.__init__(self)
+    Records are buffered and written with multi-row INSERTs: once `capacity`
+    records have built up, every `flush_interval` seconds (from a background
+    thread, once start_flushing has been called) and when the handler is
+    flushed or closed, which the job does when it finishes.
+    '''
+    def __init__(self, task_id, input, capacity=200, flush_interval=2.0):
+        logging.handlers.BufferingHandler.__init__(self, capacity)
         self.task_id = task_id
         self.input = input
+        self.flush_interval = flush_interval
+        self._stop_flushing = threading.Event()
+        self._flusher = None
+
+    def start_flushing(self):
+        '''Starts the thread that stores the records every flush_interval
+        seconds. The records refer to the job's row, so this waits until the
+        database is set up and the job added.'''
+        if not self.flush_interval or self._flusher:
+            return
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, args=(self.flush_interval,),
+            name='xloader-logs-{}'.format(self.task_id), daemon=True)
+        self._flusher.start()
 
     def emit(self, record):
-        with db.ENGINE.begin() as conn:
-            # Turn strings into unicode to stop SQLAlchemy
-            # "Unicode type received non-unicode bind param value" warnings.
-            message = str(record.getMessage())
-            level = str(record.levelname)
-            module = str(record.module)
-            funcName = str(record.funcName)
-
-            conn.execute(db.LOGS_TABLE.insert().values(
-                job_id=self.task_id,
-                timestamp=datetime.datetime.utcnow(),
-                message=message,
-                level=level,
-                module=module,
-                funcName=funcName,
-                lineno=record.lineno))
+        # Turn strings into unicode to stop SQLAlchemy
+        # "Unicode type received non-unicode bind param value" warnings.
+        # The message is formatted now, while its arguments are unchanged.
+        self.buffer.append(dict(
+            job_id=self.task_id,
+            timestamp=datetime.datetime.utcnow(),
+            message=str(record.getMessage()),
+            level=str(record.levelname),
+            module=str(record.module),
+            funcName=str(record.funcName),
+            lineno=record.lineno))
+        if self.shouldFlush(record):
+            self.flush()
+
+    def flush(self):
+        # Hold the lock while writing, so batches are stored in order
+        self.acquire()
+        try:
+            if self.buffer:
+                with db.ENGINE.begin() as conn:
+                    conn.execute(db.LOGS_TABLE.insert(), self.buffer)
+                self.buffer = []
+        finally:
+            self.release()
+
+    def _flush_periodically(self, interval):
+        while not self._stop_flushing.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Could not store the logs of job %s', self.task_id)
+
+    def close(self):
+        self._stop_flushing.set()
+        if self._flusher:
+            self._flusher.join()
+        logging.handlers.BufferingHandler.close(self)
 
 
 class DatetimeJsonEncoder(json.JSONEncoder):
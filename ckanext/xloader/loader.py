@@ -1,12 +1,16 @@
 'Load a CSV into postgres'
 from __future__ import absolute_import
 
+import contextlib
 import datetime
 from enum import Enum
 import itertools
+import random
 from six import text_type as str, binary_type
 import os
 import tempfile
+import time
+import zlib
 from decimal import Decimal
 
 import psycopg2
@@ -18,10 +22,11 @@ import sqlalchemy as sa
 
 import ckan.plugins as p
 
+from . import binary_copy, db
 from .interfaces import IXloader
 from .job_exceptions import FileCouldNotBeLoadedError, LoaderError
 from .parser import CSV_SAMPLE_LINES, TypeConverter
-from .utils import cleanup_temp_file, datastore_resource_exists, headers_guess, type_guess
+from .utils import cleanup_temp_file, datastore_resource_exists, headers_guess, record_stage, type_guess
 
 
 def _notify_datastore_before_update(resource_id, existing_fields, new_headers):
@@ -53,6 +58,9 @@ tabulator_config.CSV_SAMPLE_LINES = CSV_SAMPLE_LINES
 
 SINGLE_BYTE_ENCODING = 'cp1252'
 
+# Seconds between attempts to get a slot of a stage (see stage_slot)
+STAGE_SLOT_POLL_INTERVAL = 1
+
 
 class FieldMatch(Enum):
     """ Enumerates the possible match results between existing and new fields.
@@ -161,7 +169,90 @@ def _clear_datastore_resource(resource_id):
         conn.execute(sa.text('TRUNCATE TABLE "{}" RESTART IDENTITY'.format(resource_id)))
 
 
-def copy_file(csv_filepath, engine, logger, resource_id, headers, delimiter):
+BULK_LOAD_PROFILES = ('none', 'freeze', 'unlogged')
+
+
+def _get_bulk_load_profile(logger):
+    profile = (config.get('ckanext.xloader.bulk_load_profile') or 'none').lower()
+    if profile not in BULK_LOAD_PROFILES:
+        logger.warning('Unknown bulk load profile "%s", using "none"', profile)
+        profile = 'none'
+    return profile
+
+
+def _tune_bulk_load_session(conn):
+    ''' Relax commit durability and raise work_mem, for the current
+    transaction only, so the pooled connection is left untouched.
+    '''
+    conn.execute(sa.text("SET LOCAL synchronous_commit = off"))
+    conn.execute(sa.text("SELECT set_config('work_mem', :work_mem, true)"),
+                 {'work_mem': str(config.get('ckanext.xloader.bulk_load_work_mem', '256MB'))})
+
+
+def _set_table_logged(engine, resource_id, logged):
+    with engine.begin() as conn:
+        conn.execute(sa.text("SET LOCAL lock_timeout = '15s'"))
+        conn.execute(sa.text('ALTER TABLE {} SET {}'.format(
+            identifier(resource_id), 'LOGGED' if logged else 'UNLOGGED')))
+
+
+@contextlib.contextmanager
+def stage_slot(stage, logger):
+    """ Holds one of the ckanext.xloader.db_slots.<stage> slots of a heavy
+    stage of the load ('copy', 'fulltext' or 'indexes') for the block,
+    waiting for one to be free. The slots are shared by all the workers
+    writing to the DataStore database, so the stage only runs in that many
+    jobs at once. Without the option, there is no limit.
+
+    A slot is a session-level Postgres advisory lock, taken on a connection
+    of its own, so the slot of a worker that dies is freed with its
+    connection.
+    """
+    slots = int(config.get('ckanext.xloader.db_slots.' + stage) or 0)
+    if not slots:
+        yield
+        return
+    # advisory locks are keyed by two int4s: the stage and the slot
+    lock_class = zlib.crc32('ckanext-xloader:{}'.format(stage).encode('utf-8')) & 0x7fffffff
+    connection = get_write_engine().connect()
+    slot = None
+    try:
+        started = time.time()
+        waiting = False
+        while slot is None:
+            for candidate in random.sample(range(slots), slots):
+                # commit straight away; the lock outlasts the transaction
+                with connection.begin():
+                    if connection.execute(
+                            sa.text('SELECT pg_try_advisory_lock(:lock_class, :slot)'),
+                            {'lock_class': lock_class, 'slot': candidate}).scalar():
+                        slot = candidate
+                        break
+            else:
+                if not waiting:
+                    logger.info('Waiting for one of the %s %s slots...', slots, stage)
+                    waiting = True
+                time.sleep(STAGE_SLOT_POLL_INTERVAL)
+        if waiting:
+            logger.info('...waited %.0f seconds for a %s slot', time.time() - started, stage)
+        yield
+    finally:
+        try:
+            if slot is not None:
+                with connection.begin():
+                    connection.execute(
+                        sa.text('SELECT pg_advisory_unlock(:lock_class, :slot)'),
+                        {'lock_class': lock_class, 'slot': slot})
+        except Exception:
+            # don't return a connection holding the lock to the pool
+            connection.invalidate()
+            raise
+        finally:
+            connection.close()
+
+
+def copy_file(csv_filepath, engine, logger, resource_id, headers, delimiter,
+              freeze=False, tune_session=False):
     # Options for loading into postgres:
     # 1. \copy - can't use as that is a psql meta-command and not accessible
     #    via psycopg2
@@ -178,6 +269,14 @@ def copy_file(csv_filepath, engine, logger, resource_id, headers, delimiter):
     #    the superuser issue. <-- picked
 
     with engine.begin() as conn:
+        if tune_session:
+            _tune_bulk_load_session(conn)
+        if freeze:
+            # COPY FREEZE is only allowed into a table that was created or
+            # truncated in the same transaction. The table is still empty,
+            # so truncating it here costs nothing.
+            conn.execute(sa.text("SET LOCAL lock_timeout = '15s'"))
+            conn.execute(sa.text('TRUNCATE TABLE "{}" RESTART IDENTITY'.format(resource_id)))
         cur = conn.connection.cursor()
         try:
             with open(csv_filepath, 'rb') as f:
@@ -188,13 +287,14 @@ def copy_file(csv_filepath, engine, logger, resource_id, headers, delimiter):
                         "COPY \"{resource_id}\" ({column_names}) "
                         "FROM STDIN "
                         "WITH (DELIMITER '{delimiter}', FORMAT csv, HEADER 1, "
-                        "      ENCODING '{encoding}');"
+                        "      ENCODING '{encoding}'{freeze});"
                         .format(
                             resource_id=resource_id,
                             column_names=', '.join(['"{}"'.format(h)
                                                     for h in headers]),
                             delimiter=delimiter,
                             encoding='UTF8',
+                            freeze=', FREEZE' if freeze else '',
                         ),
                         f)
                 except psycopg2.DataError as e:
@@ -204,11 +304,13 @@ def copy_file(csv_filepath, engine, logger, resource_id, headers, delimiter):
                     error_str = str(e)
                     logger.warning('%s: %s', resource_id, error_str)
                     raise LoaderError('Error during the load into PostgreSQL: {}'.format(error_str))
+            return cur.rowcount
         finally:
             cur.close()
 
 
-def split_copy_by_size(input_file, engine, logger, resource_id, headers, delimiter=',', max_size=1024**3, encoding='utf-8'):  # 1 Gigabyte
+def split_copy_by_size(input_file, engine, logger, resource_id, headers, delimiter=',', max_size=1024**3, encoding='utf-8',  # 1 Gigabyte
+                       bulk_load_profile='none', start_offset=0, checkpoint=None, stats=None):
     """
     Reads a CSV file, splits it into chunks of maximum size, and writes each chunk
     to PostgreSQL COPY command to load the data into a table.
@@ -220,46 +322,123 @@ def split_copy_by_size(input_file, engine, logger, resource_id, headers, delimit
         columns (list, optional): List of column names for the COPY command, matching the CSV header. Defaults to None.
         connection (str, optional): Connection string for the PostgreSQL database. Defaults to an empty string.
         delimiter (str, optional): Delimiter character used in the CSV file. Defaults to ','.
+        bulk_load_profile (str, optional): One of BULK_LOAD_PROFILES. With 'freeze'
+            the first chunk is copied with COPY FREEZE. Defaults to 'none'.
+        start_offset (int, optional): Byte offset of the first row to copy, to resume
+            an interrupted load. Defaults to 0, i.e. the whole file.
+        checkpoint (callable, optional): Called as checkpoint(byte_offset, rows) once
+            each chunk is committed, with the offset of the first row not copied yet
+            and the number of rows copied by this call so far.
+        stats (dict, optional): Gets a 'copy' stage (see record_stage) per chunk.
+
+    Returns:
+        int: The number of rows copied.
     """
-
+    tune_session = bulk_load_profile != 'none'
     chunk_count = 0
+    rows_copied = 0
     file_size = os.path.getsize(input_file)
     logger.info('Starting chunked processing for file size: %s bytes with chunk size: %s bytes', file_size, max_size)
-
-    with open(input_file, 'r', encoding=encoding) as infile:
+    if start_offset:
+        logger.info('Resuming from byte %s', start_offset)
+
+    def copy_chunk(position):
+        with stage_slot('copy', logger), \
+                record_stage(stats, 'copy', chunk=chunk_count,
+                             bytes=os.path.getsize(output_filename)) as stage:
+            rows = copy_file(output_filename, engine, logger, resource_id, headers, delimiter,
+                             freeze=bulk_load_profile == 'freeze' and chunk_count == 1 and not start_offset,
+                             tune_session=tune_session)
+            stage['rows'] = rows or 0
+        if checkpoint:
+            checkpoint(position, rows_copied + (rows or 0))
+        return rows or 0
+
+    # Read and write bytes, so that the offsets of the rows can be recorded
+    # in checkpoints and seeked to when resuming.
+    with open(input_file, 'rb') as infile:
         current_file = None
         output_filename = f'/tmp/output_{resource_id}.csv'
         header = False
+        position = 0
+        if start_offset:
+            infile.seek(start_offset)
+            position = start_offset
+            header = True
         for row in infile:
             if current_file is None or current_file.tell() >= max_size:
                 # Close previous file if necessary
                 if current_file:
+                    current_file.close()
                     chunk_count += 1
                     logger.debug('Before copying chunk %s: %s', chunk_count, output_filename)
-                    copy_file(output_filename, engine, logger, resource_id, headers, delimiter)
+                    rows_copied += copy_chunk(position)
                     logger.debug('Copied chunk %s: %s', chunk_count, output_filename)
-                    current_file.close()
                     header = True
 
-                current_file = open(output_filename, 'w')
+                current_file = open(output_filename, 'wb')
                 if header:
-                    current_file.write(delimiter.join(headers) + '\n')
+                    current_file.write((delimiter.join(headers) + '\n').encode(encoding))
             current_file.write(row)
+            position += len(row)
 
-        # Close the last file if open
+        # Close and copy the last file, if there were any rows left
         if current_file:
             current_file.close()
-
-        # Copy the last file
-        chunk_count += 1
-        logger.debug('Before copying final chunk %s: %s', chunk_count, output_filename)
-        copy_file(output_filename, engine, logger, resource_id, headers, delimiter)
-        logger.debug('Copied final chunk %s: %s', chunk_count, output_filename)
-        os.remove(output_filename)
+            chunk_count += 1
+            logger.debug('Before copying final chunk %s: %s', chunk_count, output_filename)
+            rows_copied += copy_chunk(position)
+            logger.debug('Copied final chunk %s: %s', chunk_count, output_filename)
+            os.remove(output_filename)
 
     logger.info('Completed chunked processing: %s chunks processed for file size %s bytes', chunk_count, file_size)
     if infile:
         cleanup_temp_file(infile)
+    return rows_copied
+
+
+def _get_max_id(engine, resource_id):
+    with engine.connect() as conn:
+        return conn.scalar(sa.text('SELECT max(_id) FROM {}'.format(identifier(resource_id)))) or 0
+
+
+def _get_load_checkpoint(resource_id, file_hash, logger):
+    '''Returns the checkpoint of an interrupted load of the same file into
+    this resource, if the table still matches it. Otherwise discards the
+    checkpoint and returns None.
+    '''
+    checkpoint = db.get_checkpoint(resource_id)
+    if not checkpoint:
+        return None
+    if checkpoint['file_hash'] != file_hash:
+        logger.info('Discarding the checkpoint of an earlier load of a different file')
+        db.delete_checkpoint(resource_id)
+        return None
+    engine = get_write_engine()
+    max_id = _get_max_id(engine, resource_id)
+    if max_id < checkpoint['max_id']:
+        # e.g. the table was UNLOGGED and the database restarted
+        logger.info('Discarding the checkpoint as rows it recorded are missing')
+        db.delete_checkpoint(resource_id)
+        return None
+    if max_id > checkpoint['max_id'] and checkpoint['stage'] == 'copy':
+        # A chunk was committed, but the job stopped before checkpointing it
+        with engine.begin() as conn:
+            conn.execute(sa.text('DELETE FROM {} WHERE _id > :max_id'.format(identifier(resource_id))),
+                         {'max_id': checkpoint['max_id']})
+    return checkpoint
+
+
+def _make_whitespace_stripping_iter(super_iter, fields):
+    def strip_white_space_iter():
+        for row in super_iter():
+            if len(row) == len(fields):
+                for _index, _cell in enumerate(row):
+                    # only strip white space if strip_extra_white is True
+                    if fields[_index].get('strip_extra_white', True) and isinstance(_cell, str):
+                        row[_index] = _cell.strip()
+            yield row
+    return strip_white_space_iter
 
 
 def _read_metadata(table_filepath, mimetype, logger):
@@ -314,15 +493,26 @@ def _read_existing_fields(resource_id):
         return (False, None, None, None)
 
 
-def load_csv(csv_filepath, resource_id, mimetype='text/csv', allow_type_guessing=False, logger=None):
+def load_csv(csv_filepath, resource_id, mimetype='text/csv', allow_type_guessing=False, logger=None,
+             file_hash=None, stats=None):
     '''Loads a CSV into DataStore. Does not create the indexes.
 
     allow_type_guessing: Whether to fall back to Tabulator type-guessing
     in the event that the resource already existed but its structure has
     changed.
+
+    file_hash: If given, progress is checkpointed in the jobs db, and a load
+    of the same file that was interrupted is resumed from its checkpoint.
+
+    stats: An optional dict, which gets the number of rows loaded ('rows'),
+    as counted by COPY, and the timings of the stages of the load ('stages',
+    see record_stage).
     '''
+    if stats is None:
+        stats = {}
 
-    file_format, decoding_result, header_offset, headers, stream = _read_metadata(csv_filepath, mimetype, logger)
+    with record_stage(stats, 'detect_encoding', bytes=os.path.getsize(csv_filepath)):
+        file_format, decoding_result, header_offset, headers, stream = _read_metadata(csv_filepath, mimetype, logger)
 
     # Get the list of rows to skip. The rows in the tabulator stream are
     # numbered starting with 1.
@@ -348,6 +538,7 @@ def load_csv(csv_filepath, resource_id, mimetype='text/csv', allow_type_guessing
 
     # get column info from existing table
     existing, existing_info, existing_fields, existing_fields_by_headers = _read_existing_fields(resource_id)
+    checkpoint = None
     if existing:
         # Column types are either set (overridden) in the Data Dictionary page
         # or default to text type (which is robust)
@@ -372,7 +563,12 @@ def load_csv(csv_filepath, resource_id, mimetype='text/csv', allow_type_guessing
         And if the fields have significantly changed, it may also fail.
         '''
         fields_match = _fields_match(fields, existing_fields, logger)
-        if fields_match == FieldMatch.EXACT_MATCH:
+        if file_hash and fields_match == FieldMatch.EXACT_MATCH:
+            checkpoint = _get_load_checkpoint(resource_id, file_hash, logger)
+        if checkpoint:
+            logger.info('Resuming the interrupted load of this file at its "%s" stage',
+                        checkpoint['stage'])
+        elif fields_match == FieldMatch.EXACT_MATCH:
             _notify_datastore_before_update(
                 resource_id=resource_id,
                 existing_fields=existing_fields,
@@ -407,91 +603,234 @@ def load_csv(csv_filepath, resource_id, mimetype='text/csv', allow_type_guessing
 
     logger.info('Fields: %s', fields)
 
-    def _make_whitespace_stripping_iter(super_iter):
-        def strip_white_space_iter():
-            for row in super_iter():
-                if len(row) == len(fields):
-                    for _index, _cell in enumerate(row):
-                        # only strip white space if strip_extra_white is True
-                        if fields[_index].get('strip_extra_white', True) and isinstance(_cell, str):
-                            row[_index] = _cell.strip()
-                yield row
-        return strip_white_space_iter
-
-    # encoding (and line ending?)- use chardet
-    # It is easier to reencode it as UTF8 than convert the name of the encoding
-    # to one that pgloader will understand.
-    logger.info('Ensuring character coding is UTF8')
+    if checkpoint and checkpoint['stage'] == 'indexes':
+        logger.info('The rows and search index were loaded by an earlier attempt')
+        stats['rows'] = checkpoint['rows_loaded']
+        return fields
+
+    progress = {key: checkpoint[key] if checkpoint else 0
+                for key in ('byte_offset', 'rows_loaded', 'max_id', 'fulltext_id')}
+    stats['rows'] = progress['rows_loaded']
+
+    def save_checkpoint(stage, **kwargs):
+        progress.update(kwargs)
+        db.save_checkpoint(resource_id, file_hash, stage, **progress)
+
+    from ckan import model
+
+    user = p.toolkit.get_action("get_site_user")({"ignore_auth": True}, {})
+    context = {'model': model, 'ignore_auth': True, "user": user["name"]}
+    data_dict = dict(
+        resource_id=resource_id,
+        fields=fields,
+    )
+    engine = get_write_engine()
+    bulk_load_profile = _get_bulk_load_profile(logger)
+    if bulk_load_profile != 'none':
+        logger.info('Using bulk load profile: %s', bulk_load_profile)
+
     f_write = tempfile.NamedTemporaryFile(suffix=file_format, delete=False)
     try:
-        save_args = {'target': f_write.name, 'format': 'csv', 'encoding': 'utf-8', 'delimiter': delimiter}
-        try:
-            with UnknownEncodingStream(csv_filepath, file_format, decoding_result,
-                                       skip_rows=skip_rows) as stream:
-                stream.iter = _make_whitespace_stripping_iter(stream.iter)
-                stream.save(**save_args)
-        except (EncodingError, UnicodeDecodeError):
-            with Stream(csv_filepath, format=file_format, encoding=SINGLE_BYTE_ENCODING,
-                        skip_rows=skip_rows) as stream:
-                stream.iter = _make_whitespace_stripping_iter(stream.iter)
-                stream.save(**save_args)
-        csv_filepath = f_write.name
-
-        # Create table
-        from ckan import model
-
-        user = p.toolkit.get_action("get_site_user")({"ignore_auth": True}, {})
-        context = {'model': model, 'ignore_auth': True, "user": user["name"]}
-        data_dict = dict(
-            resource_id=resource_id,
-            fields=fields,
-        )
-        data_dict['records'] = None  # just create an empty table
-        data_dict['force'] = True  # TODO check this - I don't fully
-        # understand read-only/datastore resources
+        if not checkpoint or checkpoint['stage'] == 'copy':
+            # encoding (and line ending?)- use chardet
+            # It is easier to reencode it as UTF8 than convert the name of the encoding
+            # to one that pgloader will understand.
+            # The result is the same on every attempt, so the byte offsets in
+            # checkpoints stay valid.
+            logger.info('Ensuring character coding is UTF8')
+            save_args = {'target': f_write.name, 'format': 'csv', 'encoding': 'utf-8', 'delimiter': delimiter}
+            with record_stage(stats, 'reencode', bytes=os.path.getsize(csv_filepath)):
+                try:
+                    with UnknownEncodingStream(csv_filepath, file_format, decoding_result,
+                                               skip_rows=skip_rows) as stream:
+                        stream.iter = _make_whitespace_stripping_iter(stream.iter, fields)
+                        stream.save(**save_args)
+                except (EncodingError, UnicodeDecodeError):
+                    with Stream(csv_filepath, format=file_format, encoding=SINGLE_BYTE_ENCODING,
+                                skip_rows=skip_rows) as stream:
+                        stream.iter = _make_whitespace_stripping_iter(stream.iter, fields)
+                        stream.save(**save_args)
+            csv_filepath = f_write.name
+
+        if not checkpoint:
+            # Create table
+            data_dict['records'] = None  # just create an empty table
+            data_dict['force'] = True  # TODO check this - I don't fully
+            # understand read-only/datastore resources
+            try:
+                p.toolkit.get_action('datastore_create')(context, data_dict)
+            except p.toolkit.ValidationError as e:
+                if 'fields' in e.error_dict:
+                    # e.g. {'message': None, 'error_dict': {'fields': [u'"***" is not a valid field name']}, '_error_summary': None}  # noqa
+                    error_message = e.error_dict['fields'][0]
+                    raise LoaderError('Error with field definition: {}'
+                                      .format(error_message))
+                else:
+                    raise LoaderError(
+                        'Validation error when creating the database table: {}'
+                        .format(str(e)))
+            except Exception as e:
+                raise LoaderError('Could not create the database table: {}'
+                                  .format(e))
+
+            # datastore_active is switched on by datastore_create
+            # TODO temporarily disable it until the load is complete
+
+            with engine.begin() as conn:
+                _disable_fulltext_trigger(conn, resource_id)
+
+            with engine.begin() as conn:
+                context['connection'] = conn
+                _drop_indexes(context, data_dict, False)
+
+        if bulk_load_profile == 'unlogged':
+            # Skip WAL for the COPY and the full text UPDATE; SET LOGGED
+            # writes the finished table to WAL once instead.
+            _set_table_logged(engine, resource_id, logged=False)
+
         try:
-            p.toolkit.get_action('datastore_create')(context, data_dict)
-        except p.toolkit.ValidationError as e:
-            if 'fields' in e.error_dict:
-                # e.g. {'message': None, 'error_dict': {'fields': [u'"***" is not a valid field name']}, '_error_summary': None}  # noqa
-                error_message = e.error_dict['fields'][0]
-                raise LoaderError('Error with field definition: {}'
-                                  .format(error_message))
-            else:
-                raise LoaderError(
-                    'Validation error when creating the database table: {}'
-                    .format(str(e)))
-        except Exception as e:
-            raise LoaderError('Could not create the database table: {}'
-                              .format(e))
+            if not checkpoint or checkpoint['stage'] == 'copy':
+                logger.info('Copying to database...')
+
+                # Copy file to datastore db, split to chunks.
+                max_size = config.get('ckanext.xloader.copy_chunk_size', 1024**3)
+                logger.debug('Using chunk size: %s bytes for resource %s', max_size, resource_id)
+                rows_before = progress['rows_loaded']
+
+                def copy_checkpoint(byte_offset, rows):
+                    save_checkpoint('copy', byte_offset=byte_offset, rows_loaded=rows_before + rows,
+                                    max_id=_get_max_id(engine, resource_id))
+                stats['rows'] += split_copy_by_size(
+                    csv_filepath, engine, logger, resource_id, headers, delimiter, int(max_size),
+                    bulk_load_profile=bulk_load_profile,
+                    start_offset=progress['byte_offset'],
+                    checkpoint=copy_checkpoint if file_hash else None,
+                    stats=stats)
+                logger.info('Copied %s rows', stats['rows'])
+
+                logger.info('...copying done')
+
+            logger.info('Creating search index...')
+            with stage_slot('fulltext', logger), \
+                    record_stage(stats, 'fulltext', rows=stats['rows']):
+                if file_hash:
+                    # Commit each chunk of the search index, so that it can be
+                    # resumed too
+                    with engine.connect() as conn:
+                        _populate_fulltext(
+                            conn, resource_id, fields=fields, logger=logger,
+                            first_id=progress['fulltext_id'], last_id=progress['max_id'],
+                            checkpoint=lambda fulltext_id: save_checkpoint('fulltext', fulltext_id=fulltext_id),
+                            tune_session=bulk_load_profile != 'none')
+                    save_checkpoint('indexes')
+                else:
+                    with engine.begin() as conn:
+                        if bulk_load_profile != 'none':
+                            _tune_bulk_load_session(conn)
+                        # The table was created or truncated with RESTART IDENTITY,
+                        # so the _ids run from 1 to the number of rows copied
+                        _populate_fulltext(conn, resource_id, fields=fields, logger=logger,
+                                           last_id=stats['rows'])
+            logger.info('...search index created')
+        finally:
+            if bulk_load_profile == 'unlogged':
+                _set_table_logged(engine, resource_id, logged=True)
+                logger.info('Table set back to LOGGED')
+    finally:
+        cleanup_temp_file(f_write)
 
-        # datastore_active is switched on by datastore_create
-        # TODO temporarily disable it until the load is complete
+    return fields
 
-        engine = get_write_engine()
-        with engine.begin() as conn:
-            _disable_fulltext_trigger(conn, resource_id)
 
+def append_csv(csv_filepath, resource_id, offset, mimetype='text/csv', logger=None, stats=None):
+    '''Appends the rows that follow the first ``offset`` bytes of a CSV to
+    the existing DataStore table, without truncating it. The rows already in
+    the table keep their full-text values and indexes; the new rows get theirs
+    from the table trigger and normal index maintenance.
+
+    The caller is responsible for checking that the first ``offset`` bytes
+    are exactly the file that was previously loaded, ending on a line break.
+
+    Raises LoaderError if there is no table to append to, or if the columns
+    have changed, in which case a full load is needed.
+
+    stats: An optional dict, which gets the number of rows appended ('rows')
+    and the timings of the stages ('stages', see record_stage).
+    '''
+    if stats is None:
+        stats = {}
+    with record_stage(stats, 'detect_encoding', bytes=os.path.getsize(csv_filepath)):
+        file_format, decoding_result, header_offset, headers, stream = _read_metadata(csv_filepath, mimetype, logger)
+
+    delimiter = stream.dialect.get('delimiter')
+    if delimiter is None:
+        logger.warning('Could not determine delimiter from file, use default ","')
+        delimiter = ','
+
+    headers = [
+        header.strip()[:MAX_COLUMN_LENGTH].strip()
+        for header in headers
+        if header and header.strip()
+    ]
+
+    existing, existing_info, existing_fields, existing_fields_by_headers = _read_existing_fields(resource_id)
+    if not existing:
+        raise LoaderError('No DataStore table to append to')
+    existing_ids = [f['id'] for f in existing_fields if f['id'] != '_id']
+    if len(headers) != len(existing_ids) or set(headers) != set(existing_ids):
+        raise LoaderError('Columns have changed since the last load, '
+                          'so the file cannot be appended')
+
+    fields = []
+    for header_name in headers:
+        field = dict(existing_fields_by_headers[header_name])
+        if 'strip_extra_white' in existing_info.get(header_name, {}):
+            field['strip_extra_white'] = existing_info[header_name]['strip_extra_white']
+        fields.append(field)
+
+    logger.info('Appending rows after byte %s of the file', offset)
+    f_tail = tempfile.NamedTemporaryFile(suffix=file_format, delete=False)
+    f_write = tempfile.NamedTemporaryFile(suffix=file_format, delete=False)
+    try:
+        with open(csv_filepath, 'rb') as f:
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                f_tail.write(chunk)
+        f_tail.close()
+
+        # The tail has no header row of its own, so give the stream the
+        # table's headers; they are written out first and skipped by COPY.
+        logger.info('Ensuring character coding is UTF8')
+        save_args = {'target': f_write.name, 'format': 'csv', 'encoding': 'utf-8', 'delimiter': delimiter}
+        skip_rows = [{'type': 'preset', 'value': 'blank'}]
+        with record_stage(stats, 'reencode', bytes=os.path.getsize(f_tail.name)):
+            try:
+                with UnknownEncodingStream(f_tail.name, file_format, decoding_result,
+                                           headers=headers, skip_rows=skip_rows) as stream:
+                    stream.iter = _make_whitespace_stripping_iter(stream.iter, fields)
+                    stream.save(**save_args)
+            except (EncodingError, UnicodeDecodeError):
+                with Stream(f_tail.name, format=file_format, encoding=SINGLE_BYTE_ENCODING,
+                            headers=headers, skip_rows=skip_rows) as stream:
+                    stream.iter = _make_whitespace_stripping_iter(stream.iter, fields)
+                    stream.save(**save_args)
+
+        engine = get_write_engine()
+        # The trigger is normally enabled once a load has completed, but make
+        # sure, as the appended rows are not re-indexed in bulk afterwards.
         with engine.begin() as conn:
-            context['connection'] = conn
-            _drop_indexes(context, data_dict, False)
+            _enable_fulltext_trigger(conn, resource_id)
 
         logger.info('Copying to database...')
-
-        # Copy file to datastore db, split to chunks.
         max_size = config.get('ckanext.xloader.copy_chunk_size', 1024**3)
-        logger.debug('Using chunk size: %s bytes for resource %s', max_size, resource_id)
-        split_copy_by_size(csv_filepath, engine, logger, resource_id, headers, delimiter, int(max_size))
+        stats['rows'] = split_copy_by_size(f_write.name, engine, logger, resource_id, headers, delimiter,
+                                           int(max_size), stats=stats)
     finally:
+        cleanup_temp_file(f_tail)
         cleanup_temp_file(f_write)
 
     logger.info('...copying done')
 
-    logger.info('Creating search index...')
-    with engine.begin() as conn:
-        _populate_fulltext(conn, resource_id, fields=fields, logger=logger)
-    logger.info('...search index created')
-
     return fields
 
 
@@ -524,14 +863,18 @@ def _save_type_overrides(headers_dicts):
                 h['info'] = {'type_override': h['type']}
 
 
-def load_table(table_filepath, resource_id, mimetype='text/csv', logger=None):
+def load_table(table_filepath, resource_id, mimetype='text/csv', logger=None, stats=None):
     '''Loads an Excel file (or other tabular data recognized by tabulator)
     into Datastore and creates indexes.
 
     Largely copied from datapusher - see below. Is slower than load_csv.
+
+    stats: An optional dict, which gets the number of rows loaded ('rows')
+    and the timings of the stages of the load ('stages', see record_stage).
     '''
 
-    file_format, decoding_result, header_offset, headers, stream = _read_metadata(table_filepath, mimetype, logger)
+    with record_stage(stats, 'detect_encoding', bytes=os.path.getsize(table_filepath)):
+        file_format, decoding_result, header_offset, headers, stream = _read_metadata(table_filepath, mimetype, logger)
 
     existing, existing_info, existing_fields, existing_fields_by_headers = _read_existing_fields(resource_id)
 
@@ -639,19 +982,28 @@ def load_table(table_filepath, resource_id, mimetype='text/csv', logger=None):
 
         logger.info('Copying to database...')
         count = 0
-        # Some types cannot be stored as empty strings and must be converted to None,
-        # https://github.com/ckan/ckanext-xloader/issues/182
-        non_empty_types = ['timestamp', 'numeric']
-        for i, records in enumerate(chunky(result, 250)):
-            count += len(records)
-            logger.info('Saving chunk %s', i)
-            for row in records:
-                for column_index, column_name in enumerate(row):
-                    if headers_dicts[column_index]['type'] in non_empty_types and row[column_name] == '':
-                        row[column_name] = None
-            send_resource_to_datastore(resource_id, headers_dicts, records)
+        # includes parsing and converting the rows, as they are streamed
+        with stage_slot('copy', logger), \
+                record_stage(stats, 'copy', bytes=os.path.getsize(table_filepath)) as stage:
+            if p.toolkit.asbool(config.get('ckanext.xloader.binary_copy', False)):
+                count = copy_records_binary(resource_id, headers_dicts, result, logger)
+            else:
+                # Some types cannot be stored as empty strings and must be converted to None,
+                # https://github.com/ckan/ckanext-xloader/issues/182
+                non_empty_types = ['timestamp', 'numeric']
+                for i, records in enumerate(chunky(result, 250)):
+                    count += len(records)
+                    logger.info('Saving chunk %s', i)
+                    for row in records:
+                        for column_index, column_name in enumerate(row):
+                            if headers_dicts[column_index]['type'] in non_empty_types and row[column_name] == '':
+                                row[column_name] = None
+                    send_resource_to_datastore(resource_id, headers_dicts, records)
+            stage['rows'] = count
         logger.info('...copying done')
 
+    if stats is not None:
+        stats['rows'] = count
     if count:
         logger.info('Successfully pushed %s entries to "%s".', count, resource_id)
     else:
@@ -727,6 +1079,50 @@ def send_resource_to_datastore(resource_id, headers, records):
                           .format(str(e)))
 
 
+def copy_records_binary(resource_id, headers, records, logger):
+    """
+    Creates the datastore table and streams records (dicts keyed by column
+    name) into it with a binary COPY, so that the values that have already
+    been converted to numbers and timestamps aren't sent as text to be parsed
+    again. Empty strings in numeric and timestamp columns are stored as NULL,
+    as send_resource_to_datastore's callers do.
+
+    Returns the number of records copied. No table is created if there are
+    none.
+    """
+    first_record = next(records, None)
+    if first_record is None:
+        return 0
+    send_resource_to_datastore(resource_id, headers, None)
+
+    column_names = [h['id'] for h in headers]
+    rows = ([record.get(name) for name in column_names]
+            for record in itertools.chain([first_record], records))
+    stream = binary_copy.BinaryCopyStream(rows, [h['type'] for h in headers])
+    engine = get_write_engine()
+    with engine.begin() as conn:
+        cur = conn.connection.cursor()
+        try:
+            cur.copy_expert(
+                'COPY {} ({}) FROM STDIN (FORMAT binary)'.format(
+                    identifier(resource_id),
+                    ', '.join(identifier(name) for name in column_names)),
+                stream)
+            count = cur.rowcount
+        except (psycopg2.Error, ArithmeticError, TypeError, ValueError) as e:
+            if stream.error is not None:
+                raise LoaderError('Could not encode a value for binary COPY: {!r}'.format(stream.error))
+            if not isinstance(e, psycopg2.DataError):
+                raise
+            error_str = str(e)
+            logger.warning('%s: %s', resource_id, error_str)
+            raise LoaderError('Error during the load into PostgreSQL: {}'.format(error_str))
+        finally:
+            cur.close()
+    logger.info('Copied %s rows with binary COPY', count)
+    return count
+
+
 def delete_datastore_resource(resource_id):
     from ckan import model
     context = {'model': model, 'user': '', 'ignore_auth': True}
@@ -783,7 +1179,8 @@ def _get_rows_count_of_resource(connection, table):
     return rows_count or 0
 
 
-def _populate_fulltext(connection, resource_id, fields, logger):
+def _populate_fulltext(connection, resource_id, fields, logger, first_id=0, last_id=None,
+                       checkpoint=None, tune_session=False):
     '''Populates the _full_text column for full-text search functionality.
 
     This function creates a PostgreSQL tsvector (text search vector) for each row
@@ -807,18 +1204,29 @@ def _populate_fulltext(connection, resource_id, fields, logger):
         fields (list): List of dicts with column 'id' (name) and 'type'
             (text/numeric/timestamp)
         logger: Logger instance for progress tracking
+        first_id (int): The _id to start from, when resuming
+        last_id (int): The highest _id to index. Defaults to the row count.
+        checkpoint (callable): If given, each chunk is committed in its own
+            transaction (so connection must not be in one) and then
+            checkpoint(end) is called with the _id the chunk went up to. A
+            chunk that fails is then raised rather than skipped.
+        tune_session (bool): Apply the bulk load session settings to each
+            chunk's transaction, when checkpointing.
 
     Note:
         This reimplements CKAN's text indexing logic for performance,
         breaking DRY principle but providing significant speed improvements.
     '''
-    try:
-        # Get total row count to determine chunking strategy
-        rows_count = _get_rows_count_of_resource(connection, resource_id)
-    except Exception as e:
-        rows_count = ''
-        logger.info("Failed to get resource rows count: {} ".format(str(e)))
-        raise
+    if last_id is not None:
+        rows_count = last_id
+    else:
+        try:
+            # Get total row count to determine chunking strategy
+            rows_count = _get_rows_count_of_resource(connection, resource_id)
+        except Exception as e:
+            rows_count = ''
+            logger.info("Failed to get resource rows count: {} ".format(str(e)))
+            raise
 
     if rows_count:
         # Configure chunk size - prevents timeouts and memory issues on large datasets
@@ -827,7 +1235,7 @@ def _populate_fulltext(connection, resource_id, fields, logger):
 
         # Process table in chunks using _id range queries
         # This approach ensures consistent chunk sizes and allows resuming if interrupted
-        for start in range(0, rows_count, chunks):
+        for start in range(first_id, rows_count, chunks):
             try:
                 # Build SQL to update _full_text column with concatenated searchable content
                 sql = sa.text(
@@ -849,13 +1257,24 @@ def _populate_fulltext(connection, resource_id, fields, logger):
                         first=start,
                         end=start + chunks
                     ))
-                connection.execute(sql)
+                if checkpoint:
+                    with connection.begin():
+                        if tune_session:
+                            _tune_bulk_load_session(connection)
+                        connection.execute(sql)
+                    checkpoint(start + chunks)
+                else:
+                    connection.execute(sql)
                 logger.info("Indexed rows {first} to {end} of {total}".format(
                     first=start, end=min(start + chunks, rows_count), total=rows_count))
             except Exception as e:
-                # Log chunk-specific errors but continue processing remaining chunks
                 logger.error("Failed to index rows {first}-{end}: {error}".format(
                     first=start, end=start + chunks, error=str(e)))
+                if checkpoint:
+                    # a later chunk's checkpoint would skip these rows when
+                    # the job is resumed
+                    raise
+                # otherwise carry on with the remaining chunks
 
 
 def calculate_record_count(resource_id, logger):
@@ -863,10 +1282,18 @@ def calculate_record_count(resource_id, logger):
     Calculate an estimate of the record/row count and store it in
     Postgresql's pg_stat_user_tables. This number will be used when
     specifying `total_estimation_threshold`
+
+    ANALYZE samples 300 x the statistics target rows, so a lower
+    'ckanext.xloader.analyze_statistics_target' makes it quicker on big
+    tables, at the cost of rougher statistics.
     '''
     logger.info('Calculating record count (running ANALYZE on the table)')
+    statistics_target = config.get('ckanext.xloader.analyze_statistics_target')
     engine = get_write_engine()
-    with engine.connect() as conn:
+    with engine.begin() as conn:
+        if statistics_target:
+            conn.execute(sa.text("SET LOCAL default_statistics_target = {:d}"
+                                 .format(int(statistics_target))))
         conn.execute(sa.text("ANALYZE \"{resource_id}\";"
                          .format(resource_id=resource_id)))
 
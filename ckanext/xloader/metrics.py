@@ -0,0 +1,155 @@
+# encoding: utf-8
+'''Metrics of the xloader jobs, in the Prometheus text exposition format.
+
+The workers record them in the CKAN Redis, so that the counts from all of
+them are added up, and the ``/xloader/metrics`` endpoint (see
+``ckanext.xloader.metrics_enabled``) reads them back, along with the current
+depth of the xloader queues.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+'''
+import logging
+import math
+import re
+
+from ckan.lib.jobs import get_queue
+from ckan.lib.redis import connect_to_redis
+
+log = logging.getLogger(__name__)
+
+REDIS_KEY = 'ckanext-xloader:metrics'
+
+# Upper bounds of the stage duration histogram buckets, in seconds
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, float('inf'))
+
+# name: (type, help)
+METRICS = {
+    'xloader_jobs_total': ('counter', 'Finished xloader jobs, by outcome.'),
+    'xloader_retries_total': ('counter', 'Jobs queued again after a temporary error.'),
+    'xloader_downloaded_bytes_total': ('counter', 'Bytes downloaded from resource URLs.'),
+    'xloader_loaded_rows_total': ('counter', 'Rows loaded into the DataStore.'),
+    'xloader_stage_duration_seconds': ('histogram', 'Duration of the stages of the jobs.'),
+    'xloader_jobs_in_progress': ('gauge', 'Jobs being run by the workers, by queue.'),
+    'xloader_queue_depth': ('gauge', 'Jobs waiting in each xloader queue.'),
+}
+
+
+def sample_name(name, labels=None):
+    '''Returns a sample's name with its labels, as written in the
+    exposition format, e.g. ``xloader_jobs_total{outcome="error"}``.'''
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join(
+        '{}="{}"'.format(key, _escape_label(value))
+        for key, value in sorted(labels.items())))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(samples):
+    '''Returns the samples in the Prometheus text exposition format.
+
+    :param samples: the value of each sample, by sample name (see
+        sample_name)
+    :type samples: dict
+    '''
+    by_metric = {}
+    for sample, value in samples.items():
+        name = sample.split('{', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                name = name[:-len(suffix)]
+        by_metric.setdefault(name, []).append((sample, value))
+
+    lines = []
+    for name in sorted(by_metric):
+        type_, help_ = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+        for sample, value in sorted(by_metric[name], key=lambda item: _sort_key(item[0])):
+            lines.append('{} {}'.format(sample, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _sort_key(sample):
+    # the buckets of each histogram in increasing order, then _sum and _count
+    match = re.search(r'le="([^"]*)",?', sample)
+    if match:
+        le = match.group(1)
+        return (0, sample.replace(match.group(0), ''), math.inf if le == '+Inf' else float(le))
+    return (1, sample, 0)
+
+
+def job_finished(outcome, stats):
+    '''Records a finished job: its outcome ('complete', 'error' or
+    'retried'), and the bytes, rows and stage timings in its stats (see
+    utils.record_stage).'''
+    increments = {
+        sample_name('xloader_jobs_total', {'outcome': outcome}): 1,
+    }
+    if outcome == 'retried':
+        increments[sample_name('xloader_retries_total')] = 1
+    if stats.get('rows'):
+        increments[sample_name('xloader_loaded_rows_total')] = stats['rows']
+    for stage in stats.get('stages', []):
+        if stage['name'] == 'download' and stage.get('bytes'):
+            _add(increments, sample_name('xloader_downloaded_bytes_total'), stage['bytes'])
+        labels = {'stage': stage['name']}
+        for bound in STAGE_BUCKETS:
+            if stage['seconds'] <= bound:
+                _add(increments, sample_name('xloader_stage_duration_seconds_bucket',
+                                             dict(labels, le=_format_value(bound))), 1)
+        _add(increments, sample_name('xloader_stage_duration_seconds_sum', labels), stage['seconds'])
+        _add(increments, sample_name('xloader_stage_duration_seconds_count', labels), 1)
+    _update(increments)
+
+
+def _add(increments, sample, value):
+    increments[sample] = increments.get(sample, 0) + value
+
+
+def _update(increments):
+    try:
+        pipeline = connect_to_redis().pipeline()
+        for sample, value in increments.items():
+            if isinstance(value, float):
+                pipeline.hincrbyfloat(REDIS_KEY, sample, value)
+            else:
+                pipeline.hincrby(REDIS_KEY, sample, value)
+        pipeline.execute()
+    except Exception:
+        log.exception('Could not record xloader metrics')
+
+
+def collect(queue_names):
+    '''Returns the recorded samples, and the depth and the jobs in progress
+    of the given queues.'''
+    samples = {
+        sample.decode('utf-8') if isinstance(sample, bytes) else sample: float(value)
+        for sample, value in connect_to_redis().hgetall(REDIS_KEY).items()
+    }
+    # the counter that earlier versions kept, which killed jobs left too high
+    samples.pop(sample_name('xloader_jobs_in_progress'), None)
+    for queue_name in queue_names:
+        queue = get_queue(queue_name)
+        labels = {'queue': queue_name}
+        samples[sample_name('xloader_queue_depth', labels)] = queue.count
+        # RQ drops the jobs of dead workers from the registry once they time out
+        samples[sample_name('xloader_jobs_in_progress', labels)] = \
+            queue.started_job_registry.count
+    return samples
+
+
+def reset():
+    '''Deletes the recorded metrics.'''
+    connect_to_redis().delete(REDIS_KEY)
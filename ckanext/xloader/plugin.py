@@ -85,11 +85,26 @@ class xloaderPlugin(plugins.SingletonPlugin):
         )
         jobs.max_excerpt_lines = int(config_.get('ckanext.xloader.max_excerpt_lines') or 0)
         jobs.max_retries = int(config_.get('ckanext.xloader.max_retries', 1))
+        jobs.append_only_loads = toolkit.asbool(config_.get('ckanext.xloader.append_only_loads', False))
+        jobs.resumable_loads = toolkit.asbool(config_.get('ckanext.xloader.resumable_loads', False))
+        jobs.background_analyze = toolkit.asbool(config_.get('ckanext.xloader.background_analyze', False))
+        jobs.purge_interval = float(config_.get('ckanext.xloader.jobs_db.purge_interval') or 0)
+        jobs.metrics_enabled = toolkit.asbool(config_.get('ckanext.xloader.metrics_enabled', False))
         # Retries can only occur in cases where the datastore entry exists,
         # so use the standard timeout
         jobs.retried_job_timeout = config_.get('ckanext.xloader.job_timeout', '3600')
+        jobs.retry_backoff = float(config_.get('ckanext.xloader.retry_backoff') or 0)
+        jobs.retry_backoff_max = float(config_.get('ckanext.xloader.retry_backoff_max') or 0)
         jobs.apitoken_header_name = config_.get('apitoken_header_name', 'Authorization')
         jobs.default_queue_names = config_.get('ckanext.xloader.queue_names', DEFAULT_QUEUE_NAME).split()
+        jobs.queue_depth_aware = toolkit.asbool(config_.get('ckanext.xloader.queue_depth_aware', False))
+        jobs.large_file_size = int(config_.get('ckanext.xloader.large_file_size') or 0)
+        jobs.large_file_queue_names = config_.get(
+            'ckanext.xloader.large_file_queue_names', 'xloader_large').split()
+        jobs.large_file_job_timeout = config_.get('ckanext.xloader.large_file_job_timeout', '10800')
+        jobs.large_file_head_request = toolkit.asbool(
+            config_.get('ckanext.xloader.large_file_head_request', False))
+        jobs.fair_share_enabled = toolkit.asbool(config_.get('ckanext.xloader.fair_share', False))
 
     # IPipeValidation
 
@@ -247,6 +262,8 @@ class xloaderPlugin(plugins.SingletonPlugin):
             "xloader_submit": action.xloader_submit,
             "xloader_hook": action.xloader_hook,
             "xloader_status": action.xloader_status,
+            "xloader_submit_many": action.xloader_submit_many,
+            "xloader_status_bulk": action.xloader_status_bulk,
         }
 
     # IAuthFunctions
@@ -255,6 +272,9 @@ class xloaderPlugin(plugins.SingletonPlugin):
         return {
             "xloader_submit": auth.xloader_submit,
             "xloader_status": auth.xloader_status,
+            "xloader_submit_many": auth.xloader_submit_many,
+            "xloader_status_bulk": auth.xloader_status_bulk,
+            "xloader_metrics": auth.xloader_metrics,
         }
 
     # ITemplateHelpers
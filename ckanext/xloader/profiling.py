@@ -0,0 +1,52 @@
+# encoding: utf-8
+'''Profiling of single jobs, requested with the 'profile' and
+'profile_memory' options of xloader_submit. Nothing here runs otherwise.'''
+import contextlib
+import cProfile
+import io
+import pstats
+import tracemalloc
+
+# Number of functions / allocation sites reported
+PROFILE_LIMIT = 50
+MEMORY_PROFILE_LIMIT = 25
+
+
+@contextlib.contextmanager
+def profiled(memory=False):
+    '''Runs the block under cProfile, and with memory=True under tracemalloc
+    too. Yields a dict which, once the block has finished (or failed), has the
+    text reports as 'profile_report' (functions by cumulative time) and
+    'memory_profile_report' (the lines that allocated the most memory that
+    is still held, and the peak).
+    '''
+    results = {}
+    trace_memory = memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield results
+    finally:
+        profiler.disable()
+        if memory:
+            results['memory_profile_report'] = _memory_report()
+            if trace_memory:
+                tracemalloc.stop()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LIMIT)
+        results['profile_report'] = out.getvalue()
+
+
+def _memory_report():
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['Traced memory: current {:.1f} MiB, peak {:.1f} MiB'.format(
+        current / 1024 ** 2, peak / 1024 ** 2), '']
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    for stat in snapshot.statistics('lineno')[:MEMORY_PROFILE_LIMIT]:
+        lines.append(str(stat))
+    return '\n'.join(lines) + '\n'
@@ -16,6 +16,10 @@ int_validator = get_validator('int_validator')
 OneOf = get_validator('OneOf')
 ignore_not_sysadmin = get_validator('ignore_not_sysadmin')
 unicode_safe = get_validator('unicode_safe')
+natural_number_validator = get_validator('natural_number_validator')
+isodate = get_validator('isodate')
+convert_to_list_if_string = get_validator('convert_to_list_if_string')
+list_of_strings = get_validator('list_of_strings')
 
 
 def xloader_submit_schema():
@@ -25,7 +29,39 @@ def xloader_submit_schema():
         'set_url_type': [ignore_missing, boolean_validator],
         'ignore_hash': [ignore_missing, boolean_validator],
         'sync': [ignore_missing, boolean_validator, ignore_not_sysadmin],
+        'profile': [ignore_missing, boolean_validator, ignore_not_sysadmin],
+        'profile_memory': [ignore_missing, boolean_validator, ignore_not_sysadmin],
         '__junk': [empty],
         '__before': [dsschema.rename('id', 'resource_id')]
     }
     return schema
+
+
+def xloader_submit_many_schema():
+    schema = {
+        'resource_ids': [not_missing, convert_to_list_if_string, list_of_strings],
+        'set_url_type': [ignore_missing, boolean_validator],
+        'ignore_hash': [ignore_missing, boolean_validator],
+        'queue': [ignore_missing, unicode_safe],
+        'profile': [ignore_missing, boolean_validator, ignore_not_sysadmin],
+        'profile_memory': [ignore_missing, boolean_validator, ignore_not_sysadmin],
+        '__junk': [empty],
+    }
+    return schema
+
+
+def xloader_status_schema():
+    schema = {
+        'resource_id': [not_missing, not_empty, unicode_safe],
+        'logs_limit': [ignore_missing, natural_number_validator],
+        'logs_offset': [ignore_missing, int_validator],
+        'logs_since': [ignore_missing, isodate],
+    }
+    return schema
+
+
+def xloader_status_bulk_schema():
+    schema = {
+        'resource_ids': [not_missing, convert_to_list_if_string, list_of_strings],
+    }
+    return schema
@@ -1,3 +1,6 @@
+import datetime
+import json
+
 import pytest
 from ckan.plugins import toolkit
 try:
@@ -8,6 +11,7 @@ except ImportError:
 from ckan.plugins.toolkit import NotAuthorized
 from ckan.tests import helpers, factories
 
+from ckanext.xloader import db, jobs
 from ckanext.xloader.utils import get_xloader_user_apitoken
 
 
@@ -39,7 +43,33 @@ class TestAction(object):
                 resource_id=res["id"],
             )
             assert 1 == enqueue_mock.call_count
-            assert enqueue_mock.call_args[1].get('queue') == 'default{}'.format(ord(res['package_id'][0]) % 2)
+            assert enqueue_mock.call_args[1].get('queue') == jobs.get_default_queue_name(res['package_id'])
+
+    @pytest.mark.ckan_config("ckanext.xloader.large_file_size", "1000000")
+    @pytest.mark.ckan_config("ckanext.xloader.large_file_queue_names", "large0 large1")
+    @pytest.mark.ckan_config("ckanext.xloader.large_file_job_timeout", "20000")
+    def test_submit_large_file(self, with_api_token):
+        user = factories.User()
+        small = factories.Resource(user=user, format="aaa", size=1000)
+        large = factories.Resource(user=user, format="aaa", size=5000000)
+        with mock.patch(
+            "ckanext.xloader.action.enqueue_job",
+            return_value=mock.MagicMock(id=123),
+        ) as enqueue_mock:
+            for res in (small, large):
+                helpers.call_action(
+                    "xloader_submit",
+                    context=dict(user=user["name"]),
+                    resource_id=res["id"],
+                )
+            (small_call, large_call) = enqueue_mock.call_args_list
+
+            assert small_call[1]['queue'] in ('default0', 'default1')
+            assert int(small_call[1]['rq_kwargs']['timeout']) == 3600
+            assert large_call[1]['queue'] == jobs.get_default_queue_name(large['package_id'], large_file=True)
+            assert large_call[1]['queue'] in ('large0', 'large1')
+            assert int(large_call[1]['rq_kwargs']['timeout']) == 20000
+            assert large_call[0][1][0]['metadata']['large_file']
 
     def test_submit_nonexistent_resource(self, with_api_token):
         user = factories.User()
@@ -96,6 +126,52 @@ class TestAction(object):
             submit(res, user)
             assert 1 == enqueue_mock.call_count
 
+    def test_submits_while_running_coalesce(self, with_api_token):
+        user = factories.User()
+        res = factories.Resource(user=user, format="aaa")
+        helpers.call_action(
+            "task_status_update",
+            context={},
+            entity_id=res["id"],
+            entity_type="resource",
+            task_type="xloader",
+            key="xloader",
+            value="{}",
+            error="{}",
+            state="running",
+        )
+
+        with mock.patch(
+            "ckanext.xloader.action.enqueue_job",
+            return_value=mock.MagicMock(id=123),
+        ) as enqueue_mock:
+            for ignore_hash in (True, False):
+                assert helpers.call_action(
+                    "xloader_submit",
+                    context=dict(user=user["name"]),
+                    resource_id=res["id"],
+                    ignore_hash=ignore_hash,
+                ) is True
+            assert enqueue_mock.call_count == 0
+
+            # the running load finishing queues exactly one more
+            helpers.call_action(
+                "xloader_hook",
+                context=dict(user=user["name"]),
+                metadata={"resource_id": res["id"]},
+                status="complete",
+            )
+            assert enqueue_mock.call_count == 1
+            assert enqueue_mock.call_args[0][1][0]["metadata"]["ignore_hash"]
+
+            helpers.call_action(
+                "xloader_hook",
+                context=dict(user=user["name"]),
+                metadata={"resource_id": res["id"]},
+                status="complete",
+            )
+            assert enqueue_mock.call_count == 1
+
     def test_xloader_hook(self):
         # Check the task_status is stored correctly after a xloader job.
         user = factories.User()
@@ -140,6 +216,198 @@ class TestAction(object):
 
         assert status["status"] == "pending"
 
+    def test_resource_data_logs(self, app, with_api_token):
+        sysadmin = factories.SysadminWithToken()
+        res = factories.Resource(format="CSV")
+
+        response = app.get(
+            "/dataset/{}/resource_data/{}/logs?after=0".format(res["package_id"], res["id"]),
+            headers={"Authorization": sysadmin["token"]},
+        )
+
+        data = response.json
+        assert data["status"] == "pending"
+        assert not data["finished"]
+        assert data["next"] == len(data["logs"])
+        assert data["progress"]["logs"] >= len(data["logs"])
+
+    def test_resource_data_logs_while_indexing(self, app, with_api_token):
+        sysadmin = factories.SysadminWithToken()
+        res = factories.Resource(format="aaa")
+        helpers.call_action(
+            "task_status_update",
+            context={},
+            entity_id=res["id"],
+            entity_type="resource",
+            task_type="xloader",
+            key="xloader",
+            value="{}",
+            error="{}",
+            state="running_but_viewable",
+        )
+
+        response = app.get(
+            "/dataset/{}/resource_data/{}/logs?after=0".format(res["package_id"], res["id"]),
+            headers={"Authorization": sysadmin["token"]},
+        )
+
+        # the data can be viewed, but the indexes are still being built
+        assert response.json["status"] == "running_but_viewable"
+        assert not response.json["finished"]
+
+    def test_resource_data_logs_of_a_retry(self, app, with_api_token):
+        sysadmin = factories.SysadminWithToken()
+        res = factories.Resource(format="aaa")
+        start = datetime.datetime(2024, 1, 1)
+        for job_id in ("first", "retry"):
+            db.add_pending_job(job_id, "test", "123")
+            with db.ENGINE.begin() as conn:
+                conn.execute(db.LOGS_TABLE.insert(), [
+                    {"job_id": job_id, "timestamp": start + datetime.timedelta(seconds=i),
+                     "message": "{} {}".format(job_id, i), "level": "INFO"}
+                    for i in range(3)])
+        helpers.call_action(
+            "task_status_update",
+            context={},
+            entity_id=res["id"],
+            entity_type="resource",
+            task_type="xloader",
+            key="xloader",
+            value=json.dumps({"job_id": "retry"}),
+            error="{}",
+            state="running",
+        )
+        url = "/dataset/{}/resource_data/{}/logs".format(res["package_id"], res["id"])
+
+        # the page showed the first job's 3 lines
+        data = app.get(url + "?job_id=first&after=3",
+                       headers={"Authorization": sysadmin["token"]}).json
+
+        assert data["job_id"] == "retry"
+        assert data["job_changed"]
+        assert [log["message"] for log in data["logs"]] == ["retry 0", "retry 1", "retry 2"]
+        assert data["next"] == 3
+
+        data = app.get(url + "?job_id=retry&after=3",
+                       headers={"Authorization": sysadmin["token"]}).json
+
+        assert not data["job_changed"]
+        assert data["logs"] == []
+
+    def test_resource_data_logs_not_authorized(self, app, with_api_token):
+        res = factories.Resource(format="CSV")
+
+        app.get(
+            "/dataset/{}/resource_data/{}/logs".format(res["package_id"], res["id"]),
+            status=403,
+        )
+
+    def test_submit_many(self, with_api_token):
+        user = factories.User()
+        dataset = factories.Dataset(user=user)
+        resources = [factories.Resource(package_id=dataset["id"], format="aaa")
+                     for _ in range(3)]
+        resource_ids = [res["id"] for res in resources]
+
+        with mock.patch("ckanext.xloader.action.get_queue") as get_queue_mock:
+            outcomes = helpers.call_action(
+                "xloader_submit_many",
+                context=dict(user=user["name"]),
+                resource_ids=resource_ids + ["not-a-resource"],
+            )
+
+        # one round trip to the resources' queue
+        queue_name = jobs.get_default_queue_name(dataset["id"])
+        get_queue_mock.assert_called_once_with(queue_name)
+        enqueue_many = get_queue_mock.return_value.enqueue_many
+        assert enqueue_many.call_count == 1
+        job_datas = enqueue_many.call_args[0][0]
+        assert [data.args[0]["metadata"]["resource_id"] for data in job_datas] == resource_ids
+        assert outcomes == dict(
+            {res_id: "submitted" for res_id in resource_ids}, **{"not-a-resource": "not_found"})
+        for res_id, data in zip(resource_ids, job_datas):
+            status = helpers.call_action("xloader_status", resource_id=res_id)
+            assert status["status"] == "pending"
+            assert status["job_id"] == data.job_id
+
+    @pytest.mark.ckan_config("ckanext.xloader.large_file_size", "1000000")
+    @pytest.mark.ckan_config("ckanext.xloader.large_file_head_request", "true")
+    def test_submit_many_makes_no_head_requests(self, with_api_token):
+        resources = [factories.Resource(format="aaa", url="http://example.com/{}.csv".format(index))
+                     for index in range(3)]
+
+        with mock.patch("ckanext.xloader.action.get_queue") as get_queue_mock, \
+                mock.patch("ckanext.xloader.jobs.requests.head") as head_mock:
+            helpers.call_action(
+                "xloader_submit_many", resource_ids=[res["id"] for res in resources])
+
+        head_mock.assert_not_called()
+        job_datas = get_queue_mock.return_value.enqueue_many.call_args[0][0]
+        assert not any(data.args[0]["metadata"].get("large_file") for data in job_datas)
+
+    def test_submit_many_already_queued(self, with_api_token):
+        res = factories.Resource(format="aaa")
+
+        with mock.patch("ckanext.xloader.action.get_queue"):
+            helpers.call_action("xloader_submit_many", resource_ids=[res["id"]])
+            outcomes = helpers.call_action("xloader_submit_many", resource_ids=[res["id"]])
+
+        assert outcomes == {res["id"]: "queued"}
+
+    def test_submit_many_enqueue_error(self, with_api_token):
+        res = factories.Resource(format="aaa")
+
+        with mock.patch("ckanext.xloader.action.get_queue") as get_queue_mock:
+            get_queue_mock.return_value.enqueue_many.side_effect = Exception("No Redis")
+            outcomes = helpers.call_action("xloader_submit_many", resource_ids=[res["id"]])
+
+        assert outcomes == {res["id"]: "error"}
+        assert helpers.call_action("xloader_status", resource_id=res["id"])["status"] == "error"
+
+    def test_status_bulk(self, with_api_token):
+        dataset = factories.Dataset()
+        submitted = factories.Resource(package_id=dataset["id"], format="CSV")
+        not_submitted = factories.Resource(package_id=dataset["id"], format="aaa")
+
+        statuses = helpers.call_action(
+            "xloader_status_bulk",
+            resource_ids=[submitted["id"], not_submitted["id"]],
+        )
+
+        assert list(statuses) == [submitted["id"]]
+        single = helpers.call_action("xloader_status", resource_id=submitted["id"])
+        for key in ("status", "job_id", "error"):
+            assert statuses[submitted["id"]][key] == single[key]
+
+    def test_status_bulk_checks_each_resource(self):
+        user = factories.User()
+        org = factories.Organization(users=[{"name": user["name"], "capacity": "editor"}])
+        own = factories.Resource(
+            package_id=factories.Dataset(owner_org=org["id"])["id"], format="aaa")
+        other = factories.Resource(format="aaa")
+
+        helpers.call_auth(
+            "xloader_status_bulk", context=dict(user=user["name"], model=None),
+            resource_ids=[own["id"]])
+        with pytest.raises(NotAuthorized):
+            helpers.call_auth(
+                "xloader_status_bulk", context=dict(user=user["name"], model=None),
+                resource_ids=[own["id"], other["id"]])
+
+    def test_status_bulk_skips_missing_resources(self, with_api_token):
+        user = factories.User()
+        org = factories.Organization(users=[{"name": user["name"], "capacity": "editor"}])
+        dataset = factories.Dataset(owner_org=org["id"])
+        submitted = factories.Resource(package_id=dataset["id"], format="CSV")
+        deleted = factories.Resource(package_id=dataset["id"], format="CSV")
+        helpers.call_action("resource_delete", id=deleted["id"])
+
+        statuses = helpers.call_action(
+            "xloader_status_bulk", context=dict(user=user["name"], ignore_auth=False),
+            resource_ids=[submitted["id"], deleted["id"], "not-a-resource"])
+
+        assert list(statuses) == [submitted["id"]]
+
     def test_xloader_user_api_token_from_config(self):
         sysadmin = factories.SysadminWithToken()
         apikey = sysadmin["token"]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import datetime
+import struct
+from decimal import Decimal
+
+import pytest
+
+from ckanext.xloader import binary_copy
+
+
+def _decode_numeric(data):
+    ndigits, weight, sign, dscale = struct.unpack('!hhHh', data[:8])
+    digits = struct.unpack('!{}h'.format(ndigits), data[8:])
+    return ndigits, weight, sign, dscale, digits
+
+
+class TestEncodeNumeric(object):
+    @pytest.mark.parametrize("value,expected", [
+        ("12345.678", (3, 1, binary_copy.NUMERIC_POS, 3, (1, 2345, 6780))),
+        ("0.0001", (1, -1, binary_copy.NUMERIC_POS, 4, (1,))),
+        ("10000", (1, 1, binary_copy.NUMERIC_POS, 0, (1,))),
+        ("-0.5", (1, -1, binary_copy.NUMERIC_NEG, 1, (5000,))),
+        ("1.5E-7", (1, -2, binary_copy.NUMERIC_POS, 8, (15,))),
+        ("0.000", (0, 0, binary_copy.NUMERIC_POS, 3, ())),
+        ("NaN", (0, 0, binary_copy.NUMERIC_NAN, 0, ())),
+    ])
+    def test_decimal(self, value, expected):
+        assert _decode_numeric(binary_copy.encode_numeric(Decimal(value))) == expected
+
+    def test_float_uses_shortest_repr(self):
+        assert binary_copy.encode_numeric(0.1) == binary_copy.encode_numeric(Decimal("0.1"))
+
+    def test_int(self):
+        assert _decode_numeric(binary_copy.encode_numeric(20000)) == \
+            (1, 1, binary_copy.NUMERIC_POS, 0, (2,))
+
+
+class TestEncodeTimestamp(object):
+    def test_microseconds_since_2000(self):
+        data = binary_copy.encode_timestamp(datetime.datetime(2000, 1, 2, 0, 0, 1, 5))
+        assert struct.unpack('!q', data) == (86401000005,)
+
+    def test_before_2000(self):
+        data = binary_copy.encode_timestamp(datetime.datetime(1999, 12, 31, 23, 59, 59))
+        assert struct.unpack('!q', data) == (-1000000,)
+
+    def test_time_zone_is_converted_to_utc(self):
+        aware = datetime.datetime(2011, 1, 1, 2, tzinfo=datetime.timezone(datetime.timedelta(hours=5)))
+        assert binary_copy.encode_timestamp(aware) == \
+            binary_copy.encode_timestamp(datetime.datetime(2010, 12, 31, 21))
+
+    def test_not_a_timestamp(self):
+        with pytest.raises(ValueError):
+            binary_copy.encode_timestamp('yesterday')
+
+
+class TestEncodeRow(object):
+    def test_nulls(self):
+        row = binary_copy.encode_row(['', '', '', None], ['numeric', 'timestamp', 'text', 'text'])
+        # empty numeric and timestamp cells are NULL, but not empty text
+        assert row == struct.pack('!h', 4) + binary_copy.NULL * 2 \
+            + struct.pack('!i', 0) + binary_copy.NULL
+
+    def test_text(self):
+        row = binary_copy.encode_row([u'Galway é'], ['text'])
+        assert row == struct.pack('!hi', 1, 9) + u'Galway é'.encode('utf-8')
+
+    def test_bools_are_lower_case(self):
+        assert binary_copy.encode_text(True) == b'true'
+        assert binary_copy.encode_text(False) == b'false'
+
+
+class TestBinaryCopyStream(object):
+    def test_read_in_small_pieces(self):
+        rows = [[Decimal('1'), u'a'], [None, u'b']]
+        types = ['numeric', 'text']
+        stream = binary_copy.BinaryCopyStream(iter(rows), types)
+        data = b''
+        while True:
+            piece = stream.read(5)
+            if not piece:
+                break
+            data += piece
+        assert data == binary_copy.HEADER \
+            + binary_copy.encode_row(rows[0], types) \
+            + binary_copy.encode_row(rows[1], types) \
+            + binary_copy.TRAILER
+
+    def test_encoding_error_is_kept(self):
+        stream = binary_copy.BinaryCopyStream([[u'soon']], ['timestamp'])
+        with pytest.raises(ValueError):
+            stream.read()
+        assert isinstance(stream.error, ValueError)
@@ -32,8 +32,8 @@ class TestChunkedLoading(TestLoadBase):
         """Create a mock function for split_copy_by_size with specified chunk size"""
         original_split_copy = loader.split_copy_by_size
 
-        def mock_split_copy(input_file: Any, engine: Any, logger: Any, resource_id: str, headers: List[str], delimiter: str = ',', max_size: int = 1024**3) -> Any:
-            return original_split_copy(input_file, engine, logger, resource_id, headers, delimiter, chunk_size)
+        def mock_split_copy(input_file: Any, engine: Any, logger: Any, resource_id: str, headers: List[str], delimiter: str = ',', max_size: int = 1024**3, **kwargs: Any) -> Any:
+            return original_split_copy(input_file, engine, logger, resource_id, headers, delimiter, chunk_size, **kwargs)
 
         return mock_split_copy
 
@@ -0,0 +1,62 @@
+import io
+
+import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ckan.tests import factories
+
+from ckanext.xloader import command
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins")
+@pytest.mark.ckan_config("ckan.plugins", "datastore xloader")
+class TestSubmitAll(object):
+
+    def test_pages_cover_the_whole_catalogue(self, monkeypatch):
+        monkeypatch.setattr(command, "BATCH_SIZE", 2)
+        org = factories.Organization()
+        datasets = [factories.Dataset(owner_org=org["id"], private=index == 0)
+                    for index in range(5)]
+
+        pages = list(command.XloaderCmd()._iter_package_pages())
+
+        assert [len(page) for _count, page in pages] == [2, 2, 1]
+        assert pages[0][0] == 5
+        seen = [pkg["id"] for _count, page in pages for pkg in page]
+        assert seen == sorted(dataset["id"] for dataset in datasets)
+
+    def test_submit_all_in_batches(self, app, monkeypatch):
+        monkeypatch.setattr(command, "BATCH_SIZE", 2)
+        datasets = [factories.Dataset() for _ in range(3)]
+        resources = [factories.Resource(package_id=dataset["id"], format="aaa")
+                     for dataset in datasets]
+        batches = []
+
+        def submit_many(self, resources, user, queue=None):
+            batches.append(sorted(resource["id"] for resource in resources))
+            return dict.fromkeys(batches[-1], "submitted")
+
+        cmd = command.XloaderCmd(concurrency=2)
+        with mock.patch.object(command.XloaderCmd, "_submit_many", submit_many), \
+                app.flask_app.test_request_context():
+            cmd._submit_all()
+
+        assert sorted(len(batch) for batch in batches) == [1, 2]
+        assert sorted(sum(batches, [])) == sorted(resource["id"] for resource in resources)
+        assert not cmd.error_occured
+
+
+def test_progress():
+    out = io.StringIO()
+    progress = command._Progress(10, "datasets", out=out)
+    progress.started -= 2
+
+    progress.update(4)
+    progress.update(6)
+
+    lines = out.getvalue().splitlines()
+    assert lines[0].startswith("4/10 datasets (40%), 2.0/s, ETA 0:00:03")
+    assert lines[1].startswith("10/10 datasets (100%)")
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import datetime
 import logging
+import time
 from typing import Any
 
 import pytest
@@ -97,6 +99,7 @@ class TestGetJob:
 
         logger.info(first_message)
         logger.info(second_message)
+        handler.flush()
 
         job = db.get_job(id)
         assert len(job["logs"]) == 2
@@ -104,3 +107,239 @@ class TestGetJob:
         messages = sorted([item["message"] for item in job["logs"]])
 
         assert messages == sorted([first_message, second_message])
+        logger.removeHandler(handler)
+        handler.close()
+
+    def test_logs_are_buffered(self, faker: Faker):
+        """Log records are stored in batches, and on close."""
+        id = faker.uuid4()
+        db.add_pending_job(id, "test", "123")
+
+        handler = jobs.StoringHandler(id, {}, capacity=3, flush_interval=0)
+        logger = logging.getLogger(id)
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+
+        logger.info("one")
+        logger.info("two")
+        assert not db.get_job(id)["logs"]
+
+        logger.info("three")
+        logger.info("four")
+        assert len(db.get_job(id)["logs"]) == 3
+
+        logger.removeHandler(handler)
+        handler.close()
+        assert len(db.get_job(id)["logs"]) == 4
+
+    def test_logs_flushed_periodically_once_started(self, faker: Faker):
+        """Records aren't stored from the background thread until the job
+        has been added, and closing stops the thread."""
+        id = faker.uuid4()
+        handler = jobs.StoringHandler(id, {}, flush_interval=0.01)
+        logger = logging.getLogger(id)
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+
+        logger.info("before the job was added")
+        assert handler._flusher is None
+        db.add_pending_job(id, "test", "123")
+        handler.start_flushing()
+        for _ in range(100):
+            if db.get_job(id)["logs"]:
+                break
+            time.sleep(0.01)
+        assert len(db.get_job(id)["logs"]) == 1
+
+        logger.removeHandler(handler)
+        handler.close()
+        assert not handler._flusher.is_alive()
+
+    def test_logs_paginated(self, faker: Faker):
+        """get_job can return a page of the logs, counting from either end."""
+        id = faker.uuid4()
+        db.add_pending_job(id, "test", "123")
+        start = datetime.datetime(2024, 1, 1)
+        with db.ENGINE.begin() as conn:
+            conn.execute(db.LOGS_TABLE.insert(), [
+                {"job_id": id, "timestamp": start + datetime.timedelta(seconds=i),
+                 "message": str(i), "level": "INFO"}
+                for i in range(10)])
+
+        def messages(**kwargs):
+            return [log["message"] for log in db.get_job(id, **kwargs)["logs"]]
+
+        assert messages() == [str(i) for i in range(10)]
+        assert messages(logs_limit=2, logs_offset=3) == ["3", "4"]
+        assert messages(logs_offset=-2) == ["8", "9"]
+        assert messages(logs_since=(start + datetime.timedelta(seconds=7)).isoformat()) == ["8", "9"]
+
+        job = db.get_job(id, logs_limit=1)
+        assert job["logs_count"] == 10
+        assert job["logs"][0]["timestamp"] == start.isoformat()
+
+    def test_logs_with_the_same_timestamp_paginated(self, faker: Faker):
+        """Logs written in the same microsecond are paged in the order they
+        were written, so none are repeated or skipped."""
+        id = faker.uuid4()
+        db.add_pending_job(id, "test", "123")
+        with db.ENGINE.begin() as conn:
+            conn.execute(db.LOGS_TABLE.insert(), [
+                # ids as the sequence gives them on PostgreSQL
+                {"job_id": id, "timestamp": datetime.datetime(2024, 1, 1),
+                 "message": str(i), "level": "INFO", "id": 100 - i}
+                for i in range(10)])
+
+        pages = [[log["message"] for log in db.get_job(id, logs_limit=3, logs_offset=offset)["logs"]]
+                 for offset in range(0, 10, 3)]
+
+        assert sum(pages, []) == [str(i) for i in reversed(range(10))]
+        assert "id" not in db.get_job(id)["logs"][0]
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestInit:
+    def test_engine_is_reused(self, ckan_config: dict[str, Any]):
+        db.init(ckan_config)
+        engine = db.ENGINE
+        jobs_table = db.JOBS_TABLE
+        db.init(ckan_config)
+        assert db.ENGINE is engine
+        assert db.JOBS_TABLE is jobs_table
+
+    def test_tables_created_once(
+        self, ckan_config: dict[str, Any], monkeypatch: pytest.MonkeyPatch
+    ):
+        db.init(ckan_config)
+        calls = []
+        monkeypatch.setattr(db._METADATA, "create_all", lambda *args: calls.append(args))
+        db.init(ckan_config)
+        assert calls == []
+        db.init(ckan_config, create_tables=True)
+        assert calls == []
+
+    def test_tables_created_once_per_database(
+        self, ckan_config: dict[str, Any], monkeypatch: pytest.MonkeyPatch
+    ):
+        db.init(ckan_config)
+        engine = db.ENGINE
+        calls = []
+        monkeypatch.setattr(db._METADATA, "create_all", lambda *args: calls.append(args))
+        # as in a job forked by the worker
+        monkeypatch.setattr(db.os, "getpid", lambda: -1)
+        db.init(ckan_config)
+        assert db.ENGINE is not engine
+        assert calls == []
+
+    def test_tables_recreated_after_drop_all(self, ckan_config: dict[str, Any]):
+        db.init(ckan_config)
+        db.drop_all()
+        db.init(ckan_config)
+        assert db.get_job("not-a-job") is None
+
+    def test_indexes_added_to_existing_tables(self, ckan_config: dict[str, Any]):
+        db.init(ckan_config)
+        with db.ENGINE.begin() as conn:
+            conn.execute(sa.text("DROP INDEX logs_job_id_timestamp_idx"))
+
+        def logs_indexes():
+            return {index["name"] for index in sa.inspect(db.ENGINE).get_indexes("logs")}
+
+        # only init-db builds them, as on a large table that takes a while
+        db.init(ckan_config, create_tables=True)
+        assert "logs_job_id_timestamp_idx" not in logs_indexes()
+        db.create_indexes()
+        assert "logs_job_id_timestamp_idx" in logs_indexes()
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestCheckpoints:
+    @pytest.fixture(autouse=True)
+    def init(self, ckan_config: dict[str, Any]):
+        db.init(ckan_config)
+        with db.ENGINE.begin() as conn:
+            conn.execute(sa.delete(db.CHECKPOINTS_TABLE))
+
+    def test_missing(self, faker: Faker):
+        assert db.get_checkpoint(faker.uuid4()) is None
+
+    def test_save_replaces_previous(self, faker: Faker):
+        resource_id = faker.uuid4()
+        db.save_checkpoint(resource_id, "abc", "copy", byte_offset=10, rows_loaded=1, max_id=1)
+        db.save_checkpoint(resource_id, "abc", "fulltext", byte_offset=20, rows_loaded=2, max_id=2,
+                           fulltext_id=2)
+
+        checkpoint = db.get_checkpoint(resource_id)
+        assert checkpoint["file_hash"] == "abc"
+        assert checkpoint["stage"] == "fulltext"
+        assert checkpoint["byte_offset"] == 20
+        assert checkpoint["rows_loaded"] == 2
+        assert checkpoint["max_id"] == 2
+        assert checkpoint["fulltext_id"] == 2
+
+    def test_delete(self, faker: Faker):
+        resource_id = faker.uuid4()
+        db.save_checkpoint(resource_id, "abc", "copy")
+        db.delete_checkpoint(resource_id)
+        assert db.get_checkpoint(resource_id) is None
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestPurge:
+    @pytest.fixture(autouse=True)
+    def init(self, ckan_config: dict[str, Any]):
+        db.init(ckan_config)
+        with db.ENGINE.begin() as conn:
+            conn.execute(sa.delete(db.JOBS_TABLE))
+            conn.execute(sa.delete(db.METADATA_TABLE))
+            conn.execute(sa.delete(db.LOGS_TABLE))
+
+    def _add_job(self, job_id, resource_id, days_ago):
+        timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)
+        db.add_pending_job(job_id, "test", "123", metadata={"resource_id": resource_id})
+        with db.ENGINE.begin() as conn:
+            conn.execute(db.JOBS_TABLE.update()
+                         .where(db.JOBS_TABLE.c.job_id == job_id)
+                         .values(requested_timestamp=timestamp))
+            conn.execute(db.LOGS_TABLE.insert().values(
+                job_id=job_id, timestamp=timestamp, message="log", level="INFO"))
+
+    def test_keep_jobs_per_resource(self):
+        for resource_id in ("a", "b"):
+            for i in range(5):
+                self._add_job(resource_id + str(i), resource_id, days_ago=10 - i)
+
+        counts = db.purge(keep_jobs_per_resource=2, batch_size=2)
+
+        assert counts == {"jobs": 6, "logs": 6, "partitions": 0}
+        with db.ENGINE.connect() as conn:
+            job_ids = sorted(conn.execute(sa.select(db.JOBS_TABLE.c.job_id)).scalars())
+            metadata_job_ids = set(conn.execute(sa.select(db.METADATA_TABLE.c.job_id)).scalars())
+        assert job_ids == ["a3", "a4", "b3", "b4"]
+        assert metadata_job_ids == set(job_ids)
+
+    def test_keep_logs_days(self):
+        self._add_job("old", "a", days_ago=40)
+        self._add_job("new", "a", days_ago=1)
+
+        counts = db.purge(keep_logs_days=30)
+
+        assert counts == {"jobs": 0, "logs": 1, "partitions": 0}
+        assert db.get_job("old")["logs_count"] == 0
+        assert db.get_job("new")["logs_count"] == 1
+
+    def test_keep_logs_days_in_batches(self):
+        for i in range(5):
+            self._add_job("old{}".format(i), "a", days_ago=40)
+        self._add_job("new", "a", days_ago=1)
+
+        counts = db.purge(keep_logs_days=30, batch_size=2)
+
+        assert counts == {"jobs": 0, "logs": 5, "partitions": 0}
+        assert db.get_job("new")["logs_count"] == 1
+        # the job ids are gathered in a temporary table, dropped afterwards
+        assert db.purge(keep_logs_days=30, batch_size=2)["logs"] == 0
+
+    def test_nothing_to_keep_by_default(self):
+        self._add_job("old", "a", days_ago=400)
+        assert db.purge() == {"jobs": 0, "logs": 0, "partitions": 0}
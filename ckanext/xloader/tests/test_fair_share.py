@@ -0,0 +1,183 @@
+import pytest
+
+from ckanext.xloader import fair_share
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class FakeQueues(object):
+    """The RQ queues, and workers that run their jobs one at a time."""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.queues = {}
+        self.started = []
+
+    def depth(self, queue_name):
+        return len(self.queues.get(queue_name, []))
+
+    def enqueue(self, queue_name, job_id):
+        self.queues.setdefault(queue_name, []).append(job_id)
+        return True
+
+    def dispatch(self):
+        return self.dispatcher.dispatch(self.depth, self.enqueue)
+
+    def run_one(self, queue_name="default"):
+        job_id = self.queues[queue_name].pop(0)
+        self.started.append(job_id)
+        self.dispatcher.finished(job_id)
+        self.dispatch()
+        return job_id
+
+
+def _submit(queues, org, count, queue_name="default"):
+    for index in range(count):
+        queues.dispatcher.push(queue_name, org, "{}-{}".format(org, index))
+    queues.dispatch()
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis()
+
+
+def test_round_robin(redis):
+    queues = FakeQueues(fair_share.Dispatcher(redis))
+    _submit(queues, "bulk", 1000)
+    _submit(queues, "small", 3)
+
+    for _ in range(8):
+        queues.run_one()
+
+    # the bulk upload doesn't hold up the other organization
+    assert queues.started == [
+        "bulk-0", "small-0", "bulk-1", "small-1", "bulk-2", "small-2", "bulk-3", "bulk-4"]
+    assert fair_share.Dispatcher(redis).waiting() == {"default": {"bulk": 994}}
+
+
+def test_weights(redis):
+    queues = FakeQueues(fair_share.Dispatcher(redis, weights={"a": 3}))
+    _submit(queues, "a", 100)
+    _submit(queues, "b", 100)
+
+    for _ in range(40):
+        queues.run_one()
+
+    started_by_a = len([job_id for job_id in queues.started if job_id.startswith("a-")])
+    assert started_by_a == 30
+
+
+def test_returning_organization_is_not_owed_past_work(redis):
+    queues = FakeQueues(fair_share.Dispatcher(redis))
+    _submit(queues, "a", 1)
+    queues.run_one()
+    _submit(queues, "b", 100)
+    for _ in range(50):
+        queues.run_one()
+
+    _submit(queues, "a", 10)
+    for _ in range(10):
+        queues.run_one()
+
+    assert len([job_id for job_id in queues.started[-10:] if job_id.startswith("a-")]) == 5
+
+
+def test_max_jobs_per_org(redis):
+    queues = FakeQueues(fair_share.Dispatcher(redis, queue_length=4, max_jobs_per_org=2))
+    _submit(queues, "a", 10)
+    assert queues.queues["default"] == ["a-0", "a-1"]
+
+    _submit(queues, "b", 10)
+    assert queues.queues["default"] == ["a-0", "a-1", "b-0", "b-1"]
+    assert fair_share.Dispatcher(redis).active() == {"a": 2, "b": 2}
+
+
+def test_forgets_jobs_that_died(redis):
+    dispatcher = fair_share.Dispatcher(redis, max_jobs_per_org=1)
+    queues = FakeQueues(dispatcher)
+    _submit(queues, "a", 2)
+    # the worker was killed, so the job never finished
+    queues.queues["default"].pop(0)
+
+    dispatcher.dispatch(queues.depth, queues.enqueue, is_active=lambda job_id: False)
+
+    assert queues.queues["default"] == ["a-1"]
+
+
+def test_dispatches_again_when_the_lock_was_held(redis):
+    dispatcher = fair_share.Dispatcher(redis)
+    queues = FakeQueues(dispatcher)
+    for index in range(3):
+        dispatcher.push("default", "a", "a-{}".format(index))
+    finished_while_dispatching = []
+
+    def enqueue(queue_name, job_id):
+        queues.enqueue(queue_name, job_id)
+        if not finished_while_dispatching:
+            # a worker runs the job straight away, and its dispatch finds
+            # the lock held
+            finished_while_dispatching.append(queues.queues[queue_name].pop(0))
+            assert dispatcher.dispatch(queues.depth, queues.enqueue) == []
+        return True
+
+    dispatched = dispatcher.dispatch(queues.depth, enqueue)
+
+    assert finished_while_dispatching == ["a-0"]
+    assert [job_id for _queue_name, _org, job_id in dispatched] == ["a-0", "a-1"]
+    assert queues.queues["default"] == ["a-1"]
+
+
+class PushesDuringPop(object):
+    """A Redis client on which another process pushes a job once, between
+    Dispatcher._pop reading the sub-queue and changing it."""
+
+    def __init__(self, redis, push):
+        self.redis = redis
+        self.push = push
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+    def pipeline(self, *args, **kwargs):
+        pipeline = self.redis.pipeline(*args, **kwargs)
+        multi = pipeline.multi
+
+        def push_then_multi():
+            if self.push:
+                push, self.push = self.push, None
+                push()
+            return multi()
+        pipeline.multi = push_then_multi
+        return pipeline
+
+
+def test_push_while_popping_the_last_job(redis):
+    other_process = fair_share.Dispatcher(redis)
+    other_process.push("default", "a", "a-0")
+    dispatcher = fair_share.Dispatcher(PushesDuringPop(
+        redis, lambda: other_process.push("default", "a", "a-1")))
+    queues = FakeQueues(dispatcher)
+
+    queues.dispatch()
+
+    assert queues.queues["default"] == ["a-0"]
+    assert other_process.waiting() == {"default": {"a": 1}}
+
+
+def test_separate_queues(redis):
+    dispatcher = fair_share.Dispatcher(redis)
+    queues = FakeQueues(dispatcher)
+    for index in range(3):
+        dispatcher.push("q0", "a", "q0-{}".format(index))
+        dispatcher.push("q1", "a", "q1-{}".format(index))
+    queues.dispatch()
+
+    assert queues.queues == {"q0": ["q0-0"], "q1": ["q1-0"]}
+
+
+def test_parse_weights():
+    assert fair_share.parse_weights("org-a:3 org:b:0.5") == {"org-a": 3.0, "org:b": 0.5}
+    assert fair_share.parse_weights(None) == {}
+    with pytest.raises(ValueError):
+        fair_share.parse_weights("org-a")
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
-from collections import namedtuple
+from collections import Counter, namedtuple
 from typing import Any
 import pytest
 import io
 import os
+import tempfile
+import time
 
-from datetime import datetime
+import email.utils
+from datetime import datetime, timedelta, timezone
 
 from faker import Faker
 from requests import Response
@@ -17,7 +20,7 @@ from ckan.tests import helpers, factories
 
 from unittest import mock
 
-from ckanext.xloader import jobs
+from ckanext.xloader import db, jobs
 
 
 _TEST_FILE_CONTENT = "x, y\n1,2\n2,4\n3,6\n4,8\n5,10"
@@ -94,7 +97,30 @@ class TestXLoaderJobs(helpers.FunctionalRQTestBase):
     def test_derive_queue_name(self):
         assert jobs.get_default_queue_name() == "default0"
         assert jobs.get_default_queue_name("foo") == "default0"
-        assert jobs.get_default_queue_name("meh") == "default1"
+        assert jobs.get_default_queue_name("bar") == "default1"
+
+    def test_derive_queue_name_spread(self, monkeypatch: pytest.MonkeyPatch, faker: Faker):
+        package_ids = [faker.uuid4() for _ in range(2000)]
+        monkeypatch.setattr(jobs, "default_queue_names", ["q0", "q1", "q2", "q3", "q4"])
+        before = {package_id: jobs.get_default_queue_name(package_id) for package_id in package_ids}
+
+        counts = Counter(before.values())
+        assert len(counts) == 5
+        assert min(counts.values()) > 300
+
+        # a new queue only takes datasets over from the others
+        monkeypatch.setattr(jobs, "default_queue_names", ["q0", "q1", "q2", "q3", "q4", "q5"])
+        moved = [package_id for package_id in package_ids
+                 if jobs.get_default_queue_name(package_id) != before[package_id]]
+        assert all(jobs.get_default_queue_name(package_id) == "q5" for package_id in moved)
+        assert len(moved) < 500
+
+    def test_derive_queue_name_depth_aware(self, monkeypatch: pytest.MonkeyPatch):
+        depths = {"default0": 10, "default1": 0}
+        monkeypatch.setattr(jobs, "queue_depth_aware", True)
+        monkeypatch.setattr(jobs, "get_queue", lambda name: namedtuple("Queue", ["count"])(depths[name]))
+
+        assert jobs.get_default_queue_name("foo") == "default1"
 
     def test_job_duplicate(self, data: dict[str, Any], monkeypatch: pytest.MonkeyPatch, faker: Faker):
         job = namedtuple("Job", ["id"])(id=faker.uuid4())
@@ -108,6 +134,80 @@ class TestXLoaderJobs(helpers.FunctionalRQTestBase):
         assert job_dict["status"] == "error"
         assert "UNIQUE" in job_dict["error"]
 
+    def test_stage_timings(self, data: dict[str, Any], monkeypatch: pytest.MonkeyPatch, faker: Faker):
+        job = namedtuple("Job", ["id"])(id=faker.uuid4())
+        monkeypatch.setattr(jobs, "get_current_job", lambda: job)
+        monkeypatch.setattr(jobs, "callback_xloader_hook", mock.Mock())
+        with mock.patch("ckanext.xloader.jobs.get_response", get_response):
+            jobs.xloader_data_into_datastore(data)
+
+        stages = db.get_job(job.id)["metadata"]["stages"]
+        names = [stage["name"] for stage in stages]
+        for name in ("download", "detect_encoding", "reencode", "copy",
+                     "fulltext", "analyze", "indexes", "update_resource"):
+            assert name in names
+        assert all(stage["seconds"] >= 0 for stage in stages)
+        copy = names.index("copy")
+        assert stages[copy]["rows"] == 5
+        assert stages[names.index("download")]["bytes"] == len(_TEST_FILE_CONTENT)
+
+    def test_retry_is_scheduled(self, data: dict[str, Any], monkeypatch: pytest.MonkeyPatch, faker: Faker):
+        job = namedtuple("Job", ["id"])(id=faker.uuid4())
+        monkeypatch.setattr(jobs, "get_current_job", lambda: job)
+        monkeypatch.setattr(jobs, "callback_xloader_hook", mock.Mock())
+        monkeypatch.setattr(jobs, "retry_backoff", 10)
+        error = jobs.HTTPError("HTTP Error", status_code=503, request_url="test",
+                               response=None, retry_after=300)
+        with mock.patch("ckanext.xloader.jobs._download_resource_data", side_effect=error):
+            jobs.xloader_data_into_datastore(data)
+
+        registry = jobs.get_queue(jobs.DEFAULT_QUEUE_NAME).scheduled_job_registry
+        retry_ids = registry.get_job_ids()
+        assert len(retry_ids) == 1
+        assert jobs.get_queue(jobs.DEFAULT_QUEUE_NAME).count == 0
+        metadata = db.get_job(job.id)["metadata"]
+        assert metadata["tries"] == 1
+        assert "status=503" in metadata["retry_reason"]
+        # the Retry-After is kept to
+        retry_at = datetime.fromisoformat(metadata["retry_at"])
+        assert (retry_at - datetime.utcnow()).total_seconds() > 290
+
+    @pytest.mark.usefixtures("with_extended_cli")
+    def test_retry_runs_when_due(self, cli, data, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(jobs, "retry_backoff", 1)
+        monkeypatch.setattr(jobs, "retry_backoff_max", 1)
+        downloads = []
+
+        def download(*args, **kwargs):
+            downloads.append(args)
+            if len(downloads) == 1:
+                raise jobs.HTTPError("HTTP Error", status_code=503, request_url="test",
+                                     response=None)
+            tmp_file = tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".csv")
+            tmp_file.write(_TEST_FILE_CONTENT)
+            tmp_file.flush()
+            return (tmp_file, "d44fa65eda3675e11710682fdb5f1648")
+
+        self.enqueue(jobs.xloader_data_into_datastore, [data])
+        with mock.patch("ckanext.xloader.jobs._download_resource_data", download):
+            stdout = cli.invoke(ckan, ["jobs", "worker", "--burst"]).output
+            assert "retrying in" in stdout
+            assert "Express Load completed" not in stdout
+            queue = jobs.get_queue(jobs.DEFAULT_QUEUE_NAME)
+            assert queue.scheduled_job_registry.count == 1
+
+            # as a worker with --with-scheduler or `ckan xloader worker` does
+            time.sleep(1.5)
+            jobs.enqueue_due_retries()
+            assert queue.scheduled_job_registry.count == 0
+            assert queue.count == 1
+            stdout = cli.invoke(ckan, ["jobs", "worker", "--burst"]).output
+
+        assert "Express Load completed" in stdout
+        assert len(downloads) == 2
+        resource = helpers.call_action("resource_show", id=data["metadata"]["resource_id"])
+        assert resource["datastore_contains_all_records_of_source_file"]
+
     def test_xloader_data_into_datastore(self, cli, data):
         self.enqueue(jobs.xloader_data_into_datastore, [data])
         with mock.patch("ckanext.xloader.jobs.get_response", get_response):
@@ -120,6 +220,7 @@ class TestXLoaderJobs(helpers.FunctionalRQTestBase):
 
         resource = helpers.call_action("resource_show", id=data["metadata"]["resource_id"])
         assert resource["datastore_contains_all_records_of_source_file"]
+        assert int(resource["datastore_row_count"]) == 5
 
     # Set the ckanext.xloader.site_url in the config
     @pytest.mark.ckan_config("ckanext.xloader.site_url", 'http://xloader-site-url')
@@ -196,6 +297,38 @@ class TestXLoaderJobs(helpers.FunctionalRQTestBase):
             stdout = cli.invoke(ckan, ["jobs", "worker", "--burst"]).output
             assert "Ignoring resource - the file hash hasn't changed" in stdout
 
+    @pytest.mark.ckan_config("ckanext.xloader.append_only_loads", True)
+    def test_xloader_append_only_load(self, cli, data):
+        def get_content_response(content):
+            def get_response(download_url, headers):
+                resp = Response()
+                resp.raw = io.BytesIO(content.encode())
+                resp.headers = headers
+                return resp
+            return get_response
+
+        first_content = _TEST_FILE_CONTENT + "\n"
+        self.enqueue(jobs.xloader_data_into_datastore, [data])
+        with mock.patch("ckanext.xloader.jobs.get_response", get_content_response(first_content)):
+            stdout = cli.invoke(ckan, ["jobs", "worker", "--burst"]).output
+            assert "Express Load completed" in stdout
+
+        resource_id = data["metadata"]["resource_id"]
+        resource = helpers.call_action("resource_show", id=resource_id)
+        assert int(resource["xloader_loaded_bytes"]) == len(first_content)
+
+        self.enqueue(jobs.xloader_data_into_datastore, [data])
+        with mock.patch("ckanext.xloader.jobs.get_response", get_content_response(first_content + "6,12\n")):
+            stdout = cli.invoke(ckan, ["jobs", "worker", "--burst"]).output
+            assert "Finished appending the new rows" in stdout
+            assert "Express Load completed" in stdout
+
+        result = helpers.call_action("datastore_search", resource_id=resource_id)
+        assert result["total"] == 6
+        assert result["records"][-1]["x"] == "6"
+        resource = helpers.call_action("resource_show", id=resource_id)
+        assert int(resource["datastore_row_count"]) == 6
+
     def test_data_too_big_error_if_content_length_bigger_than_config(self, cli, data):
         self.enqueue(jobs.xloader_data_into_datastore, [data])
         with mock.patch("ckanext.xloader.jobs.get_response", get_large_response):
@@ -217,7 +350,7 @@ class TestXLoaderJobs(helpers.FunctionalRQTestBase):
         self.enqueue(jobs.xloader_data_into_datastore, [data], rq_kwargs=dict(timeout=2))
         with mock.patch("ckanext.xloader.jobs.get_response", get_large_data_response):
             stdout = cli.invoke(ckan, ["jobs", "worker", "--burst"]).output
-            assert "Job timed out after" in stdout
+            assert "Job timed out after 2s" in stdout
             for f in _get_temp_files():
                 # make sure that the tmp file has been closed/deleted in job timeout exception handling
                 assert file_suffix not in f
@@ -308,6 +441,30 @@ class TestXLoaderJobs(helpers.FunctionalRQTestBase):
                 assert "Express Load completed" not in stdout
 
 
+def test_retry_delay(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(jobs, "retry_backoff", 10)
+    monkeypatch.setattr(jobs, "retry_backoff_max", 60)
+
+    assert 5 <= jobs.retry_delay(1) <= 10
+    assert 10 <= jobs.retry_delay(2) <= 20
+    assert 30 <= jobs.retry_delay(5) <= 60
+    assert jobs.retry_delay(1, retry_after=50) == 50
+    # the Retry-After is capped
+    assert jobs.retry_delay(1, retry_after=86400) == 60
+
+    monkeypatch.setattr(jobs, "retry_backoff", 0)
+    assert jobs.retry_delay(3) == 0
+
+
+def test_parse_retry_after():
+    assert jobs.parse_retry_after("120") == 120
+    assert jobs.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert 3590 <= jobs.parse_retry_after(
+        email.utils.format_datetime(datetime.now(timezone.utc) + timedelta(hours=1))) <= 3600
+    assert jobs.parse_retry_after("soon") is None
+    assert jobs.parse_retry_after(None) is None
+
+
 @pytest.mark.usefixtures("clean_db")
 class TestSetResourceMetadata(object):
     def test_simple(self):
@@ -14,7 +14,7 @@ from six import text_type as str
 from decimal import Decimal
 
 from ckan.tests import factories
-from ckanext.xloader import loader
+from ckanext.xloader import db, loader
 from ckanext.xloader.loader import get_write_engine
 from ckanext.xloader.job_exceptions import LoaderError
 
@@ -717,6 +717,24 @@ class TestLoadCsv(TestLoadBase):
         ]
         assert len(self._get_records(Session, resource_id)) == 6
 
+    def test_row_count_from_copy(self, Session):
+        csv_filepath = get_sample_filepath("simple.csv")
+        resource_id = factories.Resource()['id']
+        stats = {}
+        with mock.patch("ckanext.xloader.loader._get_rows_count_of_resource") as count_rows:
+            loader.load_csv(
+                csv_filepath,
+                resource_id=resource_id,
+                mimetype="text/csv",
+                logger=logger,
+                stats=stats,
+            )
+        assert stats == {"rows": 6}
+        count_rows.assert_not_called()
+        full_text = Session.connection().execute(sa.text(
+            'SELECT count(*) FROM "{}" WHERE _full_text IS NULL'.format(resource_id))).scalar()
+        assert full_text == 0
+
     def test_reload_fallback(self, Session):
         csv_filepath = get_sample_filepath("simple.csv")
         resource = factories.Resource()
@@ -739,6 +757,158 @@ class TestLoadCsv(TestLoadBase):
                 logger=logger,
             )
 
+    def test_append(self, Session, tmp_path):
+        csv_filepath = get_sample_filepath("simple.csv")
+        resource = factories.Resource()
+        resource_id = resource['id']
+        loader.load_csv(
+            csv_filepath,
+            resource_id=resource_id,
+            mimetype="text/csv",
+            logger=logger,
+        )
+
+        with open(csv_filepath, "rb") as f:
+            original = f.read()
+        grown_filepath = tmp_path / "simple.csv"
+        grown_filepath.write_bytes(original + b"2011-01-04,7, Berkeley \n")
+        loader.append_csv(
+            str(grown_filepath),
+            resource_id=resource_id,
+            offset=len(original),
+            mimetype="text/csv",
+            logger=logger,
+        )
+
+        records = self._get_records(
+            Session, resource_id, exclude_full_text_column=False
+        )
+        assert len(records) == 7
+        # existing rows are untouched
+        assert records[0] == (
+            1,
+            "'-01':2,3 '1':4 '2011':1 'galway':5",
+            u"2011-01-01",
+            u"1",
+            u"Galway",
+        )
+        # new row is stripped and has full text from the trigger
+        assert records[6][0] == 7
+        assert records[6][2:] == (u"2011-01-04", u"7", u"Berkeley")
+        assert "'berkeley'" in records[6][1]
+
+    def test_append_with_changed_columns(self, Session, tmp_path):
+        resource = factories.Resource()
+        resource_id = resource['id']
+        loader.load_csv(
+            get_sample_filepath("simple.csv"),
+            resource_id=resource_id,
+            mimetype="text/csv",
+            logger=logger,
+        )
+
+        csv_filepath = get_sample_filepath("simple-with-extra-column.csv")
+        with pytest.raises(LoaderError):
+            loader.append_csv(
+                csv_filepath,
+                resource_id=resource_id,
+                offset=10,
+                mimetype="text/csv",
+                logger=logger,
+            )
+        assert len(self._get_records(Session, resource_id)) == 6
+
+    @pytest.mark.parametrize("profile", ["freeze", "unlogged"])
+    def test_bulk_load_profile(self, Session, profile):
+        csv_filepath = get_sample_filepath("simple.csv")
+        resource = factories.Resource()
+        resource_id = resource['id']
+        with mock.patch.dict(loader.config, {"ckanext.xloader.bulk_load_profile": profile}):
+            # load twice, so the profile is used on an existing table too
+            for _ in range(2):
+                loader.load_csv(
+                    csv_filepath,
+                    resource_id=resource_id,
+                    mimetype="text/csv",
+                    logger=logger,
+                )
+
+        assert len(self._get_records(Session, resource_id)) == 6
+        persistence = Session.connection().execute(
+            sa.text("SELECT relpersistence FROM pg_class WHERE relname = :name"),
+            {"name": resource_id}).scalar()
+        assert persistence == "p"
+
+    def test_stage_slots(self, Session):
+        csv_filepath = get_sample_filepath("simple.csv")
+        resource = factories.Resource()
+        resource_id = resource['id']
+
+        def advisory_locks():
+            return Session.connection().execute(
+                sa.text("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'")).scalar()
+
+        with mock.patch.dict(loader.config, {"ckanext.xloader.db_slots.copy": "1",
+                                             "ckanext.xloader.db_slots.fulltext": "1"}):
+            with loader.stage_slot("copy", logger):
+                assert advisory_locks() == 1
+            assert advisory_locks() == 0
+
+            loader.load_csv(
+                csv_filepath,
+                resource_id=resource_id,
+                mimetype="text/csv",
+                logger=logger,
+            )
+
+        assert len(self._get_records(Session, resource_id)) == 6
+        assert advisory_locks() == 0
+
+    def test_resume_from_checkpoint(self, Session, ckan_config):
+        db.init(ckan_config)
+        csv_filepath = get_sample_filepath("simple.csv")
+        resource = factories.Resource()
+        resource_id = resource['id']
+        db.delete_checkpoint(resource_id)
+        original_copy_file = loader.copy_file
+        copied_chunks = []
+
+        def copy_file_then_crash(*args, **kwargs):
+            if len(copied_chunks) == 2:
+                raise LoaderError("worker died")
+            copied_chunks.append(args[0])
+            return original_copy_file(*args, **kwargs)
+
+        with mock.patch.dict(loader.config, {"ckanext.xloader.copy_chunk_size": 60}):
+            with mock.patch("ckanext.xloader.loader.copy_file", side_effect=copy_file_then_crash):
+                with pytest.raises(LoaderError):
+                    loader.load_csv(
+                        csv_filepath,
+                        resource_id=resource_id,
+                        mimetype="text/csv",
+                        logger=logger,
+                        file_hash="abc",
+                    )
+            checkpoint = db.get_checkpoint(resource_id)
+            assert checkpoint["stage"] == "copy"
+            assert 0 < checkpoint["rows_loaded"] < 6
+
+            loader.load_csv(
+                csv_filepath,
+                resource_id=resource_id,
+                mimetype="text/csv",
+                logger=logger,
+                file_hash="abc",
+            )
+
+        records = self._get_records(Session, resource_id)
+        assert len(records) == 6
+        assert sorted(r[2] or "" for r in records) == ["", "-1", "0", "1", "5", "6"]
+        assert db.get_checkpoint(resource_id)["stage"] == "indexes"
+        full_text = Session.connection().execute(sa.text(
+            'SELECT count(*) FROM "{}" WHERE _full_text IS NULL'.format(resource_id))).scalar()
+        assert full_text == 0
+
     @pytest.mark.skipif(
         not p.toolkit.check_ckan_version(min_version="2.7"),
         reason="Requires CKAN 2.7 - see https://github.com/ckan/ckan/pull/3557",
@@ -1283,6 +1453,27 @@ class TestLoadTabulator(TestLoadBase):
         assert fields[1].get("info", {}).get("type_override", "") == "numeric"
         assert fields[2].get("info", {}).get("type_override", "") == ""
 
+    @pytest.mark.parametrize("filename,mimetype", [
+        ("simple.xls", "xls"),
+        ("sample_with_blanks.csv", "text/csv"),
+        ("mixed_numeric_string_sample.csv", "text/csv"),
+        ("boston_311_sample.csv", "text/csv"),
+    ])
+    def test_binary_copy_matches_datastore_create(self, Session, filename, mimetype):
+        filepath = get_sample_filepath(filename)
+        text_resource_id = factories.Resource()['id']
+        binary_resource_id = factories.Resource()['id']
+        loader.load_table(filepath, resource_id=text_resource_id,
+                          mimetype=mimetype, logger=logger)
+        with mock.patch.dict(loader.config, {"ckanext.xloader.binary_copy": True}):
+            loader.load_table(filepath, resource_id=binary_resource_id,
+                              mimetype=mimetype, logger=logger)
+
+        assert self._get_column_types(Session, binary_resource_id) == \
+            self._get_column_types(Session, text_resource_id)
+        assert self._get_records(Session, binary_resource_id, exclude_full_text_column=False) == \
+            self._get_records(Session, text_resource_id, exclude_full_text_column=False)
+
     def test_simple_large_file(self, Session):
         csv_filepath = get_sample_filepath("simple-large.csv")
         resource = factories.Resource()
@@ -1873,3 +2064,20 @@ class TestLoadTabulator(TestLoadBase):
                 u"Citizens Connect App",
             ),
         ]  # noqa
+
+
+@pytest.mark.ckan_config("ckanext.xloader.search_update_chunks", "10")
+@pytest.mark.usefixtures("ckan_config")
+def test_populate_fulltext_stops_at_a_failed_chunk_when_checkpointing():
+    connection = mock.MagicMock()
+    connection.execute.side_effect = [None, sa.exc.OperationalError("UPDATE", {}, "timeout"), None]
+    checkpoints = []
+    fields = [{"id": "a", "type": "text"}]
+
+    with pytest.raises(sa.exc.OperationalError):
+        loader._populate_fulltext(connection, "res", fields, logger, last_id=30,
+                                  checkpoint=checkpoints.append)
+
+    # resuming starts again from the chunk that failed
+    assert checkpoints == [10]
+    assert connection.execute.call_count == 2
@@ -0,0 +1,91 @@
+import pytest
+
+from ckan.tests import factories
+
+from ckanext.xloader import metrics
+
+
+def test_sample_name():
+    assert metrics.sample_name("xloader_jobs_total") == "xloader_jobs_total"
+    assert metrics.sample_name("xloader_queue_depth", {"queue": 'a"b'}) == \
+        'xloader_queue_depth{queue="a\\"b"}'
+
+
+def test_render():
+    samples = {
+        'xloader_jobs_total{outcome="error"}': 2.0,
+        'xloader_jobs_total{outcome="complete"}': 5.0,
+        'xloader_stage_duration_seconds_bucket{le="+Inf",stage="copy"}': 1.0,
+        'xloader_stage_duration_seconds_bucket{le="5",stage="copy"}': 1.0,
+        'xloader_stage_duration_seconds_sum{stage="copy"}': 2.5,
+        'xloader_stage_duration_seconds_count{stage="copy"}': 1.0,
+    }
+
+    assert metrics.render(samples) == '''\
+# HELP xloader_jobs_total Finished xloader jobs, by outcome.
+# TYPE xloader_jobs_total counter
+xloader_jobs_total{outcome="complete"} 5
+xloader_jobs_total{outcome="error"} 2
+# HELP xloader_stage_duration_seconds Duration of the stages of the jobs.
+# TYPE xloader_stage_duration_seconds histogram
+xloader_stage_duration_seconds_bucket{le="5",stage="copy"} 1
+xloader_stage_duration_seconds_bucket{le="+Inf",stage="copy"} 1
+xloader_stage_duration_seconds_count{stage="copy"} 1
+xloader_stage_duration_seconds_sum{stage="copy"} 2.5
+'''
+
+
+def test_job_finished():
+    metrics.reset()
+    metrics.job_finished("complete", {
+        "rows": 10,
+        "stages": [
+            {"name": "download", "seconds": 0.2, "bytes": 1000},
+            {"name": "copy", "seconds": 7.0, "rows": 10},
+        ],
+    })
+    metrics.job_finished("retried", {})
+
+    samples = metrics.collect(["default"])
+
+    assert samples['xloader_jobs_in_progress{queue="default"}'] == 0
+    assert samples['xloader_jobs_total{outcome="complete"}'] == 1
+    assert samples['xloader_jobs_total{outcome="retried"}'] == 1
+    assert samples["xloader_retries_total"] == 1
+    assert samples["xloader_downloaded_bytes_total"] == 1000
+    assert samples["xloader_loaded_rows_total"] == 10
+    assert 'xloader_stage_duration_seconds_bucket{le="5",stage="copy"}' not in samples
+    assert samples['xloader_stage_duration_seconds_bucket{le="10",stage="copy"}'] == 1
+    assert samples['xloader_stage_duration_seconds_count{stage="download"}'] == 1
+    assert samples['xloader_queue_depth{queue="default"}'] == 0
+    metrics.reset()
+
+
+@pytest.mark.usefixtures("with_plugins")
+@pytest.mark.ckan_config("ckan.plugins", "datastore xloader")
+class TestMetricsView(object):
+
+    @pytest.mark.usefixtures("clean_db")
+    @pytest.mark.ckan_config("ckanext.xloader.metrics_enabled", "True")
+    def test_metrics(self, app):
+        sysadmin = factories.SysadminWithToken()
+        response = app.get("/xloader/metrics", headers={"Authorization": sysadmin["token"]})
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "# TYPE xloader_jobs_in_progress gauge" in response.get_data(as_text=True)
+
+    @pytest.mark.usefixtures("clean_db")
+    @pytest.mark.ckan_config("ckanext.xloader.metrics_enabled", "True")
+    def test_not_authorized(self, app):
+        app.get("/xloader/metrics", status=403)
+        user = factories.UserWithToken()
+        app.get("/xloader/metrics", headers={"Authorization": user["token"]}, status=403)
+
+    @pytest.mark.ckan_config("ckanext.xloader.metrics_enabled", "True")
+    @pytest.mark.ckan_config("ckanext.xloader.metrics_token", "secret")
+    def test_token(self, app):
+        app.get("/xloader/metrics", headers={"Authorization": "Bearer secret"}, status=200)
+        app.get("/xloader/metrics", headers={"Authorization": "Bearer wrong"}, status=403)
+
+    @pytest.mark.ckan_config("ckanext.xloader.metrics_enabled", "False")
+    def test_disabled(self, app):
+        app.get("/xloader/metrics", status=404)
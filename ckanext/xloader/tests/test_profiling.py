@@ -0,0 +1,23 @@
+from ckanext.xloader import profiling
+
+
+def _work():
+    return [list(range(1000)) for _ in range(100)]
+
+
+def test_profiled():
+    with profiling.profiled() as reports:
+        _work()
+
+    assert "cumulative" in reports["profile_report"]
+    assert "_work" in reports["profile_report"]
+    assert "memory_profile_report" not in reports
+
+
+def test_profiled_memory():
+    with profiling.profiled(memory=True) as reports:
+        kept = _work()
+
+    assert kept
+    assert reports["memory_profile_report"].startswith("Traced memory: current ")
+    assert "test_profiling.py" in reports["memory_profile_report"]
@@ -68,3 +68,64 @@ def test_modify_input_url_no_xloader_site():
     url = "https://ckan.example.org/dataset"
     with patch.dict(toolkit.config, {"ckan.site_url": "https://ckan.example.org", "ckanext.xloader.site_url": None}):
         assert utils.modify_input_url(url) == url
+
+
+@pytest.mark.ckan_config("ckanext.xloader.status_cache_ttl", "60")
+def test_status_cache():
+    resource_id = "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee"
+    utils.invalidate_cached_status(resource_id)
+    assert utils.get_cached_statuses([resource_id]) == {}
+
+    utils.cache_statuses({resource_id: {"status": "pending"}})
+    assert utils.get_cached_statuses([resource_id, "other"]) == {resource_id: {"status": "pending"}}
+
+    utils.invalidate_cached_status(resource_id)
+    assert utils.get_cached_statuses([resource_id]) == {}
+
+
+@pytest.mark.ckan_config("ckanext.xloader.status_cache_ttl", "0")
+def test_status_cache_disabled():
+    resource_id = "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee"
+    utils.cache_statuses({resource_id: {"status": "pending"}})
+    assert utils.get_cached_statuses([resource_id]) == {}
+
+
+def test_record_stage():
+    stats = {}
+    with utils.record_stage(stats, "copy", bytes=10) as stage:
+        stage["rows"] = 2
+    with pytest.raises(ValueError):
+        with utils.record_stage(stats, "fulltext"):
+            raise ValueError()
+
+    assert [stage["name"] for stage in stats["stages"]] == ["copy", "fulltext"]
+    assert stats["stages"][0]["bytes"] == 10
+    assert stats["stages"][0]["rows"] == 2
+    assert "failed" not in stats["stages"][0]
+    assert stats["stages"][1]["failed"]
+    assert all(stage["seconds"] >= 0 for stage in stats["stages"])
+
+
+def test_active_job():
+    resource_id = "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee"
+    job = toolkit.enqueue_job(len, [[]], queue="xloader-test")
+    try:
+        utils.set_active_job(resource_id, job.id)
+        assert utils.get_active_job(resource_id).id == job.id
+
+        # a later job replaced it, so it leaves that one's entry alone
+        utils.clear_active_job(resource_id, "older-job")
+        assert utils.get_active_job(resource_id).id == job.id
+
+        utils.clear_active_job(resource_id, job.id)
+        assert utils.get_active_job(resource_id) is None
+    finally:
+        job.delete()
+
+
+def test_active_job_gone():
+    resource_id = "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee"
+    utils.set_active_job(resource_id, "no-such-job")
+
+    assert utils.get_active_job(resource_id) is None
+    assert not utils.connect_to_redis().hexists(utils.ACTIVE_JOBS_KEY, resource_id)
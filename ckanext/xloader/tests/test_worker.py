@@ -0,0 +1,195 @@
+import multiprocessing
+import time
+
+import pytest
+
+from ckanext.xloader import worker
+
+MiB = worker.MiB
+
+
+def test_estimate_cost():
+    csv = worker.estimate_cost({"resource_size": 100 * MiB, "resource_format": "CSV"})
+    xlsx = worker.estimate_cost({"resource_size": 100 * MiB, "resource_format": "xlsx"})
+
+    assert csv == worker.Cost(memory=worker.CHILD_MEMORY + 50 * MiB, disk=200 * MiB)
+    assert xlsx == worker.Cost(memory=worker.CHILD_MEMORY + 2000 * MiB, disk=1000 * MiB)
+
+
+def test_estimate_cost_of_unknown_size():
+    assert worker.estimate_cost({"resource_size": None}) == \
+        worker.estimate_cost({"resource_size": worker.UNKNOWN_FILE_SIZE})
+
+
+def test_budget():
+    budget = worker.Budget(memory=1000, disk=100)
+    budget.take("a", worker.Cost(memory=600, disk=10))
+
+    assert budget.fits(worker.Cost(memory=400, disk=90))
+    assert not budget.fits(worker.Cost(memory=401, disk=10))
+    assert not budget.fits(worker.Cost(memory=10, disk=91))
+
+    budget.release("a")
+    assert budget.fits(worker.Cost(memory=400, disk=90))
+
+
+def test_budget_runs_a_big_job_on_its_own():
+    budget = worker.Budget(memory=1000, disk=100)
+
+    assert budget.fits(worker.Cost(memory=5000, disk=500))
+    budget.take("big", worker.Cost(memory=5000, disk=500))
+    assert not budget.fits(worker.Cost(memory=1, disk=1))
+
+
+def test_no_budget():
+    budget = worker.Budget()
+    budget.take("a", worker.Cost(memory=10 ** 12, disk=10 ** 12))
+
+    assert budget.fits(worker.Cost(memory=10 ** 12, disk=10 ** 12))
+
+
+class FakeProcess(object):
+    sentinel = None
+
+    def is_alive(self):
+        return True
+
+
+def test_recycled_slot_is_not_idle():
+    pool = worker.Pool(["default"], slots=2, max_jobs_per_child=3)
+    recycling = worker._Slot(FakeProcess(), None)
+    recycling.jobs_done = 3
+    busy = worker._Slot(FakeProcess(), None)
+    busy.job_id = "a"
+    idle = worker._Slot(FakeProcess(), None)
+    pool._slots = [recycling, busy, idle]
+
+    assert pool._idle_slot() is idle
+
+
+def _exit():
+    pass
+
+
+def test_dead_child_while_stopping(monkeypatch):
+    pool = worker.Pool(["default"], slots=1, budget=worker.Budget(memory=1000))
+    context = multiprocessing.get_context("fork")
+    parent_connection, child_connection = context.Pipe()
+    process = context.Process(target=_exit)
+    process.start()
+    process.join()
+    slot = worker._Slot(process, parent_connection)
+    slot.job_id = "a"
+    pool.budget.take("a", worker.Cost(memory=600, disk=0))
+    pool._slots = [slot]
+    pool._stopping = True
+    failed = []
+    monkeypatch.setattr(pool, "_fail_job", lambda job_id, reason: failed.append(job_id))
+
+    pool._collect(timeout=0)
+    # the closed connection of the dead child isn't waited on again
+    pool._collect(timeout=0)
+
+    assert failed == ["a"]
+    assert slot.job_id is None
+    assert pool._slots == []
+    assert not pool._busy()
+    assert pool.budget.used == {}
+
+
+class ExitingProcess(object):
+    """A child that reports its job finished and exits just after the
+    supervisor has read its connection."""
+
+    exitcode = 0
+    sentinel = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def is_alive(self):
+        self.connection.send("a")
+        self.connection.close()
+        return False
+
+    def join(self):
+        pass
+
+
+def test_child_exits_after_reporting_its_job(monkeypatch):
+    pool = worker.Pool(["default"], slots=1)
+    parent_connection, child_connection = multiprocessing.Pipe()
+    slot = worker._Slot(ExitingProcess(child_connection), parent_connection)
+    slot.job_id = "a"
+    pool._slots = [slot]
+    failed = []
+    monkeypatch.setattr(pool, "_fail_job", lambda job_id, reason: failed.append(job_id))
+    monkeypatch.setattr(worker, "wait", lambda objects, timeout: [])
+    monkeypatch.setattr(pool, "_spawn", lambda: "replacement")
+
+    pool._collect(timeout=0)
+
+    assert failed == []
+    assert slot.jobs_done == 1
+    assert pool._slots == ["replacement"]
+
+
+def test_crashed_child_is_replaced_after_a_while(monkeypatch):
+    pool = worker.Pool(["default"], slots=1)
+    context = multiprocessing.get_context("fork")
+    spawned = []
+
+    def spawn():
+        spawned.append(worker._Slot(FakeProcess(), context.Pipe()[0]))
+        return spawned[-1]
+    monkeypatch.setattr(pool, "_fail_job", lambda job_id, reason: None)
+    monkeypatch.setattr(pool, "_spawn", spawn)
+    monkeypatch.setattr(worker, "wait", lambda objects, timeout: [])
+
+    for crash in range(2):
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target=_exit)
+        process.start()
+        process.join()
+        slot = worker._Slot(process, parent_connection)
+        slot.job_id = "a"
+        pool._slots = [slot]
+        pool._collect(timeout=0)
+
+    assert spawned == []
+    assert pool._slots == []
+    first, second = [respawn - time.monotonic() for respawn in pool._respawns]
+    assert 0 < first <= worker.RESPAWN_BACKOFF
+    assert worker.RESPAWN_BACKOFF < second <= 2 * worker.RESPAWN_BACKOFF
+
+    pool._respawns[0] = 0
+    pool._collect(timeout=0)
+
+    assert pool._slots == spawned
+    assert len(spawned) == 1
+    assert len(pool._respawns) == 1
+
+
+def test_job_waits_on_its_queue_for_room():
+    fakeredis = pytest.importorskip("fakeredis")
+    rq = pytest.importorskip("rq")
+    connection = fakeredis.FakeStrictRedis()
+    queue = rq.Queue("default", connection=connection)
+    big = queue.enqueue(len, {"metadata": {"resource_size": 500, "resource_format": "CSV"}})
+    pool = worker.Pool(["default"], budget=worker.Budget(memory=worker.CHILD_MEMORY + 300))
+    pool.connection = connection
+    pool.budget.take("running", worker.Cost(memory=worker.CHILD_MEMORY, disk=0))
+
+    job, cost = pool._claim([queue])
+
+    assert job is None
+    assert cost == worker.estimate_cost({"resource_size": 500, "resource_format": "CSV"})
+    # so it is still there if the supervisor dies
+    assert queue.get_job_ids() == [big.id]
+
+    pool.budget.release("running")
+    job, cost = pool._claim([queue])
+
+    assert job.id == big.id
+    assert queue.get_job_ids() == []
+    assert pool._claim([queue]) == (None, None)
@@ -1,23 +1,42 @@
 # encoding: utf-8
 
 from collections import defaultdict
+import contextlib
 from decimal import Decimal
 import json
 import datetime
 import logging
 import os
 import re
+import time
 from six import text_type as str, binary_type
 from urllib.parse import urlunparse, urlparse
 
 from ckan import model
 from ckan.lib import search
+from ckan.lib.redis import connect_to_redis
 import ckan.plugins.toolkit as tk
 
 from .job_exceptions import JobError
 
 log = logging.getLogger(__name__)
 
+STATUS_CACHE_KEY = 'ckanext-xloader:status:{}'
+# Hash of the id of the queued or running job of each resource
+ACTIVE_JOBS_KEY = 'ckanext-xloader:active-jobs'
+# Options of the load to run once the current one finishes, by resource
+FOLLOW_UP_KEY = 'ckanext-xloader:follow-up:{}'
+# RQ job statuses of the jobs that are yet to finish
+ACTIVE_JOB_STATUSES = ('queued', 'started', 'deferred', 'scheduled')
+
+# xloader statuses of jobs that are still writing log lines. A job is
+# 'running_but_viewable' while it builds the indexes after the data is in.
+IN_PROGRESS_STATUSES = ('submitting', 'pending', 'running', 'running_but_viewable')
+# Most log lines returned by one request to resource_data_logs
+LOGS_PAGE_SIZE = 500
+# Seconds between the checks for new log lines while long polling
+LOGS_POLL_INTERVAL = 1
+
 
 # resource.formats accepted by ckanext-xloader. Must be lowercase here.
 DEFAULT_FORMATS = [
@@ -151,6 +170,8 @@ def resource_data(id, resource_id, rows=None):
         "status": xloader_status,
         "resource": resource,
         "pkg_dict": pkg_dict,
+        "logs_poll_timeout": _logs_poll_timeout(),
+        "in_progress_statuses": IN_PROGRESS_STATUSES,
     }
     if rows:
         extra_vars["rows"] = rows
@@ -160,6 +181,243 @@ def resource_data(id, resource_id, rows=None):
     )
 
 
+def resource_data_logs(resource_id, after=0, wait=0, job_id=None):
+    """ Returns the log lines of the resource's latest job after the first
+    `after` of them, with the job's status and progress counters, for the
+    resource_data page to follow a running load.
+
+    `after` counts the lines of job `job_id`. If the latest job is another
+    one (e.g. a retry), its lines are returned from the first, with
+    `job_changed` set.
+
+    If there are no new log lines and the job hasn't finished, waits up to
+    `wait` seconds (capped by ckanext.xloader.logs_poll_timeout) for some.
+    """
+    wait = min(wait, _logs_poll_timeout())
+    deadline = time.monotonic() + wait
+    job_changed = False
+    while True:
+        try:
+            status = tk.get_action("xloader_status")(None, {
+                "resource_id": resource_id,
+                "logs_offset": after,
+                "logs_limit": LOGS_PAGE_SIZE,
+            })
+        except tk.ObjectNotFound:
+            status = {}
+        if job_id and status.get('job_id') and status['job_id'] != job_id:
+            job_id = status['job_id']
+            job_changed = True
+            if after:
+                after = 0
+                continue
+        job = status.get('task_info') or {}
+        finished = status.get('status') not in IN_PROGRESS_STATUSES
+        if job.get('logs') or finished or time.monotonic() >= deadline:
+            break
+        time.sleep(LOGS_POLL_INTERVAL)
+
+    logs = job.get('logs', [])
+    return {
+        "status": status.get('status'),
+        "status_description": tk.h.xloader_status_description(status),
+        "job_id": status.get('job_id'),
+        "job_changed": job_changed,
+        "last_updated": status.get('last_updated'),
+        "finished": finished,
+        "logs": logs,
+        "next": after + len(logs),
+        "progress": _job_progress(resource_id, job),
+    }
+
+
+def _logs_poll_timeout():
+    return int(tk.config.get('ckanext.xloader.logs_poll_timeout', 0) or 0)
+
+
+def _job_progress(resource_id, job):
+    from ckanext.xloader import db
+
+    progress = {"logs": job.get('logs_count', 0)}
+    if job.get('requested_timestamp'):
+        end = datetime.datetime.fromisoformat(job['finished_timestamp']) \
+            if job.get('finished_timestamp') else datetime.datetime.utcnow()
+        progress["elapsed_seconds"] = round(
+            (end - datetime.datetime.fromisoformat(job['requested_timestamp'])).total_seconds())
+    if job and not job.get('finished_timestamp'):
+        # only resumable loads record how far the copy has got
+        checkpoint = db.get_checkpoint(resource_id)
+        if checkpoint:
+            progress["stage"] = checkpoint['stage']
+            progress["rows_loaded"] = checkpoint['rows_loaded']
+            progress["bytes_loaded"] = checkpoint['byte_offset']
+    return progress
+
+
+def _status_cache_ttl():
+    return int(tk.config.get('ckanext.xloader.status_cache_ttl', 60) or 0)
+
+
+def get_cached_statuses(resource_ids):
+    """ Returns the xloader statuses of those resources that are in the
+    status cache, by resource id. Resources that have never been submitted
+    are cached as an empty dict.
+    """
+    if not _status_cache_ttl() or not resource_ids:
+        return {}
+    try:
+        values = connect_to_redis().mget(
+            [STATUS_CACHE_KEY.format(resource_id) for resource_id in resource_ids])
+    except Exception:
+        log.exception('Could not read the xloader status cache')
+        return {}
+    return {resource_id: json.loads(value)
+            for resource_id, value in zip(resource_ids, values)
+            if value is not None}
+
+
+def cache_statuses(statuses):
+    """ Stores xloader statuses, by resource id, in the status cache for
+    ckanext.xloader.status_cache_ttl seconds.
+    """
+    ttl = _status_cache_ttl()
+    if not ttl or not statuses:
+        return
+    try:
+        pipeline = connect_to_redis().pipeline()
+        for resource_id, status in statuses.items():
+            pipeline.setex(STATUS_CACHE_KEY.format(resource_id), ttl, json.dumps(status))
+        pipeline.execute()
+    except Exception:
+        log.exception('Could not write to the xloader status cache')
+
+
+def invalidate_cached_status(resource_id):
+    """ Removes a resource's xloader status from the status cache, because it
+    has changed.
+    """
+    invalidate_cached_statuses([resource_id])
+
+
+def invalidate_cached_statuses(resource_ids):
+    """ Removes the xloader statuses of the resources from the status cache,
+    with one Redis command.
+    """
+    if not _status_cache_ttl() or not resource_ids:
+        return
+    try:
+        connect_to_redis().delete(
+            *[STATUS_CACHE_KEY.format(resource_id) for resource_id in resource_ids])
+    except Exception:
+        log.exception('Could not clear the xloader status cache')
+
+
+def set_active_job(resource_id, job_id):
+    """ Records the job as the one queued (or running) for the resource, for
+    get_active_job.
+    """
+    set_active_jobs({resource_id: job_id})
+
+
+def set_active_jobs(job_ids):
+    """ Records the jobs, by resource id, as set_active_job does, with one
+    Redis command.
+    """
+    if not job_ids:
+        return
+    try:
+        connect_to_redis().hset(ACTIVE_JOBS_KEY, mapping=job_ids)
+    except Exception:
+        log.exception('Could not record the xloader jobs of resources %s',
+                      ', '.join(job_ids))
+
+
+def clear_active_job(resource_id, job_id):
+    """ Forgets the resource's job, once it has finished, unless another one
+    has been recorded for the resource since.
+    """
+    try:
+        connect_to_redis().eval(
+            "if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then "
+            "return redis.call('hdel', KEYS[1], ARGV[1]) end return 0",
+            1, ACTIVE_JOBS_KEY, resource_id, job_id)
+    except Exception:
+        log.exception('Could not clear the xloader job of resource %s', resource_id)
+
+
+def get_active_job(resource_id):
+    """ Returns the RQ job that is queued, or running, to xload the resource,
+    on whichever queue, or None. Only looks up that job, rather than going
+    through the queues.
+    """
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+
+    redis = connect_to_redis()
+    job_id = redis.hget(ACTIVE_JOBS_KEY, resource_id)
+    if not job_id:
+        return None
+    if isinstance(job_id, bytes):
+        job_id = job_id.decode('utf-8')
+    try:
+        job = Job.fetch(job_id, connection=redis)
+    except NoSuchJobError:
+        job = None
+    if job is None or job.get_status() not in ACTIVE_JOB_STATUSES:
+        # it finished without clearing its entry, e.g. the worker was killed
+        clear_active_job(resource_id, job_id)
+        return None
+    return job
+
+
+def coalesce_into_job(job, ignore_hash=False):
+    """ Folds a submit into the resource's queued job, rather than queueing
+    another job that would load the same thing: the queued job loads the
+    resource as it is when it starts anyway. Only ignore_hash needs passing
+    on, in the job's meta.
+    """
+    if ignore_hash and not job.meta.get('ignore_hash'):
+        job.meta['ignore_hash'] = True
+        job.save_meta()
+
+
+def request_follow_up(resource_id, ignore_hash=False, ttl=3600):
+    """ Asks for the resource to be loaded again once the load that is
+    running finishes (see pop_follow_up). However many times this is called
+    during a load, there is one follow-up load.
+
+    :param ttl: seconds after which the request lapses, in case the load
+        never finishes
+    """
+    key = FOLLOW_UP_KEY.format(resource_id)
+    try:
+        redis = connect_to_redis()
+        if ignore_hash:
+            redis.set(key, json.dumps({'ignore_hash': True}), ex=ttl)
+        else:
+            # don't lose an ignore_hash asked for earlier
+            redis.set(key, json.dumps({'ignore_hash': False}), ex=ttl, nx=True)
+    except Exception:
+        log.exception('Could not request a follow-up load of resource %s', resource_id)
+
+
+def pop_follow_up(resource_id):
+    """ Returns the options of the follow-up load asked for by
+    request_follow_up during the resource's last load, as a dict, or None
+    if none was, and clears the request.
+    """
+    key = FOLLOW_UP_KEY.format(resource_id)
+    try:
+        pipeline = connect_to_redis().pipeline()
+        pipeline.get(key)
+        pipeline.delete(key)
+        value, _deleted = pipeline.execute()
+    except Exception:
+        log.exception('Could not get the follow-up load of resource %s', resource_id)
+        return None
+    return json.loads(value) if value else None
+
+
 def get_xloader_user_apitoken():
     """ Returns the API Token for authentication.
 
@@ -387,6 +645,29 @@ def type_guess(rows, types=TYPES, strict=False):
     return _columns
 
 
+@contextlib.contextmanager
+def record_stage(stats, name, **fields):
+    """ Times a stage of a job, such as the download or a COPY, and appends
+    it to the list in stats['stages'], as a dict of its name, its duration in
+    seconds and any other fields given (such as 'bytes' or 'rows'). The
+    block can add fields to the dict that it is given. A stage that raises
+    an exception is recorded with 'failed': True.
+
+    Nothing is recorded if stats is None.
+    """
+    stage = dict(name=name, **fields)
+    start = time.monotonic()
+    try:
+        yield stage
+    except BaseException:
+        stage['failed'] = True
+        raise
+    finally:
+        stage['seconds'] = round(time.monotonic() - start, 3)
+        if stats is not None:
+            stats.setdefault('stages', []).append(stage)
+
+
 def datastore_resource_exists(resource_id):
     context = {'model': model, 'ignore_auth': True}
     try:
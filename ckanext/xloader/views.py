@@ -1,7 +1,14 @@
-from flask import Blueprint
+import hmac
 
-from ckan.plugins.toolkit import _, h, g, render, request, abort, NotAuthorized, get_action, ObjectNotFound
+from flask import Blueprint, jsonify, make_response
 
+from ckan.plugins.toolkit import (
+    _, h, g, render, request, abort, NotAuthorized, get_action, ObjectNotFound,
+    check_access, config,
+)
+
+import ckanext.xloader.jobs as jobs
+import ckanext.xloader.metrics as metrics
 import ckanext.xloader.utils as utils
 
 
@@ -25,6 +32,39 @@ def resource_data(id, resource_id):
     return utils.resource_data(id, resource_id, rows)
 
 
+@xloader.route("/dataset/<id>/resource_data/<resource_id>/logs")
+def resource_data_logs(id, resource_id):
+    try:
+        after = max(int(request.args.get('after', 0)), 0)
+        wait = max(int(request.args.get('wait', 0)), 0)
+    except ValueError:
+        return abort(400, _('"after" and "wait" must be integers'))
+    try:
+        return jsonify(utils.resource_data_logs(
+            resource_id, after, wait, request.args.get('job_id')))
+    except NotAuthorized:
+        return abort(403, _('Not authorized to see this page'))
+
+
+@xloader.route("/xloader/metrics")
+def metrics_view():
+    if not jobs.metrics_enabled:
+        return abort(404)
+    token = config.get('ckanext.xloader.metrics_token')
+    if not (token and hmac.compare_digest(
+            request.headers.get('Authorization', ''), 'Bearer ' + token)):
+        try:
+            check_access('xloader_metrics', {'user': g.user})
+        except NotAuthorized:
+            return abort(403, _('Not authorized to see this page'))
+    queue_names = jobs.default_queue_names
+    if jobs.large_file_size:
+        queue_names = queue_names + jobs.large_file_queue_names
+    response = make_response(metrics.render(metrics.collect(queue_names)))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
 @xloader.route("/dataset/<id>/delete-datastore/<resource_id>", methods=("GET", "POST"))
 def delete_datastore_table(id, resource_id):
     if u'cancel' in request.form:
@@ -0,0 +1,79 @@
+/* Follows the upload log of a running xloader job.
+ *
+ * Asks the logs endpoint for the log lines after the ones already shown,
+ * appends them to the log and updates the progress line. Once the job has
+ * finished, or been replaced by another (e.g. a retry), reloads the page.
+ *
+ * url - the logs endpoint of the resource
+ * job_id - the job whose log is shown
+ * after - the number of log lines already shown
+ * wait - the seconds the endpoint may wait for new log lines
+ */
+this.ckan.module('xloader-log', function ($) {
+  return {
+    options: {
+      url: null,
+      job_id: null,
+      after: 0,
+      wait: 0
+    },
+
+    initialize: function () {
+      this.after = parseInt(this.options.after, 10) || 0;
+      this.end = this.el.find('.xloader-log-end');
+      this.progress = this.el.find('.xloader-log-progress');
+      this.poll();
+    },
+
+    poll: function () {
+      $.getJSON(this.options.url, {
+        job_id: this.options.job_id, after: this.after, wait: this.options.wait
+      })
+        .done($.proxy(this.update, this))
+        .fail($.proxy(function () {
+          window.setTimeout($.proxy(this.poll, this), 10000);
+        }, this));
+    },
+
+    update: function (data) {
+      if (data.finished || data.job_changed) {
+        window.location.reload();
+        return;
+      }
+      $.each(data.logs, $.proxy(function (index, item) {
+        this.end.before(this.renderItem(item));
+      }, this));
+      this.after = data.next;
+      this.progress.text(this.renderProgress(data));
+      // long polling returns as soon as there is something new; without it,
+      // don't ask again straight away
+      var delay = (data.logs.length || parseInt(this.options.wait, 10)) ? 0 : 3000;
+      window.setTimeout($.proxy(this.poll, this), delay);
+    },
+
+    renderItem: function (item) {
+      var ok = item.level === 'INFO';
+      var message = $('<p>');
+      $.each($.trim(item.message).split('\n'), function (index, line) {
+        message.append(document.createTextNode(line), '<br>');
+      });
+      message.append($('<span class="date">').text(item.timestamp.replace('T', ' ').split('.')[0]));
+      return $('<li class="item no-avatar">')
+        .addClass(ok ? 'success' : 'failure')
+        .append($('<i class="fa icon">').addClass(ok ? 'fa-ok' : 'fa-exclamation'))
+        .append(message);
+    },
+
+    renderProgress: function (data) {
+      var progress = data.progress;
+      var parts = [data.status_description];
+      if (progress.rows_loaded) {
+        parts.push(this._('{rows} rows loaded').replace('{rows}', progress.rows_loaded));
+      }
+      if (progress.elapsed_seconds !== undefined) {
+        parts.push(this._('{seconds}s elapsed').replace('{seconds}', progress.elapsed_seconds));
+      }
+      return parts.join(' · ');
+    }
+  };
+});
@@ -0,0 +1,401 @@
+# encoding: utf-8
+'''A worker that runs several xloader jobs at once, started with
+``ckan xloader worker``.
+
+A supervisor process takes the jobs off the RQ queues and hands each to one
+of ``ckanext.xloader.worker.slots`` child processes, which run it as an RQ
+worker would (so the job registries, timeouts and results are as usual).
+Before a job is handed out, its peak memory and temporary disk use are
+estimated from the size and format of its file, and it waits until the jobs
+running leave room for it in ``ckanext.xloader.worker.memory_budget`` and
+``ckanext.xloader.worker.disk_budget``. A job bigger than the whole budget
+runs on its own. Each child exits after
+``ckanext.xloader.worker.max_jobs_per_child`` jobs and is replaced, so memory
+leaked by the parsing libraries (tabulator, openpyxl) is given back.
+
+The first SIGINT or SIGTERM stops the supervisor taking jobs, and it exits
+once the running ones have finished; a second one kills them.
+'''
+import collections
+import itertools
+import logging
+import multiprocessing
+import signal
+import time
+from multiprocessing.connection import wait
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 ** 2
+# Memory used by a child before it loads anything
+CHILD_MEMORY = 200 * MiB
+# Assumed size of the files of resources whose size isn't recorded
+UNKNOWN_FILE_SIZE = 50 * MiB
+# Peak memory and temporary disk space of a load, as multiples of the size of
+# the file, by format. CSV files are streamed, while spreadsheets are read
+# into memory and converted to a CSV file, which is larger than the
+# (compressed) spreadsheet.
+MEMORY_FACTORS = {'XLSX': 20, 'XLS': 10, 'ODS': 20}
+DEFAULT_MEMORY_FACTOR = 0.5
+DISK_FACTORS = {'XLSX': 10, 'XLS': 4, 'ODS': 10}
+DEFAULT_DISK_FACTOR = 2
+# Seconds between checks of the children and of the stop signals
+POLL_INTERVAL = 1
+# Seconds before replacing a child that crashed, doubled for each crash in a
+# row up to RESPAWN_BACKOFF_MAX
+RESPAWN_BACKOFF = 1
+RESPAWN_BACKOFF_MAX = 60
+
+
+Cost = collections.namedtuple('Cost', ['memory', 'disk'])
+
+
+def estimate_cost(metadata):
+    '''Returns the estimated peak memory and temporary disk space, in bytes,
+    of the job with this metadata.
+
+    :rtype: Cost
+    '''
+    try:
+        size = int(metadata.get('resource_size'))
+    except (TypeError, ValueError):
+        size = UNKNOWN_FILE_SIZE
+    format_ = (metadata.get('resource_format') or '').upper()
+    return Cost(
+        memory=CHILD_MEMORY + int(size * MEMORY_FACTORS.get(format_, DEFAULT_MEMORY_FACTOR)),
+        disk=int(size * DISK_FACTORS.get(format_, DEFAULT_DISK_FACTOR)),
+    )
+
+
+class Budget(object):
+    '''The memory and disk space, in bytes, that the running jobs may use.
+
+    :param memory: the memory budget, 0 for no limit
+    :param disk: the disk space budget, 0 for no limit
+    '''
+
+    def __init__(self, memory=0, disk=0):
+        self.memory = memory
+        self.disk = disk
+        self.used = {}
+
+    def fits(self, cost):
+        '''Returns whether a job of this cost can start now.'''
+        if not self.used:
+            # a job bigger than the budget still runs, on its own
+            return True
+        memory = sum(used.memory for used in self.used.values()) + cost.memory
+        disk = sum(used.disk for used in self.used.values()) + cost.disk
+        return (not self.memory or memory <= self.memory) \
+            and (not self.disk or disk <= self.disk)
+
+    def take(self, job_id, cost):
+        self.used[job_id] = cost
+
+    def release(self, job_id):
+        self.used.pop(job_id, None)
+
+
+class _Slot(object):
+    '''A child process and the job it is running.'''
+
+    def __init__(self, process, connection):
+        self.process = process
+        self.connection = connection
+        self.job_id = None
+        self.jobs_done = 0
+
+
+class Pool(object):
+    '''Runs the jobs of the RQ queues in several child processes, within a
+    memory and disk budget.
+
+    :param queue_names: the names of the queues to take jobs from, in order
+        of priority
+    :param slots: the number of child processes
+    :param budget: the memory and disk budget
+    :type budget: Budget
+    :param max_jobs_per_child: the number of jobs after which a child is
+        replaced, 0 for never
+    '''
+
+    def __init__(self, queue_names, slots=4, budget=None, max_jobs_per_child=0):
+        self.queue_names = queue_names
+        self.slots = slots
+        self.budget = budget or Budget()
+        self.max_jobs_per_child = max_jobs_per_child
+        self._context = multiprocessing.get_context('fork')
+        self._slots = []
+        self._stopping = False
+        # when to replace the children that crashed
+        self._respawns = []
+        self._crashes = 0
+
+    def run(self, burst=False):
+        '''Runs jobs until stopped by a signal or, with burst, until the
+        queues are empty.'''
+        from ckan.lib.jobs import get_queue
+        from ckan.lib.redis import connect_to_redis
+        from ckan.plugins.toolkit import config
+
+        from ckanext.xloader import db, fair_share, jobs
+
+        self.connection = connect_to_redis()
+        queues = [get_queue(name) for name in self.queue_names]
+        # so that the children, and their jobs, find the tables created
+        db.init(config)
+        self._install_signal_handlers()
+        self._slots = [self._spawn() for _ in range(self.slots)]
+        log.info('xloader worker started with %s slots, on queues: %s',
+                 self.slots, ', '.join(self.queue_names))
+        retries_checked = 0
+        try:
+            while not self._stopping:
+                self._collect(timeout=0)
+                if time.time() - retries_checked >= POLL_INTERVAL:
+                    # as an RQ worker with --with-scheduler would
+                    jobs.enqueue_due_retries()
+                    if jobs.fair_share_enabled:
+                        # in case the jobs that would have done it were killed
+                        fair_share.dispatch()
+                    retries_checked = time.time()
+                if self._idle_slot() is None:
+                    self._collect(timeout=POLL_INTERVAL)
+                    continue
+                job, cost = self._claim(queues)
+                if job is None:
+                    if cost is None and burst and not self._busy():
+                        break
+                    # the queues are empty, or the next job has to wait for
+                    # running ones to make room
+                    self._collect(timeout=POLL_INTERVAL)
+                    continue
+                self._start(self._idle_slot(), job, cost)
+            while self._busy():
+                self._collect(timeout=POLL_INTERVAL)
+        finally:
+            self._stop_children()
+        log.info('xloader worker stopped')
+
+    def _claim(self, queues):
+        '''Takes the job at the head of the first queue that has one off
+        the queue, if it fits in the budget. The job is left on the queue
+        until then, so that it isn't lost if the supervisor dies while it
+        waits.
+
+        :returns: (job, cost); (None, cost) if the job has to wait; or
+            (None, None) if the queues are empty
+        '''
+        from rq.exceptions import NoSuchJobError
+        from rq.job import Job
+
+        while True:
+            for queue in queues:
+                job_ids = queue.get_job_ids(0, 1)
+                if job_ids:
+                    break
+            else:
+                return None, None
+            job_id = job_ids[0]
+            try:
+                job = Job.fetch(job_id, connection=self.connection)
+            except NoSuchJobError:
+                # deleted while queued; RQ skips these too
+                self.connection.lrem(queue.key, 1, job_id)
+                continue
+            cost = estimate_cost(_job_metadata(job))
+            if not self.budget.fits(cost):
+                return None, cost
+            # unless another worker has just taken it
+            if self.connection.lrem(queue.key, 1, job_id):
+                return job, cost
+
+    def _install_signal_handlers(self):
+        def handle(signum, frame):
+            if self._stopping:
+                log.warning('Killing the running jobs')
+                for slot in self._slots:
+                    slot.process.kill()
+                raise SystemExit(1)
+            log.info('Stopping once the running jobs have finished')
+            self._stopping = True
+
+        signal.signal(signal.SIGINT, handle)
+        signal.signal(signal.SIGTERM, handle)
+
+    def _spawn(self):
+        from ckan import model
+
+        # the child must not share the parent's database connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_run_child,
+            args=(child_connection, self.queue_names, self.max_jobs_per_child),
+            daemon=True)
+        process.start()
+        child_connection.close()
+        return _Slot(process, parent_connection)
+
+    def _busy(self):
+        return any(slot.job_id for slot in self._slots)
+
+    def _idle_slot(self):
+        for slot in self._slots:
+            if slot.job_id is None and slot.process.is_alive() and not (
+                    self.max_jobs_per_child and slot.jobs_done >= self.max_jobs_per_child):
+                return slot
+        return None
+
+    def _start(self, slot, job, cost):
+        log.info('Starting job %s ("%s"), estimated to use %d MiB of memory and '
+                 '%d MiB of disk', job.id, job.meta.get('title'),
+                 cost.memory // MiB, cost.disk // MiB)
+        self.budget.take(job.id, cost)
+        slot.job_id = job.id
+        try:
+            slot.connection.send(job.id)
+        except OSError:
+            # the child has just died; _collect fails the job
+            pass
+
+    def _collect(self, timeout):
+        '''Waits up to timeout seconds for children to finish their jobs or
+        exit, then replaces the children that have exited (after a while, if
+        they crashed).'''
+        if not self._stopping:
+            now = time.monotonic()
+            self._slots += [self._spawn() for respawn in self._respawns if respawn <= now]
+            self._respawns = [respawn for respawn in self._respawns if respawn > now]
+        wait([slot.connection for slot in self._slots]
+             + [slot.process.sentinel for slot in self._slots], timeout)
+        slots = []
+        for slot in self._slots:
+            self._receive(slot)
+            if slot.process.is_alive():
+                slots.append(slot)
+                continue
+            slot.process.join()
+            # it may have reported its last job between the two
+            self._receive(slot)
+            crashed = slot.process.exitcode != 0 or slot.job_id
+            if slot.job_id:
+                log.error('The process running job %s exited with code %s',
+                          slot.job_id, slot.process.exitcode)
+                self._fail_job(slot.job_id, 'The xloader worker process exited with code {}'
+                               .format(slot.process.exitcode))
+                self.budget.release(slot.job_id)
+                slot.job_id = None
+            slot.connection.close()
+            # while stopping, the slot is dropped, as wait can't be given
+            # its closed connection
+            if self._stopping:
+                continue
+            if not crashed:
+                self._crashes = 0
+                slots.append(self._spawn())
+                continue
+            delay = min(RESPAWN_BACKOFF * 2 ** self._crashes, RESPAWN_BACKOFF_MAX)
+            self._crashes += 1
+            log.warning('Replacing the process in %ss', delay)
+            self._respawns.append(time.monotonic() + delay)
+        self._slots = slots
+
+    def _receive(self, slot):
+        '''Frees the slot of the job its child has reported finished.'''
+        try:
+            while slot.connection.poll():
+                slot.connection.recv()
+                self.budget.release(slot.job_id)
+                slot.job_id = None
+                slot.jobs_done += 1
+        except (EOFError, OSError):
+            pass
+
+    def _fail_job(self, job_id, reason):
+        '''Moves a job whose process died to the failed job registry, as RQ
+        does with the jobs of a worker that died.'''
+        from rq import Queue
+        from rq.exceptions import NoSuchJobError
+        from rq.job import Job, JobStatus
+
+        try:
+            job = Job.fetch(job_id, connection=self.connection)
+            queue = Queue(job.origin, connection=self.connection)
+            registry = queue.started_job_registry
+            # RQ 2 records each execution of the job in the registry
+            getattr(registry, 'remove_executions', registry.remove)(job)
+            job.set_status(JobStatus.FAILED)
+            queue.failed_job_registry.add(job, exc_string=reason)
+        except NoSuchJobError:
+            pass
+        except Exception:
+            log.exception('Could not mark job %s as failed', job_id)
+
+    def _stop_children(self):
+        for slot in self._slots:
+            if slot.process.is_alive():
+                try:
+                    slot.connection.send(None)
+                except (EOFError, OSError):
+                    pass
+        for slot in self._slots:
+            slot.process.join(POLL_INTERVAL * 5)
+            if slot.process.is_alive():
+                slot.process.kill()
+
+
+def _job_metadata(job):
+    try:
+        return job.args[0]['metadata']
+    except (IndexError, KeyError, TypeError):
+        return {}
+
+
+def _run_child(connection, queue_names, max_jobs):
+    '''Runs the jobs the supervisor sends, as an RQ worker, until it sends
+    None or max_jobs have run.'''
+    from ckan.lib.jobs import Worker
+    from rq import Queue
+    from rq.job import Job
+
+    # stopping is up to the supervisor, which waits for the running job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker = Worker(queue_names)
+    worker.register_birth()
+    try:
+        for _ in (range(max_jobs) if max_jobs else itertools.count()):
+            job_id = connection.recv()
+            if job_id is None:
+                break
+            job = Job.fetch(job_id, connection=worker.connection)
+            worker.perform_job(job, Queue(job.origin, connection=worker.connection))
+            connection.send(job_id)
+    except EOFError:
+        # the supervisor has gone
+        pass
+    finally:
+        worker.register_death()
+
+
+def get_pool(queue_names=None, slots=None):
+    '''Returns a Pool configured by the ckanext.xloader.worker.* options,
+    on the xloader queues (including the large file ones) by default.'''
+    from ckan.plugins.toolkit import config
+    from ckanext.xloader import jobs
+
+    if not queue_names:
+        queue_names = list(jobs.default_queue_names)
+        if jobs.large_file_size:
+            queue_names += jobs.large_file_queue_names
+    return Pool(
+        queue_names,
+        slots=slots or int(config.get('ckanext.xloader.worker.slots') or 4),
+        budget=Budget(
+            memory=int(config.get('ckanext.xloader.worker.memory_budget') or 0) * MiB,
+            disk=int(config.get('ckanext.xloader.worker.disk_budget') or 0) * MiB,
+        ),
+        max_jobs_per_child=int(config.get('ckanext.xloader.worker.max_jobs_per_child') or 0),
+    )
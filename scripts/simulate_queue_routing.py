@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Shows how evenly jobs.get_default_queue_name spreads datasets over the
+queues, compared with the earlier routing by the first character of the
+package id.
+
+Usage:
+
+    python scripts/simulate_queue_routing.py [--ckan-url https://demo.ckan.org] [ids.txt ...]
+
+The package ids are read from the files (one per line), or fetched from the
+package_search API of a CKAN site, or else random UUIDs are used. For each
+number of queues up to --max-queues, it prints the share of the datasets
+that the busiest and the idlest queue get (1.00 is an even spread), and the
+share of the datasets that move when one more queue is added.
+
+Run it in the CKAN virtualenv, where ckanext-xloader's dependencies are.
+'''
+import argparse
+import os
+import sys
+import uuid
+from collections import Counter
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ckanext.xloader import jobs  # noqa: E402
+
+
+def first_character(package_id):
+    return jobs.default_queue_names[ord(package_id[0]) % len(jobs.default_queue_names)]
+
+
+def fetch_package_ids(ckan_url, limit):
+    package_ids = []
+    while len(package_ids) < limit:
+        response = requests.get(ckan_url.rstrip('/') + '/api/3/action/package_search', params={
+            'fl': 'id', 'rows': min(1000, limit - len(package_ids)), 'start': len(package_ids),
+            'include_private': True,
+        }, timeout=60)
+        response.raise_for_status()
+        results = response.json()['result']['results']
+        if not results:
+            break
+        package_ids.extend(result['id'] for result in results)
+    return package_ids
+
+
+def spread(route, package_ids, queue_count):
+    jobs.default_queue_names = ['queue{}'.format(index) for index in range(queue_count)]
+    routes = {package_id: route(package_id) for package_id in package_ids}
+    counts = Counter(routes.values())
+    even = len(package_ids) / queue_count
+    return (max(counts.values()) / even,
+            min(counts.get(name, 0) for name in jobs.default_queue_names) / even,
+            routes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='*', help='files of package ids, one per line')
+    parser.add_argument('--ckan-url', help='fetch the package ids from this CKAN site')
+    parser.add_argument('--limit', type=int, default=10000,
+                        help='the most ids to fetch, or the number of random ones')
+    parser.add_argument('--max-queues', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.files:
+        package_ids = []
+        for path in args.files:
+            with open(path) as f:
+                package_ids.extend(line.strip() for line in f if line.strip())
+    elif args.ckan_url:
+        package_ids = fetch_package_ids(args.ckan_url, args.limit)
+    else:
+        package_ids = [str(uuid.uuid4()) for _ in range(args.limit)]
+    if not package_ids:
+        sys.exit('No package ids')
+    jobs.queue_depth_aware = False
+
+    print('{} package ids\n'.format(len(package_ids)))
+    print('{:>6}  {:>21}  {:>21}  {:>14}  {:>14}'.format(
+        'queues', 'first char max / min', 'hash max / min', 'first char +1', 'hash +1'))
+    for queue_count in range(2, args.max_queues + 1):
+        row = [queue_count]
+        moved = []
+        for route in (first_character, jobs.get_default_queue_name):
+            busiest, idlest, routes = spread(route, package_ids, queue_count)
+            _, _, routes_after = spread(route, package_ids, queue_count + 1)
+            row.append('{:.2f} / {:.2f}'.format(busiest, idlest))
+            moved.append(sum(routes[package_id] != routes_after[package_id]
+                             for package_id in package_ids) / len(package_ids))
+        print('{:>6}  {:>21}  {:>21}  {:>13.0%}  {:>13.0%}'.format(*(row + moved)))
+
+
+if __name__ == '__main__':
+    main()